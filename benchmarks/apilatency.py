@@ -0,0 +1,94 @@
+"""
+Per-call latency of the Kubernetes backends: `kubectl` processes (the stub
+of `stub.py`) against the API client of `ueli.kubeapi` talking to the fake
+API server of `fakeapi.py`, once with its pooled keep-alive connections and
+once with a new connection per call. Both servers answer after the same
+`--latency`, so the difference is what ueli pays per call on top:
+
+    python benchmarks/apilatency.py --calls 50 --latency 0.02
+
+The fake server speaks plain HTTP, against a real cluster every new
+connection additionally costs a TLS handshake.
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import commands  # noqa: E402
+import fakeapi  # noqa: E402
+from ueli import kubeapi, runner  # noqa: E402
+
+
+def measure(call, calls):
+    seconds = []
+    for _ in range(calls):
+        start = time.time()
+        call()
+        seconds.append(time.time() - start)
+    return seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--calls', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=commands.DEFAULT_LATENCY,
+                        help='Seconds the fake servers take per call (default %(default)s)')
+    args = parser.parse_args()
+
+    workspace = tempfile.mkdtemp(prefix='ueli-bench-')
+    api_server = None
+    try:
+        bin_dir = commands.install_stubs(workspace)
+        config = {
+            'log': os.path.join(workspace, 'calls.log'), 'seed': 1, 'commit': commands.COMMIT,
+            'latency': {'kubectl': args.latency}, 'output_bytes': {}, 'failure_rate': {},
+            'service': commands.SERVICE, 'image_repository': 'bench',
+            'namespaces': commands.ENVIRONMENTS, 'deployments': commands.DEPLOYMENTS,
+        }
+        api_server, url = fakeapi.start(config)
+        stub_config = os.path.join(workspace, 'stubs.json')
+        with open(stub_config, 'w') as f:
+            json.dump(config, f)
+        os.environ['UELI_BENCH_CONFIG'] = stub_config
+        os.environ['PATH'] = os.pathsep.join([bin_dir, os.environ.get('PATH', '')])
+
+        credentials = kubeapi.StaticCredentials(fakeapi.TOKEN)
+        client = kubeapi.ApiClient(url, credentials=credentials)
+        kubectl = ['kubectl', 'get', 'namespace', 'stage1', '-o', 'json']
+
+        def new_connection():
+            kubeapi.ApiClient(url, credentials=credentials).get('namespace', 'stage1')
+
+        results = [
+            ('kubectl', measure(lambda: runner.run(kubectl, quiet=True), args.calls)),
+            ('api (new connection)', measure(new_connection, args.calls)),
+            ('api (pooled)', measure(lambda: client.get('namespace', 'stage1'), args.calls)),
+        ]
+    finally:
+        if api_server is not None:
+            api_server.shutdown()
+        shutil.rmtree(workspace, ignore_errors=True)
+
+    baseline = statistics.median(results[0][1])
+    rows = [('BACKEND', 'MEDIAN', 'P95', 'OVERHEAD', 'SPEEDUP')]
+    for name, seconds in results:
+        median = statistics.median(seconds)
+        p95 = sorted(seconds)[int(len(seconds) * 0.95) - 1] if len(seconds) > 1 else seconds[0]
+        rows.append((name, '{:.1f} ms'.format(median * 1000), '{:.1f} ms'.format(p95 * 1000),
+                     '{:.1f} ms'.format((median - args.latency) * 1000),
+                     '{:.1f}x'.format(baseline / median)))
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    for row in rows:
+        print('  '.join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip())
+    print('{} calls each, {:.0f} ms server latency, pooled client opened {} '
+          'connection(s)'.format(args.calls, args.latency * 1000, client.pool.connections))
+
+
+if __name__ == '__main__':
+    main()
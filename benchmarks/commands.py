@@ -0,0 +1,358 @@
+"""
+Benchmarks of ueli commands against stub `git`, `kubectl`, `docker` and
+`gcloud` binaries.
+
+Every scenario runs `ueli` in a generated project (`ueli.yaml` and a tree
+of manifests of the given sizes) with the stubs from `stub.py` first on
+`PATH`, so it runs offline and without a cluster. Reports wall time,
+number of external processes and peak RSS of the ueli process per
+scenario and manifest count, and compares them against a stored baseline:
+
+    python benchmarks/commands.py --save-baseline
+    python benchmarks/commands.py --sizes 10,1000,5000 --latency kubectl=0.2
+
+Exits with status 1 if a scenario fails or the median wall time regressed
+by more than `--max-regression` percent against the baseline.
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import fakeapi
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STUB = os.path.join(ROOT, 'benchmarks', 'stub.py')
+TOOLS = ('git', 'kubectl', 'docker', 'gcloud')
+
+DEFAULT_BASELINE = os.path.join(ROOT, 'benchmarks', 'baseline.json')
+DEFAULT_SIZES = '10,100,1000'
+DEFAULT_RUNS = 3
+DEFAULT_LATENCY = 0.02
+DEFAULT_MAX_REGRESSION = 20
+
+SERVICE = 'bench'
+PROJECT = 'bench-project'
+REGISTRY = 'eu.gcr.io'
+ENVIRONMENTS = ['stage{}'.format(i) for i in range(1, 6)]
+DEPLOYMENTS = ['{}-web'.format(SERVICE), '{}-worker'.format(SERVICE)]
+COMMIT = 'a1b2c3d4e5f60718293a4b5c6d7e8f9012345678'
+
+# name: (ueli arguments, whether it depends on the number of manifests,
+# kubernetes backend). Scenarios of the `api` backend run against the fake
+# API server of `fakeapi.py`.
+SCENARIOS = [
+    ('status', ['status'], False, 'kubectl'),
+    ('inspect-deployments', ['inspect-deployments'], True, 'kubectl'),
+    ('where-used', ['where-used', 'DATABASE_URL_1'], True, 'kubectl'),
+    ('apply', ['apply', 'stage1', '--batch'], True, 'kubectl'),
+    ('apply-api', ['apply', 'stage1', '--batch'], True, 'api'),
+    ('build', ['build'], False, 'kubectl'),
+    ('delete-images', ['delete-images', '--keep', '2'], False, 'kubectl'),
+    ('deploy', ['deploy', 'stage1', 'master'], False, 'kubectl'),
+    ('deploy-api', ['deploy', 'stage1', 'master'], False, 'api'),
+    ('deploy-fanout', ['deploy', 'stage*', 'master'], False, 'kubectl'),
+    ('config-fanout', ['config', 'stage*', '--set', 'BENCH=1'], True, 'kubectl'),
+    ('config-fanout-api', ['config', 'stage*', '--set', 'BENCH=1'], True, 'api'),
+]
+
+# Runs ueli and writes its peak RSS to the file given as first argument
+RUN_UELI = '''
+import atexit, resource, sys
+def report(path=sys.argv[1]):
+    with open(path, 'w') as f:
+        f.write(str(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+atexit.register(report)
+sys.argv = ['ueli'] + sys.argv[2:]
+from ueli.main import main
+main()
+'''
+
+MANIFEST = '''apiVersion: apps/v1
+kind: Deployment
+metadata:
+  name: {name}
+spec:
+  replicas: 2
+  template:
+    metadata:
+      labels: {{name: {name}}}
+    spec:
+      volumes:
+        - name: config
+          configMap: {{name: {service}-config}}
+      containers:
+        - name: {service}
+          image: {image}:master.0000000
+          env:
+            - name: DATABASE_URL
+              valueFrom: {{configMapKeyRef: {{name: {service}-config, key: DATABASE_URL_{i}}}}}
+            - name: SECRET_KEY
+              valueFrom: {{secretKeyRef: {{name: {service}-secret, key: SECRET_KEY_{i}}}}}
+---
+apiVersion: v1
+kind: Service
+metadata:
+  name: {name}
+spec:
+  selector: {{name: {name}}}
+  ports:
+    - port: 80
+'''
+
+
+def write_config(path, backend):
+    with open(os.path.join(path, 'ueli.yaml'), 'w') as f:
+        f.write('service: {service}\n'
+                'repository: git@example.com:bench/{service}.git\n'
+                'gcloud:\n'
+                '  project: {project}\n'
+                '  registry: {registry}\n'
+                '  cluster: stage\n'
+                'kubernetes:\n'
+                '  backend: {backend}\n'
+                'deployments:\n'.format(
+                    service=SERVICE, project=PROJECT, registry=REGISTRY, backend=backend))
+        for deployment in DEPLOYMENTS:
+            f.write('  - name: {deployment}\n'
+                    '    apply:\n'
+                    '      - k8s/{deployment}\n'.format(deployment=deployment))
+
+
+def write_project(path, size):
+    """
+    Generates `ueli.yaml`, `size` manifests split over two deployments, a
+    build context and a `.git` directory ueli can read branch and commit
+    from.
+    """
+    image = '{registry}/{project}/{service}'.format(registry=REGISTRY, project=PROJECT,
+                                                    service=SERVICE)
+    for deployment in DEPLOYMENTS:
+        os.makedirs(os.path.join(path, 'k8s', deployment))
+    for i in range(size):
+        deployment = DEPLOYMENTS[i % len(DEPLOYMENTS)]
+        name = '{deployment}-{i}'.format(deployment=deployment, i=i)
+        with open(os.path.join(path, 'k8s', deployment, '{}.yaml'.format(name)), 'w') as f:
+            f.write(MANIFEST.format(name=name, service=SERVICE, image=image, i=i))
+
+    write_config(path, backend='kubectl')
+
+    os.makedirs(os.path.join(path, 'source'))
+    with open(os.path.join(path, 'source', 'Dockerfile'), 'w') as f:
+        f.write('FROM scratch\n')
+
+    os.makedirs(os.path.join(path, '.git', 'refs', 'heads'))
+    with open(os.path.join(path, '.git', 'HEAD'), 'w') as f:
+        f.write('ref: refs/heads/master\n')
+    with open(os.path.join(path, '.git', 'refs', 'heads', 'master'), 'w') as f:
+        f.write(COMMIT + '\n')
+    return image
+
+
+def install_stubs(path):
+    bin_dir = os.path.join(path, 'bin')
+    os.makedirs(bin_dir)
+    for tool in TOOLS:
+        script = os.path.join(bin_dir, tool)
+        with open(script, 'w') as f:
+            f.write('#!/bin/sh\nexec "{python}" "{stub}" {tool} "$@"\n'.format(
+                python=sys.executable, stub=STUB, tool=tool))
+        os.chmod(script, 0o755)
+    return bin_dir
+
+
+def parse_per_tool(values, default):
+    """
+    Parses `TOOL=VALUE` (or just `VALUE` for all tools) options.
+    """
+    result = dict((tool, default) for tool in TOOLS)
+    for value in values or []:
+        if '=' in value:
+            tool, value = value.split('=', 1)
+            result[tool] = float(value)
+        else:
+            result = dict((tool, float(value)) for tool in TOOLS)
+    return result
+
+
+def run_scenario(workspace, env, args, log):
+    """
+    Runs ueli once and returns (wall seconds, processes, peak RSS in MB,
+    exit code, output).
+    """
+    with open(log, 'a'):
+        pass
+    with open(log) as f:
+        calls_before = sum(1 for _ in f)
+    rss_file = os.path.join(workspace, 'rss')
+
+    start = time.time()
+    process = subprocess.Popen(
+        [sys.executable, '-c', RUN_UELI, rss_file] + args, cwd=workspace, env=env,
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+        universal_newlines=True)
+    output, _ = process.communicate('y\n')
+    seconds = time.time() - start
+
+    with open(log) as f:
+        calls = sum(1 for _ in f) - calls_before
+    try:
+        with open(rss_file) as f:
+            rss = int(f.read())
+    except (IOError, ValueError):
+        rss = 0
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    rss_mb = rss / (1024.0 * 1024.0) if sys.platform == 'darwin' else rss / 1024.0
+    return seconds, calls, rss_mb, process.returncode, output
+
+
+def run_benchmarks(args):
+    sizes = [int(size) for size in args.sizes.split(',')]
+    scenarios = [s for s in SCENARIOS if not args.scenarios or s[0] in args.scenarios]
+    results = {}
+    failed = False
+
+    for size in sizes:
+        workspace = tempfile.mkdtemp(prefix='ueli-bench-')
+        api_server = None
+        try:
+            image = write_project(workspace, size)
+            bin_dir = install_stubs(workspace)
+            log = os.path.join(workspace, 'calls.log')
+            stub_config = os.path.join(workspace, 'stubs.json')
+            failure_rate = parse_per_tool(args.failure_rate, 0)
+            config = {
+                'log': log, 'seed': args.seed, 'commit': COMMIT,
+                'latency': parse_per_tool(args.latency, DEFAULT_LATENCY),
+                'output_bytes': parse_per_tool(args.output_bytes, 0),
+                'failure_rate': failure_rate,
+                'service': SERVICE, 'image_repository': image,
+                'namespaces': ENVIRONMENTS, 'deployments': DEPLOYMENTS,
+                'project': PROJECT, 'cluster': 'stage', 'location': 'europe-west1-b',
+            }
+            api_server, config['api_server'] = fakeapi.start(config)
+            with open(stub_config, 'w') as f:
+                json.dump(config, f)
+
+            for name, ueli_args, sized, backend in scenarios:
+                if not sized and size != sizes[0]:
+                    continue
+                write_config(workspace, backend=backend)
+                # Every scenario starts with empty caches, the first run is cold
+                cache_dir = os.path.join(workspace, 'cache-{}'.format(name))
+                env = dict(os.environ,
+                           PATH=os.pathsep.join([bin_dir, os.environ.get('PATH', '')]),
+                           PYTHONPATH=ROOT, UELI_BENCH_CONFIG=stub_config,
+                           UELI_CACHE_DIR=cache_dir,
+                           KUBECONFIG=os.path.join(workspace, 'kubeconfig-{}'.format(name)))
+                runs = [run_scenario(workspace, env, ueli_args, log) for _ in range(args.runs)]
+
+                errors = [run for run in runs if run[3] != 0]
+                # Errors are expected with injected failures
+                if errors and not any(failure_rate.values()):
+                    failed = True
+                    print('{name} ({size} manifests) failed:\n{output}'.format(
+                        name=name, size=size, output=errors[0][4]))
+
+                results['{}@{}'.format(name, size)] = {
+                    'cold': runs[0][0],
+                    'median': statistics.median(run[0] for run in runs),
+                    'processes': max(run[1] for run in runs),
+                    'rss_mb': max(run[2] for run in runs),
+                    'errors': len(errors),
+                }
+        finally:
+            if api_server is not None:
+                api_server.shutdown()
+            shutil.rmtree(workspace, ignore_errors=True)
+    return results, failed
+
+
+def format_change(value, baseline):
+    if baseline is None:
+        return ''
+    if not baseline:
+        return ' (+0%)' if not value else ' (was 0)'
+    return ' ({:+.0f}%)'.format((value - baseline) * 100.0 / baseline)
+
+
+def report(results, baseline, max_regression):
+    """
+    Prints the results compared to `baseline` and returns the names of
+    regressed scenarios.
+    """
+    rows = [('SCENARIO', 'COLD', 'MEDIAN', 'PROCESSES', 'PEAK RSS', 'ERRORS')]
+    regressions = []
+    for key in sorted(results, key=lambda key: (key.split('@')[0], int(key.split('@')[1]))):
+        result = results[key]
+        base = baseline.get(key) or {}
+        rows.append((
+            key,
+            '{:.3f}s'.format(result['cold']),
+            '{:.3f}s{}'.format(result['median'],
+                               format_change(result['median'], base.get('median'))),
+            '{}{}'.format(result['processes'],
+                          format_change(result['processes'], base.get('processes'))),
+            '{:.1f} MB{}'.format(result['rss_mb'],
+                                 format_change(result['rss_mb'], base.get('rss_mb'))),
+            str(result['errors']),
+        ))
+        if base.get('median') and \
+                result['median'] > base['median'] * (1 + max_regression / 100.0):
+            regressions.append(key)
+
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    for row in rows:
+        print('  '.join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip())
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--sizes', default=DEFAULT_SIZES,
+                        help='Comma separated numbers of manifests (default %(default)s)')
+    parser.add_argument('--scenario', dest='scenarios', action='append',
+                        choices=[s[0] for s in SCENARIOS],
+                        help='Only run this scenario, can be used multiple times')
+    parser.add_argument('--runs', type=int, default=DEFAULT_RUNS)
+    parser.add_argument('--latency', action='append', metavar='[TOOL=]SECONDS',
+                        help='Latency of stub calls (default {})'.format(DEFAULT_LATENCY))
+    parser.add_argument('--output-bytes', action='append', metavar='[TOOL=]BYTES',
+                        help='Extra output of stub calls')
+    parser.add_argument('--failure-rate', action='append', metavar='[TOOL=]RATE',
+                        help='Share of stub calls failing with a transient error')
+    parser.add_argument('--seed', type=int, default=1, help='Seed of stub failures')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='Store the results as new baseline')
+    parser.add_argument('--max-regression', type=float, default=DEFAULT_MAX_REGRESSION,
+                        help='Allowed slowdown of median wall time in percent')
+    args = parser.parse_args()
+
+    baseline = {}
+    if not args.save_baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results, failed = run_benchmarks(args)
+    regressions = report(results, baseline, args.max_regression)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print('Baseline written to {}'.format(args.baseline))
+    elif regressions:
+        print('Regressed by more than {:.0f}%: {}'.format(args.max_regression,
+                                                          ', '.join(regressions)))
+    if failed or (regressions and not args.save_baseline):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,236 @@
+"""
+Fake Kubernetes API server for the benchmarks, the counterpart of the
+`kubectl` stub in `stub.py` for ueli's API backend (`kubernetes.backend:
+api`). Serves the same synthetic world read from `$UELI_BENCH_CONFIG`
+over plain HTTP with keep-alive:
+
+    python benchmarks/fakeapi.py --port 8001
+
+It answers the calls ueli makes: get and list (with label selector and
+pages) of namespaces, configmaps and deployments, create, replace, merge
+patch and server side apply. Like the stub, the world doesn't change:
+writes are answered as if they succeeded but not stored, so every
+benchmark run starts from the same state. Every request sleeps for the `kubectl`
+latency of the config, so API and kubectl calls see the same server.
+"""
+import argparse
+import copy
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import stub  # noqa: E402
+
+
+TOKEN = 'bench-token'
+
+# resource -> (API path, kind)
+RESOURCES = {
+    'namespaces': ('/api/v1', 'Namespace'),
+    'configmaps': ('/api/v1', 'ConfigMap'),
+    'deployments': ('/apis/apps/v1', 'Deployment'),
+}
+
+
+def build_world(config):
+    """
+    Returns the objects of the fake cluster keyed by (resource, namespace,
+    name), the same ones the kubectl stub lists.
+    """
+    world = {}
+    for namespace in ['default', 'kube-system'] + config['namespaces']:
+        labels = {} if namespace in ('default', 'kube-system') else \
+            {'app.kubernetes.io/managed-by': 'ueli'}
+        world[('namespaces', None, namespace)] = {
+            'apiVersion': 'v1', 'kind': 'Namespace',
+            'metadata': {'name': namespace, 'labels': labels,
+                         'creationTimestamp': '2026-01-01T00:00:00Z'}}
+    for namespace in config['namespaces']:
+        name = '{}-config'.format(config['service'])
+        world[('configmaps', namespace, name)] = {
+            'apiVersion': 'v1', 'kind': 'ConfigMap',
+            'metadata': {'name': name, 'namespace': namespace}}
+        for name in config['deployments']:
+            world[('deployments', namespace, name)] = stub.deployment(config, namespace, name)
+    return world
+
+
+def merge(target, patch):
+    """
+    Applies a JSON merge patch, which is good enough for server side apply
+    of the few fields ueli sends, too.
+    """
+    if not isinstance(patch, dict):
+        return copy.deepcopy(patch)
+    result = dict(target) if isinstance(target, dict) else {}
+    for key, value in patch.items():
+        if value is None:
+            result.pop(key, None)
+        elif key == 'containers' and isinstance(value, list):
+            # Lists of containers are merged by name like the API server does
+            containers = dict((c['name'], c) for c in result.get(key) or [])
+            result[key] = [merge(containers.get(c['name'], {}), c) for c in value]
+        else:
+            result[key] = merge(result.get(key), value)
+    return result
+
+
+def parse_path(path):
+    """
+    Returns (resource, namespace, name) of an API path or None.
+    """
+    for prefix in set(prefix for prefix, kind in RESOURCES.values()):
+        if path.startswith(prefix + '/'):
+            parts = [unquote(part) for part in path[len(prefix) + 1:].split('/') if part]
+            break
+    else:
+        return None
+    namespace = None
+    if len(parts) >= 3 and parts[0] == 'namespaces':
+        namespace, parts = parts[1], parts[2:]
+    if not parts or parts[0] not in RESOURCES or len(parts) > 2:
+        return None
+    return parts[0], namespace, parts[1] if len(parts) == 2 else None
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in one write, otherwise Nagle's algorithm and
+    # delayed ACKs stall every response on a kept-alive connection
+    wbufsize = 64 * 1024
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_status(self, status, reason, message):
+        self.send_json(status, {'kind': 'Status', 'apiVersion': 'v1', 'status': 'Failure',
+                                'reason': reason, 'message': message, 'code': status})
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length)) if length else None
+
+    def handle_request(self, method):
+        server = self.server
+        server.requests += 1
+        time.sleep(server.latency)
+        url = urlsplit(self.path)
+        body = self.read_body()
+        if self.headers.get('Authorization') != 'Bearer {}'.format(TOKEN):
+            return self.send_status(401, 'Unauthorized', 'Unauthorized')
+        parsed = parse_path(url.path)
+        if parsed is None:
+            return self.send_status(404, 'NotFound', 'the server could not find the resource')
+        resource, namespace, name = parsed
+        key = (resource, namespace, name)
+
+        if method == 'GET' and name is None:
+            return self.send_json(200, self.list(resource, namespace, parse_qs(url.query)))
+        if method == 'GET':
+            if key not in server.world:
+                return self.send_status(404, 'NotFound', '{} "{}" not found'.format(
+                    resource, name))
+            return self.send_json(200, server.world[key])
+        if method == 'POST':
+            name = (body.get('metadata') or {}).get('name')
+            if (resource, namespace, name) in server.world:
+                return self.send_status(409, 'AlreadyExists', '{} "{}" already exists'.format(
+                    resource, name))
+            return self.send_json(201, body)
+        if method == 'PUT':
+            if key not in server.world:
+                return self.send_status(404, 'NotFound', '{} "{}" not found'.format(
+                    resource, name))
+            return self.send_json(200, body)
+        if method == 'PATCH':
+            apply = self.headers.get('Content-Type') == 'application/apply-patch+yaml'
+            if key not in server.world and not apply:
+                return self.send_status(404, 'NotFound', '{} "{}" not found'.format(
+                    resource, name))
+            current = server.world.get(key) or {}
+            result = merge(current, body)
+            if resource == 'deployments' and result.get('spec') != current.get('spec'):
+                result['metadata']['generation'] = \
+                    (current.get('metadata') or {}).get('generation', 0) + 1
+            return self.send_json(200, result)
+        self.send_status(405, 'MethodNotAllowed', 'method not allowed')
+
+    def list(self, resource, namespace, query):
+        items = [obj for (r, ns, n), obj in sorted(self.server.world.items(),
+                                                   key=lambda item: (item[0][1] or '',
+                                                                     item[0][2]))
+                 if r == resource and (namespace is None or ns == namespace)]
+        for selector in query.get('labelSelector', []):
+            label, value = selector.split('=', 1)
+            items = [obj for obj in items
+                     if (obj['metadata'].get('labels') or {}).get(label) == value]
+        start = int(query.get('continue', ['0'])[0])
+        limit = int(query.get('limit', ['0'])[0]) or len(items)
+        page = items[start:start + limit]
+        metadata = {}
+        if start + limit < len(items):
+            metadata['continue'] = str(start + limit)
+        prefix, kind = RESOURCES[resource]
+        # Like the real API server, items of lists come without kind
+        page = [dict((k, v) for k, v in obj.items() if k not in ('kind', 'apiVersion'))
+                for obj in page]
+        return {'kind': '{}List'.format(kind), 'apiVersion': prefix.split('/', 2)[-1],
+                'metadata': metadata, 'items': page}
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_PUT(self):
+        self.handle_request('PUT')
+
+    def do_PATCH(self):
+        self.handle_request('PATCH')
+
+
+def start(config, port=0):
+    """
+    Starts the server in a background thread and returns it with its URL.
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    server.daemon_threads = True
+    server.world = build_world(config)
+    server.latency = config['latency'].get('kubectl', 0)
+    server.requests = 0
+    thread = threading.Thread(target=server.serve_forever, name='fakeapi')
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:{}'.format(server.server_address[1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--port', type=int, default=8001)
+    args = parser.parse_args()
+    server, url = start(stub.load_config(), port=args.port)
+    print('Serving on {}'.format(url))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""
+Import time benchmark for the `ueli` entry point.
+
+Runs `python -X importtime -c "import ueli.main"` a couple of times and
+reports the best cumulative import time of `ueli.main`, split into click and
+ueli's own share. Exits with status 1 if ueli's own share exceeds the budget,
+so it can run in CI:
+
+    python benchmarks/importtime.py --budget-ms 30
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_RUNS = 7
+DEFAULT_BUDGET_MS = 30
+
+
+def measure(module='ueli.main'):
+    """
+    Returns cumulative import times in microseconds of all top level imports
+    of one fresh interpreter importing `module`.
+    """
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    output = subprocess.check_output(
+        [sys.executable, '-X', 'importtime', '-c', 'import {}'.format(module)],
+        stderr=subprocess.STDOUT, env=env, universal_newlines=True)
+
+    times = {}
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative_us)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--runs', type=int, default=DEFAULT_RUNS)
+    parser.add_argument('--budget-ms', type=float, default=DEFAULT_BUDGET_MS,
+                        help="Budget for ueli's own import time")
+    args = parser.parse_args()
+
+    total, click = [], []
+    for _ in range(args.runs):
+        times = measure()
+        total.append(times['ueli.main'])
+        click.append(times.get('click', 0))
+
+    best_total = min(total) / 1000.0
+    best_click = min(click) / 1000.0
+    own = best_total - best_click
+    print('ueli.main: {:.1f} ms (click {:.1f} ms, ueli {:.1f} ms, budget {:.1f} ms)'.format(
+        best_total, best_click, own, args.budget_ms))
+
+    if own > args.budget_ms:
+        print('Import time budget exceeded')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
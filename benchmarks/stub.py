@@ -0,0 +1,229 @@
+"""
+Stand-in for `git`, `kubectl`, `docker` and `gcloud` used by the command
+benchmarks (see `commands.py`). Installed on `PATH` as small wrapper scripts
+calling
+
+    python stub.py TOOL ARGS...
+
+It answers just enough of each tool's interface for ueli's commands to run
+against a synthetic cluster and registry, entirely offline. Behaviour is read
+from the JSON file in `$UELI_BENCH_CONFIG`:
+
+- `latency`, `output_bytes` and `failure_rate` per tool: seconds to sleep,
+  bytes of filler written to stderr and the probability of failing with a
+  transient error. Failures are reproducible for a `seed`, retries of the
+  same command get a new draw.
+- `log`: every call is appended to this file, one line per process.
+- `service`, `image_repository`, `namespaces`, `deployments`, `commit`,
+  `project`, `cluster` and `location` describe the fake world.
+- `api_server`: URL of the fake API server (see `fakeapi.py`) written to
+  the kubeconfig by `gcloud container clusters get-credentials`.
+"""
+import hashlib
+import json
+import os
+import random
+import sys
+import time
+
+
+def load_config():
+    with open(os.environ['UELI_BENCH_CONFIG']) as f:
+        return json.load(f)
+
+
+def log_call(config, tool, args):
+    """
+    Appends the call to the log and returns how often the same command was
+    called before.
+    """
+    line = ' '.join([tool] + args) + '\n'
+    previous = 0
+    if os.path.exists(config['log']):
+        with open(config['log']) as f:
+            previous = sum(1 for logged in f if logged == line)
+    with open(config['log'], 'a') as f:
+        f.write(line)
+    return previous
+
+
+def should_fail(config, tool, args, attempt):
+    rate = config['failure_rate'].get(tool, 0)
+    if not rate:
+        return False
+    key = '{seed} {attempt} {tool} {args}'.format(seed=config['seed'], attempt=attempt,
+                                                 tool=tool, args=' '.join(args))
+    seed = int(hashlib.sha1(key.encode('utf-8')).hexdigest()[:8], 16)
+    return random.Random(seed).random() < rate
+
+
+def get_option(args, name):
+    for i, arg in enumerate(args):
+        if arg.startswith(name + '='):
+            return arg.split('=', 1)[1]
+        if arg == name and i + 1 < len(args):
+            return args[i + 1]
+    return None
+
+
+def deployment(config, namespace, name, generation=1, image=None):
+    image = image or '{}:master.0000000'.format(config['image_repository'])
+    return {
+        'apiVersion': 'apps/v1',
+        'kind': 'Deployment',
+        'metadata': {'name': name, 'namespace': namespace, 'generation': generation,
+                     'creationTimestamp': '2026-01-01T00:00:00Z'},
+        'spec': {'replicas': 2, 'template': {'spec': {'containers': [
+            {'name': config['service'], 'image': image},
+            {'name': 'proxy', 'image': 'nginx:1.25'}]}}},
+        'status': {'observedGeneration': generation, 'replicas': 2, 'updatedReplicas': 2,
+                   'availableReplicas': 2},
+    }
+
+
+def kubectl(config, args):
+    if args[:1] == ['get'] and '--watch' in args:
+        # Every deployment is updated and ready right away, the watch then
+        # waits for changes until it's stopped
+        namespace = get_option(args, '--namespace')
+        for name in config['deployments']:
+            print(json.dumps(deployment(config, namespace, name, generation=2), indent=4))
+        sys.stdout.flush()
+        time.sleep(3600)
+    elif args[:1] == ['get'] and get_option(args, '-o') == 'json':
+        kinds = args[1].split(',')
+        selected = get_option(args, '--namespace')
+        items = []
+        for namespace in ['default', 'kube-system'] + config['namespaces']:
+            if 'namespace' not in kinds:
+                break
+            labels = {} if namespace in ('default', 'kube-system') else \
+                {'app.kubernetes.io/managed-by': 'ueli'}
+            items.append({'apiVersion': 'v1', 'kind': 'Namespace',
+                          'metadata': {'name': namespace, 'labels': labels,
+                                       'creationTimestamp': '2026-01-01T00:00:00Z'}})
+        for namespace in config['namespaces']:
+            if selected is not None and namespace != selected:
+                continue
+            if 'configmap' in kinds:
+                items.append({'apiVersion': 'v1', 'kind': 'ConfigMap',
+                              'metadata': {'name': '{}-config'.format(config['service']),
+                                           'namespace': namespace}})
+            if 'deployment' in kinds:
+                items.extend(deployment(config, namespace, name)
+                             for name in config['deployments'])
+        print(json.dumps({'apiVersion': 'v1', 'kind': 'List', 'items': items}))
+    elif args[:1] == ['apply'] and '-f' in args and get_option(args, '-f') == '-':
+        data = json.load(sys.stdin)
+        namespace = get_option(args, '--namespace')
+        items = [deployment(config, namespace, item['metadata']['name'], generation=2)
+                 for item in data.get('items', [data])]
+        print(json.dumps({'apiVersion': 'v1', 'kind': 'List', 'items': items}, indent=4))
+    elif args[:1] == ['apply']:
+        for i, arg in enumerate(args):
+            if arg == '-f':
+                print('{} configured'.format(args[i + 1]))
+    elif args[:1] in (['create'], ['replace']) and get_option(args, '-f') == '-':
+        data = json.load(sys.stdin)
+        print('{}/{} {}d'.format(data['kind'].lower(), data['metadata']['name'], args[0]))
+    elif args[:1] == ['create']:
+        print('{}/{} created'.format(args[1], args[2]))
+
+
+def git(config, args):
+    commit = config['commit']
+    if args[:1] == ['status']:
+        print('# branch.oid {}'.format(commit))
+        print('# branch.head master')
+    elif args[:1] == ['rev-parse']:
+        print('master' if '--abbrev-ref' in args else commit)
+    elif args[:1] == ['ls-remote']:
+        # ls-remote [--heads] REPOSITORY [BRANCH...]
+        branches = [a for a in args[1:] if not a.startswith('-')][1:] or ['master', 'feature']
+        for branch in branches:
+            print('{commit}\trefs/heads/{branch}'.format(commit=commit, branch=branch))
+
+
+def gcloud(config, args):
+    if args[:3] == ['container', 'clusters', 'get-credentials']:
+        name = 'gke_{project}_{location}_{cluster}'.format(**config)
+        with open(os.environ['KUBECONFIG'], 'w') as f:
+            json.dump({
+                'apiVersion': 'v1',
+                'current-context': name,
+                'contexts': [{'name': name, 'context': {'cluster': name, 'user': name}}],
+                'clusters': [{'name': name, 'cluster': {
+                    'server': config.get('api_server') or 'https://127.0.0.1'}}],
+                'users': [{'name': name, 'user': {'token': 'bench-token'}}],
+            }, f)
+        sys.stderr.write('Fetching cluster endpoint and auth data.\n')
+    elif args[:3] == ['container', 'images', 'list-tags']:
+        print('[]')
+
+
+def local_images(config):
+    """
+    Images listed by `docker images`: ten builds of each of twenty branches
+    of the service, every other one also with its remote tag, and a few
+    base images.
+    """
+    service = config['image_repository'].rsplit('/', 1)[-1]
+    result = []
+    for branch in range(20):
+        for build in range(10):
+            commit = hashlib.sha1('{} {}'.format(branch, build).encode('utf-8')).hexdigest()[:7]
+            image = {'Tag': 'branch-{}.{}'.format(branch, commit), 'ID': 'sha256:' + commit,
+                     'CreatedAt': '2026-10-{:02d} 12:00:00 +0200 CEST'.format(build + 1),
+                     'Size': '{}MB'.format(100 + build)}
+            result.append(dict(image, Repository=service))
+            if build % 2:
+                result.append(dict(image, Repository=config['image_repository']))
+    for repository, tag in (('python', '3.11'), ('node', '20'), ('nginx', '1.25')):
+        result.append({'Repository': repository, 'Tag': tag, 'ID': 'sha256:' + repository,
+                       'CreatedAt': '2026-01-01 12:00:00 +0100 CET', 'Size': '900MB'})
+    return result
+
+
+def docker(config, args):
+    if args[:1] == ['images'] and get_option(args, '--format') == '{{json .}}':
+        for image in local_images(config):
+            print(json.dumps(image))
+    elif args[:2] == ['system', 'df']:
+        print(json.dumps({'Type': 'Images', 'Size': '25.2GB', 'Reclaimable': '0B'}))
+    elif args[:1] == ['rmi']:
+        for ref in args[1:]:
+            print('Untagged: {}'.format(ref))
+    elif args[:2] in (['image', 'inspect'], ['manifest', 'inspect']):
+        sys.stderr.write('Error: No such image\n')
+        sys.exit(1)
+    elif args[:1] == ['build']:
+        print('sha256:{}'.format(hashlib.sha256(' '.join(args).encode('utf-8')).hexdigest()))
+
+
+TOOLS = {
+    'kubectl': kubectl,
+    'git': git,
+    'gcloud': gcloud,
+    'docker': docker,
+}
+
+
+def main():
+    tool, args = sys.argv[1], sys.argv[2:]
+    config = load_config()
+    attempt = log_call(config, tool, args)
+
+    time.sleep(config['latency'].get(tool, 0))
+    filler = int(config['output_bytes'].get(tool, 0))
+    if filler:
+        line = '.' * 79 + '\n'
+        sys.stderr.write(line * (filler // len(line)))
+
+    if should_fail(config, tool, args, attempt):
+        sys.stderr.write('error: read tcp 10.0.0.1:443: connection reset by peer\n')
+        sys.exit(1)
+    TOOLS[tool](config, args)
+
+
+if __name__ == '__main__':
+    main()
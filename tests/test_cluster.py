@@ -0,0 +1,44 @@
+from ueli import cluster
+
+
+MANIFESTS = [
+    ('k8s/config.yaml', ['ConfigMap']),
+    ('k8s/service.yaml', ['Service']),
+    ('k8s/deployment.yaml', ['Deployment']),
+]
+
+
+def test_apply_plan_skips_unchanged_files():
+    hashes = {'k8s/config.yaml': 'a', 'k8s/service.yaml': 'b2', 'k8s/deployment.yaml': 'c'}
+    applied = {'k8s/service.yaml': 'b1', 'k8s/deployment.yaml': 'c'}
+    plan = cluster.ApplyPlan(MANIFESTS, hashes=hashes, applied=applied)
+    assert plan.to_apply == MANIFESTS[:2]
+    assert plan.changes == {'k8s/config.yaml': 'new', 'k8s/service.yaml': 'changed'}
+    assert plan.unchanged == ['k8s/deployment.yaml']
+
+
+def test_full_apply_plan_applies_unchanged_files():
+    hashes = {'k8s/config.yaml': 'a', 'k8s/service.yaml': 'b', 'k8s/deployment.yaml': 'c'}
+    plan = cluster.ApplyPlan(MANIFESTS, hashes=hashes, applied=dict(hashes), full=True)
+    assert plan.to_apply == MANIFESTS
+    assert plan.changes == {}
+    assert plan.unchanged == []
+
+
+def test_apply_plan_state_keeps_hashes_of_failed_files():
+    hashes = {'k8s/config.yaml': 'a2', 'k8s/service.yaml': 'b2', 'k8s/deployment.yaml': 'c'}
+    applied = {'k8s/config.yaml': 'a1', 'k8s/service.yaml': 'b1', 'k8s/deployment.yaml': 'c',
+               'k8s/removed.yaml': 'd'}
+    plan = cluster.ApplyPlan(MANIFESTS, hashes=hashes, applied=applied)
+    results = [
+        cluster.ApplyResult(['k8s/config.yaml'], cmd=[], returncode=0),
+        cluster.ApplyResult(['k8s/service.yaml'], cmd=[], returncode=1),
+    ]
+    assert plan.get_state(results) == {
+        'k8s/config.yaml': 'a2', 'k8s/service.yaml': 'b1', 'k8s/deployment.yaml': 'c'}
+
+
+def test_applied_hashes_of_invalid_state_are_empty():
+    assert cluster.get_applied_hashes(None) == {}
+    assert cluster.get_applied_hashes({'data': {cluster.STATE_KEY: 'not json'}}) == {}
+    assert cluster.get_applied_hashes({'data': {cluster.STATE_KEY: '{"a": "1"}'}}) == {'a': '1'}
@@ -0,0 +1,67 @@
+from ueli import configmaps, manifests
+
+
+def get_current(data):
+    return {'apiVersion': 'v1', 'kind': 'ConfigMap',
+            'metadata': {'name': 'web-config', 'namespace': 'stage1',
+                         'resourceVersion': '42', 'uid': 'abc'},
+            'data': data}
+
+
+def get_analysis(required, used_whole=False):
+    analysis = manifests.Analysis(service='web')
+    analysis.required_config_keys = set(required)
+    analysis.config_used_whole = used_whole
+    return analysis
+
+
+def test_change_tells_added_changed_and_removed_keys():
+    current = get_current({'DEBUG': 'false', 'HOST': 'a', 'OLD': 'x'})
+    change = configmaps.ConfigChange('web-config', 'stage1', current,
+                                     values={'DEBUG': 'true', 'HOST': 'a', 'PORT': '80'},
+                                     unset=['OLD', 'UNKNOWN'])
+    assert change.added == ['PORT']
+    assert change.changed == ['DEBUG']
+    assert change.removed == ['OLD']
+    assert change.data == {'DEBUG': 'true', 'HOST': 'a', 'PORT': '80'}
+    assert change.dirty
+
+
+def test_change_setting_same_values_is_not_dirty():
+    change = configmaps.ConfigChange('web-config', 'stage1', get_current({'HOST': 'a'}),
+                                     values={'HOST': 'a'})
+    assert not change.dirty
+    assert change.get_cmd()[:2] == ['kubectl', 'replace']
+
+
+def test_change_of_missing_configmap_creates_it():
+    change = configmaps.ConfigChange('web-config', 'stage1', None)
+    assert change.dirty
+    assert change.get_cmd()[:2] == ['kubectl', 'create']
+    assert change.to_manifest()['metadata'] == {'name': 'web-config', 'namespace': 'stage1'}
+
+
+def test_change_manifest_keeps_resource_version():
+    change = configmaps.ConfigChange('web-config', 'stage1', get_current({}),
+                                     values={'HOST': 'a'})
+    metadata = change.to_manifest()['metadata']
+    assert metadata['resourceVersion'] == '42'
+    assert 'uid' not in metadata
+
+
+def test_change_tells_missing_and_unused_keys():
+    change = configmaps.ConfigChange('web-config', 'stage1', get_current({'HOST': 'a', 'OLD': 'x'}),
+                                     unset=['HOST'])
+    analysis = get_analysis(['HOST', 'PORT'])
+    assert change.missing(analysis) == ['HOST', 'PORT']
+    assert change.unused(analysis) == ['OLD']
+
+
+def test_no_keys_are_unused_if_used_as_whole():
+    change = configmaps.ConfigChange('web-config', 'stage1', get_current({'OLD': 'x'}))
+    assert change.unused(get_analysis([], used_whole=True)) == []
+
+
+def test_parse_env_file():
+    assert configmaps.parse_env_file('# comment\n\nA=1\nB=x=y\nC=\n') == \
+        {'A': '1', 'B': 'x=y', 'C': ''}
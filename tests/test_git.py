@@ -0,0 +1,108 @@
+import pytest
+
+from ueli import git, runner
+
+
+REPOSITORY = 'git@github.com:flatfox-ag/web.git'
+
+LS_REMOTE = '\n'.join([
+    'aaaaaaa1\trefs/heads/master',
+    'bbbbbbb2\trefs/heads/feature-xy',
+    'ccccccc3\trefs/heads/user/feature',
+    'ddddddd4\trefs/tags/feature',
+    'eeeeeee5\tHEAD',
+])
+
+
+class FakeLsRemote(object):
+
+    def __init__(self, output=LS_REMOTE):
+        self.output = output
+        self.calls = 0
+
+    def run_local(self, cmd, verbose=False):
+        assert cmd[:3] == ['git', 'ls-remote', '--heads']
+        self.calls += 1
+        if self.output is None:
+            raise runner.CommandError(128, cmd, output='', stderr='fatal: Could not read')
+        return self.output
+
+
+@pytest.fixture
+def ls_remote(monkeypatch):
+    fake = FakeLsRemote()
+    monkeypatch.setattr(git.utils, 'run_local', fake.run_local)
+    return fake
+
+
+@pytest.fixture
+def now(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(git.time, 'time', lambda: now[0])
+    return now
+
+
+def test_parse_heads_takes_branches_only():
+    assert git.parse_heads(LS_REMOTE) == {
+        'master': 'aaaaaaa1',
+        'feature-xy': 'bbbbbbb2',
+        'user/feature': 'ccccccc3',
+    }
+
+
+def test_resolve_matches_branches_exactly(tmp_path, ls_remote):
+    refs = git.RemoteRefCache(path=str(tmp_path / 'refs.json'))
+    assert refs.resolve(REPOSITORY, 'feature-xy') == 'bbbbbbb2'
+    assert refs.resolve(REPOSITORY, 'feature') is None
+    assert refs.resolve(REPOSITORY, 'feature-x') is None
+
+
+def test_heads_are_cached_within_ttl(tmp_path, ls_remote, now):
+    refs = git.RemoteRefCache(path=str(tmp_path / 'refs.json'), ttl=30)
+    assert refs.resolve(REPOSITORY, 'master') == 'aaaaaaa1'
+    now[0] += 30
+    # Another instance, e.g. the next ueli call, reads the file
+    refs = git.RemoteRefCache(path=str(tmp_path / 'refs.json'), ttl=30)
+    assert refs.resolve(REPOSITORY, 'master') == 'aaaaaaa1'
+    assert ls_remote.calls == 1
+
+    now[0] += 1
+    ls_remote.output = 'fffffff6\trefs/heads/master'
+    assert refs.resolve(REPOSITORY, 'master') == 'fffffff6'
+    assert ls_remote.calls == 2
+
+
+def test_missing_branch_is_fetched_again(tmp_path, ls_remote, now):
+    refs = git.RemoteRefCache(path=str(tmp_path / 'refs.json'), ttl=30)
+    refs.get_heads(REPOSITORY)
+    ls_remote.output = LS_REMOTE + '\nfffffff6\trefs/heads/pushed-just-now'
+    assert refs.resolve(REPOSITORY, 'pushed-just-now') == 'fffffff6'
+    assert ls_remote.calls == 2
+
+
+def test_refresh_ignores_cache(tmp_path, ls_remote, now):
+    refs = git.RemoteRefCache(path=str(tmp_path / 'refs.json'), ttl=30)
+    refs.get_heads(REPOSITORY)
+    refs.get_heads(REPOSITORY, refresh=True)
+    assert ls_remote.calls == 2
+
+
+def test_failed_ls_remote_keeps_cache(tmp_path, ls_remote, now):
+    path = tmp_path / 'refs.json'
+    refs = git.RemoteRefCache(path=str(path), ttl=30)
+    refs.get_heads(REPOSITORY)
+    content = path.read_text()
+
+    ls_remote.output = None
+    with pytest.raises(runner.CommandError):
+        refs.resolve(REPOSITORY, 'unknown')
+    assert path.read_text() == content
+    assert refs.resolve(REPOSITORY, 'master') == 'aaaaaaa1'
+
+
+def test_unreadable_cache_is_fetched_again(tmp_path, ls_remote):
+    path = tmp_path / 'refs.json'
+    path.write_text('{not json')
+    refs = git.RemoteRefCache(path=str(path))
+    assert refs.resolve(REPOSITORY, 'master') == 'aaaaaaa1'
+    assert ls_remote.calls == 1
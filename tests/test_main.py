@@ -0,0 +1,16 @@
+from ueli import main
+
+
+EXISTING = ['legacy', 'production', 'stage1', 'stage2']
+MANAGED = ['production', 'stage1', 'stage2']
+
+
+def test_patterns_match_managed_environments_only():
+    assert main.match_environments('*', EXISTING, MANAGED) == ['stage1', 'stage2']
+    assert main.match_environments('stage?', EXISTING, MANAGED) == ['stage1', 'stage2']
+
+
+def test_named_environments_match_if_they_exist():
+    assert main.match_environments('production', EXISTING, MANAGED) == ['production']
+    assert main.match_environments('legacy', EXISTING, MANAGED) == ['legacy']
+    assert main.match_environments('stage3', EXISTING, MANAGED) == []
@@ -0,0 +1,84 @@
+import os
+
+import pytest
+
+from ueli import manifests
+
+
+DEPLOYMENT = '''
+kind: Deployment
+metadata:
+  name: web
+spec:
+  template:
+    spec:
+      containers:
+      - name: app
+        env:
+        - name: KEY_{number}
+          valueFrom:
+            configMapKeyRef:
+              name: web-config
+              key: KEY_{number}
+'''
+
+
+@pytest.fixture
+def parsed(monkeypatch):
+    parsed = []
+    parse_facts = manifests.parse_facts
+
+    def parse(content):
+        parsed.append(content)
+        return parse_facts(content)
+
+    monkeypatch.setattr(manifests, 'parse_facts', parse)
+    return parsed
+
+
+def write_manifests(tmp_path, count, prefix='deployment'):
+    paths = []
+    for number in range(count):
+        path = tmp_path / '{}-{}.yaml'.format(prefix, number)
+        path.write_text(DEPLOYMENT.format(number=number))
+        paths.append(str(path))
+    return paths
+
+
+def load(cache_path, paths, max_entries=manifests.CACHE_MAX_ENTRIES):
+    cache = manifests.ManifestCache(path=cache_path, max_entries=max_entries)
+    facts = cache.get_many(paths, jobs=1)
+    cache.save()
+    return facts
+
+
+def test_cache_is_not_written_if_everything_is_a_hit(tmp_path, parsed):
+    cache_path = str(tmp_path / 'manifests.json')
+    paths = write_manifests(tmp_path, 3)
+    load(cache_path, paths)
+    os.utime(cache_path, (0, 0))
+
+    facts = load(cache_path, paths)
+    assert facts[paths[2]]['documents'][0]['config_key_refs'] == [['web-config', 'KEY_2', 'app']]
+    assert len(parsed) == 3
+    assert os.stat(cache_path).st_mtime == 0
+
+
+def test_cache_keeps_working_set_larger_than_max_entries(tmp_path, parsed):
+    cache_path = str(tmp_path / 'manifests.json')
+    paths = write_manifests(tmp_path, 5)
+    load(cache_path, paths, max_entries=3)
+    load(cache_path, paths, max_entries=3)
+    assert len(parsed) == 5
+
+
+def test_cache_evicts_entries_of_other_projects(tmp_path, parsed):
+    cache_path = str(tmp_path / 'manifests.json')
+    other = write_manifests(tmp_path, 3, prefix='other')
+    load(cache_path, other, max_entries=4)
+    paths = write_manifests(tmp_path, 3)
+    load(cache_path, paths, max_entries=4)
+
+    cache = manifests.ManifestCache(path=cache_path, max_entries=4)
+    assert len(cache.entries) == 4
+    assert all(os.path.abspath(path) in cache.entries for path in paths)
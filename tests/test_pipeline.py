@@ -0,0 +1,85 @@
+import pytest
+import yaml
+
+from ueli import configuration, pipeline
+
+
+def get_config(images):
+    return configuration.parse(yaml.safe_dump({
+        'service': 'web',
+        'gcloud': {'project': 'project', 'registry': 'eu.gcr.io'},
+        'images': images,
+    }))
+
+
+def test_plan_orders_dependencies_first():
+    config = get_config([
+        {'name': 'web', 'depends_on': ['base', 'assets']},
+        {'name': 'assets', 'depends_on': ['base']},
+        {'name': 'base'},
+    ])
+    tasks = pipeline.plan(config, branch='master', commit='abcdef1')
+    assert [task.name for task in tasks] == ['base', 'assets', 'web']
+    assert tasks[2].depends_on == ['base', 'assets']
+    assert tasks[2].build_tag == 'web:master.abcdef1'
+    assert tasks[2].remote_tag == 'eu.gcr.io/project/web:master.abcdef1'
+
+
+def test_plan_keeps_declared_order_of_independent_images():
+    config = get_config([{'name': 'worker'}, {'name': 'web'}])
+    tasks = pipeline.plan(config, branch='master', commit='abcdef1')
+    assert [task.name for task in tasks] == ['worker', 'web']
+
+
+def test_plan_rejects_cycles():
+    config = get_config([
+        {'name': 'web', 'depends_on': ['assets']},
+        {'name': 'assets', 'depends_on': ['base']},
+        {'name': 'base', 'depends_on': ['web']},
+    ])
+    with pytest.raises(ValueError) as e:
+        pipeline.plan(config, branch='master', commit='abcdef1')
+    assert str(e.value) == 'Cyclic image dependencies: web -> assets -> base -> web'
+
+
+def test_plan_rejects_unknown_dependencies():
+    config = get_config([{'name': 'web', 'depends_on': ['base']}])
+    with pytest.raises(ValueError) as e:
+        pipeline.plan(config, branch='master', commit='abcdef1')
+    assert "unknown image 'base'" in str(e.value)
+
+
+def build(tmp_path, monkeypatch, base_content):
+    for name, content in [('base', base_content), ('web', 'FROM ${BASE_IMAGE}\n')]:
+        (tmp_path / name).mkdir(exist_ok=True)
+        (tmp_path / name / 'Dockerfile').write_text(content)
+    config = get_config([
+        {'name': 'base', 'source': str(tmp_path / 'base')},
+        {'name': 'web', 'source': str(tmp_path / 'web'), 'depends_on': ['base']},
+    ])
+    tasks = pipeline.plan(config, branch='master', commit='abcdef1')
+    found = []
+
+    def find_reusable_image(build_tag, context_digest, remote_tag, clean):
+        found.append(context_digest)
+        return None, None, None
+
+    monkeypatch.setattr(pipeline.images, 'find_reusable_image', find_reusable_image)
+    monkeypatch.setattr(pipeline.utils, 'run_captured', lambda cmd: (0, ''))
+    tasks_by_name = dict((task.name, task) for task in tasks)
+    for task in tasks:
+        pipeline.build_task(task, tasks_by_name, branch='master', clean=True, cache_from=False)
+    return tasks_by_name, found
+
+
+def test_build_digest_changes_with_images_built_on(tmp_path, monkeypatch):
+    tasks, found = build(tmp_path, monkeypatch, 'FROM debian:12\n')
+    web_digest = tasks['web'].digest
+    assert found == [tasks['base'].digest, web_digest]
+    assert web_digest != pipeline.images.get_context_digest(tasks['web'].source)
+
+    tasks, found = build(tmp_path, monkeypatch, 'FROM debian:13\n')
+    assert tasks['web'].digest != web_digest
+
+    tasks, found = build(tmp_path, monkeypatch, 'FROM debian:12\n')
+    assert tasks['web'].digest == web_digest
@@ -0,0 +1,174 @@
+import json
+
+import pytest
+
+from ueli import rollout, runner
+
+
+REPOSITORY = 'eu.gcr.io/project/web'
+
+
+def get_deployment(name, image, generation=1):
+    return {
+        'apiVersion': 'apps/v1', 'kind': 'Deployment',
+        'metadata': {'name': name, 'namespace': 'stage1', 'generation': generation},
+        'spec': {'replicas': 1, 'template': {'spec': {'containers': [
+            {'name': 'app', 'image': image},
+            {'name': 'proxy', 'image': 'nginx:1.25'},
+        ]}}},
+        'status': {'observedGeneration': generation, 'replicas': 1, 'updatedReplicas': 1,
+                   'availableReplicas': 1},
+    }
+
+
+def get_failed_deployment(name, generation):
+    deployment = get_deployment(name, REPOSITORY + ':new', generation=generation)
+    deployment['status']['conditions'] = [{'type': 'Progressing',
+                                           'reason': 'ProgressDeadlineExceeded',
+                                           'message': 'Pods crash'}]
+    return deployment
+
+
+class FakeKubectl(object):
+    """
+    Stands in for `runner.run`: applies bump the generation, watches print
+    the deployments in `watched`.
+    """
+
+    def __init__(self, watched, watch_error=None):
+        self.watched = watched
+        self.watch_error = watch_error
+        self.applied = []
+        self.watches = 0
+
+    def run(self, cmd, stdin=None, on_line=None, **kwargs):
+        stdout = stderr = ''
+        returncode = 0
+        if cmd[1] == 'apply':
+            manifest = json.loads(stdin)
+            self.applied.append(manifest)
+            for item in manifest['items']:
+                item['metadata']['generation'] = 2
+            stdout = json.dumps(manifest)
+        elif '--watch' in cmd:
+            self.watches += 1
+            if self.watch_error:
+                returncode, stderr = 1, self.watch_error
+            for deployment in self.watched:
+                for line in json.dumps(deployment, indent=4).splitlines(True):
+                    stdout += line
+                    on_line(line)
+        return runner.Result(argv=cmd, returncode=returncode, stdout=stdout, stderr=stderr,
+                             output=stdout + stderr, seconds=0, attempts=1)
+
+
+def get_images(manifest):
+    return dict((item['metadata']['name'], item['spec']['template']['spec']['containers'])
+                for item in manifest['items'])
+
+
+@pytest.fixture
+def deployments():
+    return {
+        'web': get_deployment('web', REPOSITORY + ':old'),
+        'web-worker': get_deployment('web-worker', REPOSITORY + ':old'),
+    }
+
+
+def test_deploy_rolls_back_all_deployments_if_one_fails(monkeypatch, deployments):
+    kubectl = FakeKubectl(watched=[
+        get_deployment('web', REPOSITORY + ':new', generation=2),
+        get_failed_deployment('web-worker', generation=2),
+    ])
+    monkeypatch.setattr(runner, 'run', kubectl.run)
+
+    rollouts = rollout.deploy(deployments, names=['web', 'web-worker'], namespace='stage1',
+                              repository=REPOSITORY, image=REPOSITORY + ':new', timeout=5)
+
+    assert [r.status for r in rollouts] == ['rolled back', 'rolled back']
+    assert rollouts[0].message == 'Rolled back because other deployments failed'
+    assert rollouts[1].message == 'Pods crash'
+    assert len(kubectl.applied) == 2
+    # Only the containers running the service's image are touched
+    assert get_images(kubectl.applied[0])['web'] == [{'name': 'app', 'image': REPOSITORY + ':new'}]
+    assert get_images(kubectl.applied[1]) == {
+        'web': [{'name': 'app', 'image': REPOSITORY + ':old'}],
+        'web-worker': [{'name': 'app', 'image': REPOSITORY + ':old'}],
+    }
+
+
+def test_deploy_rolls_back_after_timeout(monkeypatch, deployments):
+    # The watch ends without the rollout getting ready
+    kubectl = FakeKubectl(watched=[get_deployment('web', REPOSITORY + ':old')])
+    monkeypatch.setattr(runner, 'run', kubectl.run)
+
+    rollouts = rollout.deploy(deployments, names=['web'], namespace='stage1',
+                              repository=REPOSITORY, image=REPOSITORY + ':new', timeout=0.2)
+
+    assert rollouts[0].status == 'rolled back'
+    assert rollouts[0].message.startswith('Timed out')
+    assert get_images(kubectl.applied[-1]) == {
+        'web': [{'name': 'app', 'image': REPOSITORY + ':old'}]}
+
+
+def test_deploy_rolls_back_if_watch_fails(monkeypatch, deployments):
+    kubectl = FakeKubectl(watched=[], watch_error='Error from server (Forbidden): forbidden')
+    monkeypatch.setattr(runner, 'run', kubectl.run)
+
+    with pytest.raises(runner.CommandError):
+        rollout.deploy(deployments, names=['web'], namespace='stage1', repository=REPOSITORY,
+                       image=REPOSITORY + ':new', timeout=5)
+
+    assert kubectl.watches == 1
+    assert get_images(kubectl.applied[-1]) == {
+        'web': [{'name': 'app', 'image': REPOSITORY + ':old'}]}
+
+
+def test_deploy_watches_again_with_backoff(monkeypatch, deployments):
+    # Watches closed without events
+    kubectl = FakeKubectl(watched=[])
+    monkeypatch.setattr(runner, 'run', kubectl.run)
+
+    rollout.deploy(deployments, names=['web'], namespace='stage1', repository=REPOSITORY,
+                   image=REPOSITORY + ':new', timeout=1)
+
+    # Right away and after 0.5s, not back to back
+    assert kubectl.watches <= 3
+
+
+def test_deploy_rolls_back_if_deployments_are_missing(monkeypatch, deployments):
+    kubectl = FakeKubectl(watched=[get_deployment('web', REPOSITORY + ':new', generation=2)])
+    monkeypatch.setattr(runner, 'run', kubectl.run)
+
+    rollouts = rollout.deploy(deployments, names=['web', 'web-api'], namespace='stage1',
+                              repository=REPOSITORY, image=REPOSITORY + ':new', timeout=5)
+
+    assert [r.status for r in rollouts] == ['rolled back', 'missing']
+    assert get_images(kubectl.applied[-1]) == {
+        'web': [{'name': 'app', 'image': REPOSITORY + ':old'}]}
+
+
+def test_deploy_without_rollback_keeps_failed_rollouts(monkeypatch, deployments):
+    kubectl = FakeKubectl(watched=[
+        get_deployment('web', REPOSITORY + ':new', generation=2),
+        get_failed_deployment('web-worker', generation=2),
+    ])
+    monkeypatch.setattr(runner, 'run', kubectl.run)
+
+    rollouts = rollout.deploy(deployments, names=['web', 'web-worker'], namespace='stage1',
+                              repository=REPOSITORY, image=REPOSITORY + ':new', timeout=5,
+                              rollback=False)
+
+    assert [r.status for r in rollouts] == ['ready', 'failed']
+    assert len(kubectl.applied) == 1
+
+
+def test_deploy_of_running_image_does_nothing(monkeypatch, deployments):
+    kubectl = FakeKubectl(watched=[])
+    monkeypatch.setattr(runner, 'run', kubectl.run)
+
+    rollouts = rollout.deploy(deployments, names=['web'], namespace='stage1',
+                              repository=REPOSITORY, image=REPOSITORY + ':old')
+
+    assert rollouts[0].status == 'ready'
+    assert kubectl.applied == []
@@ -0,0 +1,102 @@
+import stat
+
+import pytest
+
+from ueli import runner
+
+
+def make_command(tmp_path, name, attempts):
+    """
+    Writes an executable `name` which prints the stdout, stderr and exits
+    with the code given for its first, second, ... call.
+    """
+    script = ['#!/bin/sh',
+              'count=$(cat {counter} 2>/dev/null || echo 0)'.format(counter=tmp_path / 'count'),
+              'count=$((count + 1))',
+              'echo $count > {counter}'.format(counter=tmp_path / 'count')]
+    for i, (stdout, stderr, code) in enumerate(attempts, 1):
+        script.append('if [ $count = {} ]; then'.format(i))
+        if stdout:
+            script.append("  echo '{}'".format(stdout))
+        if stderr:
+            script.append("  echo '{}' >&2".format(stderr))
+        script.append('  exit {}'.format(code))
+        script.append('fi')
+    path = tmp_path / name
+    path.write_text('\n'.join(script) + '\n')
+    path.chmod(path.stat().st_mode | stat.S_IEXEC)
+    return str(path)
+
+
+def get_calls(tmp_path):
+    return int((tmp_path / 'count').read_text())
+
+
+ALREADY_EXISTS = 'Error from server (AlreadyExists): namespaces "stage1" already exists'
+
+
+def test_create_existing_after_uncertain_error_succeeds(tmp_path):
+    kubectl = make_command(tmp_path, 'kubectl', [
+        ('', 'error: unexpected EOF', 1),
+        ('', ALREADY_EXISTS, 1),
+    ])
+    result = runner.run([kubectl, 'create', 'namespace', 'stage1'], backoff=0)
+    assert result.ok
+    assert result.attempts == 2
+
+
+def test_create_existing_after_rejected_request_fails(tmp_path):
+    # The first attempt didn't reach the server, someone else created it
+    kubectl = make_command(tmp_path, 'kubectl', [
+        ('', 'dial tcp 10.0.0.1:443: connect: connection refused', 1),
+        ('', ALREADY_EXISTS, 1),
+    ])
+    with pytest.raises(runner.CommandError):
+        runner.run([kubectl, 'create', 'namespace', 'stage1'], backoff=0)
+    assert get_calls(tmp_path) == 2
+
+
+def test_create_existing_without_retry_fails(tmp_path):
+    kubectl = make_command(tmp_path, 'kubectl', [('', ALREADY_EXISTS, 1)])
+    result = runner.run([kubectl, 'create', 'namespace', 'stage1'], backoff=0, check=False)
+    assert result.returncode == 1
+
+
+def test_transient_errors_are_retried(tmp_path):
+    kubectl = make_command(tmp_path, 'kubectl', [
+        ('', 'error: i/o timeout', 1),
+        ('ok', '', 0),
+    ])
+    result = runner.run([kubectl, 'get', 'namespaces'], backoff=0)
+    assert result.stdout == 'ok\n'
+    assert result.attempts == 2
+
+
+def test_emitted_lines_are_not_repeated(tmp_path):
+    kubectl = make_command(tmp_path, 'kubectl', [
+        ('first', 'error: unexpected EOF', 1),
+        ('second', '', 0),
+    ])
+    lines = []
+    result = runner.run([kubectl, 'get', 'namespaces', '--watch'], on_line=lines.append,
+                        backoff=0, check=False)
+    assert lines == ['first\n']
+    assert result.attempts == 1
+
+
+def test_numbers_in_build_output_are_not_retried(tmp_path):
+    make = make_command(tmp_path, 'make', [('', 'expected 200, got 503', 1)])
+    result = runner.run([make, 'test'], backoff=0, check=False)
+    assert result.attempts == 1
+
+
+def test_docker_builds_are_not_retried(tmp_path):
+    docker = make_command(tmp_path, 'docker', [('', 'connection reset by peer', 1)])
+    result = runner.run([docker, 'build', '.'], backoff=0, check=False)
+    assert result.attempts == 1
+
+
+def test_pushes_through_gcloud_have_no_timeout():
+    assert runner.get_default_timeout(['gcloud', 'docker', '--', 'push', 'image']) is None
+    assert runner.get_default_timeout(['/usr/bin/gcloud', 'container', 'clusters']) == \
+        runner.DEFAULT_TIMEOUTS['gcloud']
@@ -0,0 +1,68 @@
+import yaml
+
+from ueli import configuration, manifests, usage
+
+
+DEPLOYMENT = '''
+kind: Deployment
+metadata:
+  name: web
+spec:
+  template:
+    spec:
+      volumes:
+      - name: tls
+        secret:
+          secretName: web-tls
+      containers:
+      - name: app
+        env:
+        - name: KEY_{number}
+          valueFrom:
+            configMapKeyRef:
+              name: web-config
+              key: KEY_{number}
+        - name: SHARED
+          valueFrom:
+            secretKeyRef:
+              name: web-secret
+              key: SHARED
+'''
+
+
+def analyze(tmp_path, count, max_entries):
+    directory = tmp_path / 'k8s'
+    directory.mkdir(exist_ok=True)
+    for number in range(count):
+        (directory / '{}.yaml'.format(number)).write_text(DEPLOYMENT.format(number=number))
+    config = configuration.parse(yaml.safe_dump({
+        'service': 'web',
+        'deployments': [{'name': 'web', 'apply': [str(directory)]},
+                        {'name': 'web-worker', 'apply': [str(directory / '0.yaml')]}],
+    }))
+    cache = manifests.ManifestCache(path=str(tmp_path / 'manifests.json'),
+                                    max_entries=max_entries)
+    return manifests.analyze(config, cache=cache, jobs=1)
+
+
+def test_index_covers_projects_larger_than_the_cache(tmp_path):
+    # Analyzed twice, the second time from the cache
+    analyze(tmp_path, 20, max_entries=8)
+    index = usage.UsageIndex(analyze(tmp_path, 20, max_entries=8))
+
+    assert index.used_keys('configmap', 'web-config') == \
+        set('KEY_{}'.format(number) for number in range(20))
+    assert [u.deployments for u in index.where_used('KEY_0')] == [['web', 'web-worker']]
+    assert [u.deployments for u in index.where_used('KEY_19')] == [['web']]
+    assert len(index.where_used('SHARED')) == 20
+
+
+def test_index_tells_whole_references(tmp_path):
+    index = usage.UsageIndex(analyze(tmp_path, 2, max_entries=8))
+
+    whole = index.where_used_whole('secret', 'web-tls')
+    assert [(u.kind, u.name, u.key, u.container) for u in whole] == \
+        [('secret', 'web-tls', None, None)] * 2
+    assert index.where_used_whole('configmap', 'web-tls') == []
+    assert index.used_keys('secret', 'web-secret') == {'SHARED'}
+    assert index.where_used('UNKNOWN') == []
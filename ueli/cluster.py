@@ -0,0 +1,323 @@
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from ueli import runner, utils
+
+
+# Manifests are applied in tiers by kind. Everything in a tier can be applied
+# concurrently, but a tier only starts once the previous one succeeded.
+# Unknown kinds (ingresses, autoscalers, ...) usually reference services or
+# deployments and go into the last tier.
+APPLY_TIERS = (
+    ('namespace', 'configmap', 'secret', 'serviceaccount', 'persistentvolumeclaim',
+     'role', 'rolebinding'),
+    ('service',),
+    ('deployment', 'statefulset', 'daemonset', 'job', 'cronjob'),
+)
+
+# Key of the state configmap holding the content hash of every manifest
+# applied to its namespace
+STATE_KEY = 'manifests.json'
+STATE_FIELD_MANAGER = 'ueli-apply'
+
+# Resource kinds fetched by default. Commands only need to know whether
+# these exist, so we get them all in one `kubectl get` call per namespace.
+DEFAULT_KINDS = ('namespace', 'configmap', 'deployment')
+
+# Namespaces fetched concurrently by `Inventory.load`
+MAX_FETCH_JOBS = 8
+
+# Kinds which don't belong to a namespace
+CLUSTER_KINDS = ('namespace',)
+
+
+class Inventory(object):
+    """
+    In-memory index of cluster resources keyed by (kind, namespace, name).
+
+    Resources are fetched lazily and every existence check is then served
+    from memory. Cluster scoped resources (e.g. namespaces) are fetched with
+    one batched kubectl call and indexed with namespace `None`, namespaced
+    ones with one call per namespace the first time it's looked at. Use
+    `load` to fetch several namespaces concurrently upfront, and `add` to
+    index resources created since.
+
+    With an API `client` (see `kubeapi`) the kinds are listed concurrently
+    over its pooled connections instead.
+    """
+
+    def __init__(self, kinds=DEFAULT_KINDS, client=None):
+        self.kinds = tuple(kinds)
+        self.client = client
+        self._index = {}
+        # Namespaces fetched so far, `None` for cluster scoped kinds
+        self._loaded = set()
+        self._lock = threading.Lock()
+        self._scope_locks = {}
+
+    def get_kinds(self, namespace=None):
+        return tuple(kind for kind in self.kinds
+                     if (kind in CLUSTER_KINDS) == (namespace is None))
+
+    def fetch(self, namespace=None):
+        """
+        Returns the resources of the inventory's kinds in `namespace`, or
+        the cluster scoped ones for `None`.
+        """
+        kinds = self.get_kinds(namespace)
+        if not kinds:
+            return []
+        if self.client is not None and all(self.client.supports(kind) for kind in kinds):
+            with ThreadPoolExecutor(max_workers=len(kinds)) as executor:
+                lists = list(executor.map(
+                    lambda kind: list(self.client.list(kind, namespace=namespace)), kinds))
+            return [item for items in lists for item in items]
+        cmd = ['kubectl', 'get', ','.join(kinds), '-o', 'json']
+        if namespace is not None:
+            cmd.append('--namespace={}'.format(namespace))
+        return json.loads(utils.run_local(cmd)).get('items') or []
+
+    def _load_scope(self, namespace):
+        with self._lock:
+            lock = self._scope_locks.setdefault(namespace, threading.Lock())
+        # Lookups of the same namespace from several threads wait for one
+        # fetch instead of fetching it each
+        with lock:
+            if namespace in self._loaded:
+                return
+            index = index_items(self.fetch(namespace))
+            with self._lock:
+                for key, item in index.items():
+                    self._index.setdefault(key, item)
+                self._loaded.add(namespace)
+
+    def load(self, namespaces=()):
+        """
+        Fetches the cluster scoped resources and the ones of `namespaces`
+        not fetched yet, concurrently.
+        """
+        scopes = [None] + [namespace for namespace in namespaces if namespace is not None]
+        scopes = [scope for scope in scopes if scope not in self._loaded]
+        if len(scopes) == 1:
+            self._load_scope(scopes[0])
+        elif scopes:
+            with ThreadPoolExecutor(max_workers=min(len(scopes), MAX_FETCH_JOBS)) as executor:
+                list(executor.map(self._load_scope, scopes))
+
+    def invalidate(self):
+        with self._lock:
+            self._index = {}
+            self._loaded = set()
+
+    def add(self, item):
+        """
+        Indexes a resource created after the inventory was fetched.
+        """
+        with self._lock:
+            self._index.update(index_items([item]))
+
+    def require(self, kind):
+        # Unknown kinds are added to the batch, which requires a refetch
+        kind = kind.lower()
+        if kind not in self.kinds:
+            self.kinds = self.kinds + (kind,)
+            self.invalidate()
+        return kind
+
+    def get(self, kind, name, namespace=None):
+        kind = self.require(kind)
+        self._load_scope(namespace)
+        return self._index.get((kind, namespace, name))
+
+    def exists(self, kind, name, namespace=None):
+        return self.get(kind=kind, name=name, namespace=namespace) is not None
+
+    def names(self, kind, namespace=None):
+        kind = self.require(kind)
+        self._load_scope(namespace)
+        with self._lock:
+            keys = list(self._index.keys())
+        return sorted(n for (k, ns, n) in keys if k == kind and ns == namespace)
+
+
+def index_items(items):
+    """
+    Indexes a list of kubernetes objects by (kind, namespace, name).
+    """
+    index = {}
+    for item in items:
+        metadata = item.get('metadata', {})
+        key = (item['kind'].lower(), metadata.get('namespace'), metadata['name'])
+        index[key] = item
+    return index
+
+
+class ApplyResult(object):
+    """
+    Outcome of one `kubectl apply` call for one or more manifest files.
+    """
+
+    def __init__(self, files, cmd, returncode=None, output=''):
+        self.files = files
+        self.cmd = cmd
+        self.returncode = returncode
+        self.output = output
+
+    def format_cmd(self):
+        return runner.format_cmd(self.cmd)
+
+    @property
+    def executed(self):
+        return self.returncode is not None
+
+    @property
+    def ok(self):
+        return self.returncode in (None, 0)
+
+
+def get_apply_tier(kind):
+    kind = (kind or '').lower()
+    for i, kinds in enumerate(APPLY_TIERS):
+        if kind in kinds:
+            return i
+    return len(APPLY_TIERS)
+
+
+def group_manifests(manifests):
+    """
+    Groups (path, kinds) tuples into tiers which have to be applied one after
+    another. Files with several documents go into the tier of their first
+    kind to be applied. The order of manifests within a tier is kept.
+    """
+    tiers = {}
+    for path, kinds in manifests:
+        tier = min([get_apply_tier(kind) for kind in kinds] or [len(APPLY_TIERS)])
+        tiers.setdefault(tier, []).append(path)
+    return [tiers[tier] for tier in sorted(tiers.keys())]
+
+
+def get_apply_cmd(files, namespace):
+    cmd = ['kubectl', 'apply']
+    for f in files:
+        cmd += ['-f', f]
+    return cmd + ['--namespace={}'.format(namespace)]
+
+
+def _run_apply(result):
+    # Output is collected instead of written to the terminal, results of
+    # concurrent calls would be mixed up otherwise
+    result.returncode, result.output = utils.run_captured(result.cmd)
+    return result
+
+
+def apply_manifests(manifests, namespace, jobs=1, batch=False, execute=True,
+                    echo=None):
+    """
+    Applies manifests given as (path, kinds) tuples to a namespace.
+
+    Tiers of manifests (see `APPLY_TIERS`) are applied one after another,
+    manifests within a tier run concurrently on up to `jobs` kubectl
+    processes. With `batch` each tier is sent as one multi `-f` kubectl call.
+    Stops after the first tier with failures. `echo` is called with every
+    result once it's done. Returns all results, including the ones not
+    executed.
+    """
+    results = []
+    failed = False
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        for files in group_manifests(manifests):
+            groups = [files] if batch else [[f] for f in files]
+            tier = [ApplyResult(files=group, cmd=get_apply_cmd(group, namespace))
+                    for group in groups]
+            results.extend(tier)
+            if failed or not execute:
+                continue
+
+            for result in executor.map(_run_apply, tier):
+                if echo:
+                    echo(result)
+            failed = any(not result.ok for result in tier)
+    return results
+
+
+def get_applied_hashes(state):
+    """
+    Returns path -> content hash of the manifests last applied to a
+    namespace, read from its state configmap (as returned by kubectl), or
+    an empty dict.
+    """
+    content = ((state or {}).get('data') or {}).get(STATE_KEY)
+    if not content:
+        return {}
+    try:
+        hashes = json.loads(content)
+    except ValueError:
+        return {}
+    return hashes if isinstance(hashes, dict) else {}
+
+
+class ApplyPlan(object):
+    """
+    Manifests to apply to a namespace. Files with the same content hash as
+    last time they were applied are skipped, unless the plan is `full`.
+    """
+
+    def __init__(self, manifests, hashes, applied, full=False):
+        self.hashes = hashes
+        self.applied = applied
+        self.to_apply = []
+        # Why files are applied, `new` or `changed`. Unchanged files are
+        # only applied for `full` plans.
+        self.changes = {}
+        self.unchanged = []
+        for path, kinds in manifests:
+            previous = applied.get(path)
+            if not previous:
+                self.changes[path] = 'new'
+            elif previous != hashes.get(path):
+                self.changes[path] = 'changed'
+            elif not full:
+                self.unchanged.append(path)
+                continue
+            self.to_apply.append((path, kinds))
+
+    def get_state(self, results):
+        """
+        Returns the hashes to store after applying: the ones of successfully
+        applied files, and the previous ones of files not applied this time.
+        Files no longer part of any deployment are dropped.
+        """
+        hashes = dict((path, self.applied[path]) for path in self.hashes
+                      if path in self.applied)
+        for result in results:
+            if result.executed and result.ok:
+                hashes.update((path, self.hashes[path]) for path in result.files
+                              if path in self.hashes)
+        return hashes
+
+
+def save_applied_hashes(name, namespace, hashes, client=None):
+    """
+    Stores the hashes of applied manifests in the state configmap `name`
+    with one server side apply, which creates it if needed. Returns exit
+    code and output like `utils.run_captured`.
+    """
+    state = {
+        'apiVersion': 'v1',
+        'kind': 'ConfigMap',
+        'metadata': {'name': name, 'namespace': namespace},
+        'data': {STATE_KEY: json.dumps(hashes, sort_keys=True, separators=(',', ':'))},
+    }
+    if client is not None:
+        from ueli import kubeapi
+
+        try:
+            client.apply(state, field_manager=STATE_FIELD_MANAGER, force=True)
+        except kubeapi.ApiError as e:
+            return 1, str(e)
+        return 0, ''
+    cmd = ['kubectl', 'apply', '--server-side', '--force-conflicts',
+           '--field-manager={}'.format(STATE_FIELD_MANAGER), '--namespace={}'.format(namespace),
+           '-f', '-']
+    return utils.run_captured(cmd, stdin=json.dumps(state))
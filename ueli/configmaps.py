@@ -0,0 +1,160 @@
+import json
+
+import yaml
+
+from ueli import utils
+
+
+# Files with these extensions are read as YAML mapping by `load_values`,
+# everything else as env file
+YAML_EXTENSIONS = ('.yaml', '.yml', '.json')
+
+
+def parse_assignment(value):
+    """
+    Parses `KEY=VALUE` and returns (key, value). The value may be empty and
+    contain `=`.
+    """
+    key, sep, value = value.partition('=')
+    key = key.strip()
+    if not sep or not key:
+        raise ValueError("Invalid assignment '{}', use KEY=VALUE".format(key + sep + value))
+    return key, value
+
+
+def parse_env_file(content):
+    """
+    Parses an env file like `kubectl create configmap --from-env-file`: one
+    `KEY=VALUE` per line, empty lines and lines starting with `#` are
+    ignored.
+    """
+    values = {}
+    for number, line in enumerate(content.splitlines(), 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        try:
+            key, value = parse_assignment(line)
+        except ValueError as e:
+            raise ValueError('Line {}: {}'.format(number, e))
+        values[key] = value
+    return values
+
+
+def to_value(key, value):
+    # Configmap values are strings, YAML gives us booleans and numbers
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if value is None:
+        return ''
+    if isinstance(value, (dict, list)):
+        raise ValueError("Value of '{}' has to be a string, not a {}".format(
+            key, type(value).__name__))
+    return str(value)
+
+
+def load_values(path):
+    """
+    Returns the keys and values of an env file or, for `YAML_EXTENSIONS`, a
+    YAML mapping. Raises ValueError for files in neither format.
+    """
+    with open(path, 'r') as f:
+        content = f.read()
+    if not path.endswith(YAML_EXTENSIONS):
+        return parse_env_file(content)
+    try:
+        data = yaml.load(content, Loader=utils.get_yaml_loader())
+    except yaml.YAMLError as e:
+        raise ValueError("Can't parse YAML: {}".format(e))
+    if data is None:
+        return {}
+    if not isinstance(data, dict):
+        raise ValueError('Has to be a mapping of keys to values')
+    return dict((str(key), to_value(key, value)) for key, value in data.items())
+
+
+class ConfigChange(object):
+    """
+    Change of the configmap `name` in one namespace. `current` is the
+    configmap as returned by kubectl (None if it doesn't exist), `values`
+    are set and `unset` keys removed.
+    """
+
+    def __init__(self, name, namespace, current, values=None, unset=()):
+        self.name = name
+        self.namespace = namespace
+        self.current = current
+        self.before = dict((current or {}).get('data') or {})
+        self.data = dict(self.before)
+        self.data.update(values or {})
+        for key in unset:
+            self.data.pop(key, None)
+
+    @property
+    def added(self):
+        return sorted(key for key in self.data if key not in self.before)
+
+    @property
+    def changed(self):
+        return sorted(key for key in self.data
+                      if key in self.before and self.data[key] != self.before[key])
+
+    @property
+    def removed(self):
+        return sorted(key for key in self.before if key not in self.data)
+
+    @property
+    def dirty(self):
+        return self.current is None or self.data != self.before
+
+    def missing(self, analysis):
+        """
+        Returns the keys the manifests reference which the configmap doesn't
+        have after the change.
+        """
+        return sorted(analysis.required_config_keys - set(self.data))
+
+    def unused(self, analysis):
+        """
+        Returns the keys no manifest references. If the configmap is used as
+        a whole (volume, `envFrom`) every key counts as used.
+        """
+        if analysis.config_used_whole:
+            return []
+        return sorted(set(self.data) - analysis.required_config_keys)
+
+    def to_manifest(self):
+        """
+        Returns the complete configmap to write. Its `resourceVersion` makes
+        the write fail if the configmap changed since it was read.
+        """
+        metadata = dict((self.current or {}).get('metadata') or {})
+        for key in ('managedFields', 'creationTimestamp', 'uid'):
+            metadata.pop(key, None)
+        metadata.update(name=self.name, namespace=self.namespace)
+        manifest = dict(self.current or {})
+        manifest.update(apiVersion='v1', kind='ConfigMap', metadata=metadata, data=self.data)
+        return manifest
+
+    def get_cmd(self):
+        verb = 'create' if self.current is None else 'replace'
+        return ['kubectl', verb, '--namespace={}'.format(self.namespace), '-f', '-']
+
+    def write(self, client=None):
+        """
+        Writes the configmap with one create or replace call. Returns exit
+        code and output like `utils.run_captured`.
+        """
+        manifest = self.to_manifest()
+        if client is not None:
+            from ueli import kubeapi
+
+            try:
+                if self.current is None:
+                    client.create(manifest)
+                else:
+                    client.replace(manifest)
+            except kubeapi.ApiError as e:
+                return 1, str(e)
+            return 0, ''
+        return utils.run_captured(self.get_cmd(), stdin=json.dumps(manifest))
@@ -0,0 +1,305 @@
+import hashlib
+import os
+import os.path
+import time
+
+from ueli import timings, utils
+
+
+CACHE_FILE_NAME = 'config.json'
+CACHE_VERSION = 4
+CACHE_MAX_ENTRIES = 64
+
+# Marks fields without default
+REQUIRED = object()
+
+
+class ConfigError(ValueError):
+    """
+    Raised for config files which can't be parsed or don't match the
+    schema. `errors` lists all problems found.
+    """
+
+    def __init__(self, errors):
+        super(ConfigError, self).__init__('\n'.join(errors))
+        self.errors = errors
+
+
+class ConfigObject(object):
+    """
+    Base of the config classes. `FIELDS` declares (name, type, default) of
+    every key. Types are `str`, `int`, a ConfigObject subclass or a list
+    with one of these as only item for lists of them. A tuple of strings
+    allows these values only.
+    """
+    __slots__ = ()
+    FIELDS = ()
+
+    def __init__(self, **values):
+        for name, type_, default in self.FIELDS:
+            value = values.get(name, default)
+            if isinstance(value, list):
+                value = list(value)
+            setattr(self, name, value)
+
+    def __repr__(self):
+        return '{name}({fields})'.format(
+            name=self.__class__.__name__,
+            fields=', '.join('{}={!r}'.format(name, getattr(self, name))
+                             for name, type_, default in self.FIELDS))
+
+    @classmethod
+    def validate(cls, data, path, errors, warnings):
+        """
+        Returns an instance for the parsed YAML `data` and adds all problems
+        to `errors`, with the path of the key, e.g. `gcloud.registry`.
+        Unknown keys are ignored and added to `warnings`, e.g. keys of newer
+        ueli versions.
+        """
+        if not isinstance(data, dict):
+            errors.append('{}: must be a mapping'.format(path or 'config'))
+            return None
+
+        names = set(name for name, type_, default in cls.FIELDS)
+        for key in sorted(set(data) - names, key=str):
+            warnings.append('{}: unknown key'.format(join_path(path, key)))
+
+        values = {}
+        for name, type_, default in cls.FIELDS:
+            key_path = join_path(path, name)
+            if name not in data or data[name] is None:
+                if default is REQUIRED:
+                    errors.append('{}: is required'.format(key_path))
+                continue
+            values[name] = validate_value(data[name], type_, key_path, errors, warnings)
+        return cls(**values)
+
+    def to_dict(self):
+        return dict((name, to_plain(getattr(self, name)))
+                    for name, type_, default in self.FIELDS)
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Rebuilds an instance from `to_dict` output, without validation.
+        """
+        values = {}
+        for name, type_, default in cls.FIELDS:
+            value = data.get(name)
+            if isinstance(type_, list) and value is not None:
+                value = [from_plain(item, type_[0]) for item in value]
+            elif value is not None:
+                value = from_plain(value, type_)
+            values[name] = value
+        return cls(**values)
+
+
+def join_path(path, key):
+    return '{}.{}'.format(path, key) if path else str(key)
+
+
+def validate_value(value, type_, path, errors, warnings):
+    if isinstance(type_, list):
+        if not isinstance(value, list):
+            errors.append('{}: must be a list'.format(path))
+            return []
+        return [validate_value(item, type_[0], '{}[{}]'.format(path, i), errors, warnings)
+                for i, item in enumerate(value)]
+    if isinstance(type_, tuple):
+        if value not in type_:
+            errors.append('{}: must be one of {}'.format(path, ', '.join(type_)))
+        return value
+    if isinstance(type_, type) and issubclass(type_, ConfigObject):
+        return type_.validate(value, path, errors, warnings)
+    if type_ is int and (not isinstance(value, int) or isinstance(value, bool)):
+        errors.append('{}: must be a number'.format(path))
+    elif type_ is str and not isinstance(value, str):
+        errors.append('{}: must be a string'.format(path))
+    return value
+
+
+def to_plain(value):
+    if isinstance(value, list):
+        return [to_plain(item) for item in value]
+    if isinstance(value, ConfigObject):
+        return value.to_dict()
+    return value
+
+
+def from_plain(value, type_):
+    if isinstance(type_, type) and issubclass(type_, ConfigObject):
+        return type_.from_dict(value)
+    return value
+
+
+class GcloudConfig(ConfigObject):
+    __slots__ = ('project', 'registry', 'cluster', 'credentials_ttl')
+    FIELDS = (
+        ('project', str, None),
+        ('registry', str, None),
+        ('cluster', str, None),
+        ('credentials_ttl', int, None),
+    )
+
+
+class GitConfig(ConfigObject):
+    __slots__ = ('dirty_check', 'remote_refs_ttl')
+    FIELDS = (
+        ('dirty_check', ('status', 'diff-index'), 'status'),
+        ('remote_refs_ttl', int, None),
+    )
+
+
+class KubernetesConfig(ConfigObject):
+    __slots__ = ('backend',)
+    FIELDS = (
+        ('backend', ('kubectl', 'api'), 'kubectl'),
+    )
+
+
+class DeploymentConfig(ConfigObject):
+    __slots__ = ('name', 'apply')
+    FIELDS = (
+        ('name', str, REQUIRED),
+        ('apply', [str], REQUIRED),
+    )
+
+
+class ImageConfig(ConfigObject):
+    __slots__ = ('name', 'source', 'depends_on')
+    FIELDS = (
+        ('name', str, REQUIRED),
+        ('source', str, 'source'),
+        ('depends_on', [str], []),
+    )
+
+
+class Config(ConfigObject):
+    """
+    Contents of `ueli.yaml`. Only `service` is needed by every command,
+    commands check the other keys they use with `get_missing`. `warnings`
+    lists the unknown keys which were ignored.
+    """
+    __slots__ = ('service', 'repository', 'gcloud', 'git', 'kubernetes', 'deployments',
+                 'images', 'warnings')
+    FIELDS = (
+        ('service', str, REQUIRED),
+        ('repository', str, None),
+        ('gcloud', GcloudConfig, None),
+        ('git', GitConfig, None),
+        ('kubernetes', KubernetesConfig, None),
+        ('deployments', [DeploymentConfig], []),
+        ('images', [ImageConfig], []),
+    )
+
+    def __init__(self, **values):
+        super(Config, self).__init__(**values)
+        if self.gcloud is None:
+            self.gcloud = GcloudConfig()
+        if self.git is None:
+            self.git = GitConfig()
+        if self.kubernetes is None:
+            self.kubernetes = KubernetesConfig()
+        self.warnings = []
+
+    def get_missing(self, paths):
+        """
+        Returns the keys of `paths` (e.g. `gcloud.project`) which aren't
+        set.
+        """
+        missing = []
+        for path in paths:
+            value = self
+            for name in path.split('.'):
+                value = getattr(value, name, None)
+            if value is None or value == []:
+                missing.append(path)
+        return missing
+
+
+def parse(content):
+    """
+    Parses and validates the content of a config file and returns a
+    `Config`. Raises `ConfigError`.
+    """
+    with timings.span('parse config', category='yaml'):
+        try:
+            data = utils.yaml.load(content, Loader=utils.get_yaml_loader())
+        except utils.yaml.YAMLError as e:
+            raise ConfigError(["Can't parse YAML: {}".format(e)])
+
+    errors = []
+    warnings = []
+    config = Config.validate(data, '', errors, warnings)
+    if errors:
+        raise ConfigError(errors)
+    config.warnings = warnings
+    return config
+
+
+class ConfigCache(object):
+    """
+    On-disk cache of validated configs keyed by path, so unchanged config
+    files don't have to be parsed at all. Like the manifest cache, an entry
+    is used as long as mtime and size are unchanged and otherwise if the
+    content hash still matches.
+    """
+
+    def __init__(self, path=None, max_entries=CACHE_MAX_ENTRIES):
+        self.path = path or os.path.join(utils.get_cache_dir(), CACHE_FILE_NAME)
+        self.max_entries = max_entries
+
+    def _read(self):
+        data = utils.read_json_file(self.path, default={})
+        if not isinstance(data, dict) or data.get('version') != CACHE_VERSION:
+            return {}
+        return data.get('entries', {})
+
+    def _write(self, entries):
+        if len(entries) > self.max_entries:
+            keep = sorted(entries.keys(), key=lambda p: entries[p]['used'])[-self.max_entries:]
+            entries = dict((p, entries[p]) for p in keep)
+        utils.write_json_file(self.path, {'version': CACHE_VERSION, 'entries': entries})
+
+    @staticmethod
+    def _from_entry(entry):
+        config = Config.from_dict(entry['config'])
+        config.warnings = entry.get('warnings') or []
+        return config
+
+    def load(self, path):
+        """
+        Returns the `Config` of the file at `path` or None if it doesn't
+        exist. Raises `ConfigError` for invalid configs, they aren't cached.
+        """
+        abs_path = os.path.abspath(path)
+        try:
+            stat = os.stat(abs_path)
+        except OSError:
+            return None
+
+        entries = self._read()
+        entry = entries.get(abs_path)
+        if entry and entry['mtime'] == stat.st_mtime and entry['size'] == stat.st_size:
+            return self._from_entry(entry)
+
+        with open(abs_path, 'rb') as f:
+            content = f.read()
+        digest = hashlib.sha1(content).hexdigest()
+        if entry and entry['hash'] == digest:
+            config = self._from_entry(entry)
+        else:
+            config = parse(content)
+        entries[abs_path] = {'mtime': stat.st_mtime, 'size': stat.st_size, 'hash': digest,
+                             'config': config.to_dict(), 'warnings': config.warnings,
+                             'used': time.time()}
+        self._write(entries)
+        return config
+
+
+def load(path):
+    """
+    Returns the validated `Config` of the file at `path`, from the cache if
+    the file didn't change, or None if there is no such file.
+    """
+    return ConfigCache().load(path)
@@ -0,0 +1,101 @@
+import os
+import os.path
+import time
+import yaml
+
+from ueli import utils
+
+
+CACHE_FILE_NAME = 'credentials.json'
+
+# Refresh credentials at least once an hour, e.g. to pick up a new cluster
+# endpoint, and when the cached access token expires within a minute
+DEFAULT_TTL = 60 * 60
+EXPIRY_MARGIN = 60
+
+
+def get_kubeconfig_path():
+    """
+    Returns the kubeconfig kubectl uses, the first file of `$KUBECONFIG` or
+    `~/.kube/config`.
+    """
+    paths = [p for p in os.environ.get('KUBECONFIG', '').split(os.pathsep) if p]
+    return paths[0] if paths else os.path.expanduser('~/.kube/config')
+
+
+def load_kubeconfig(path=None):
+    try:
+        with open(path or get_kubeconfig_path(), 'r') as f:
+            return yaml.load(f, Loader=utils.get_yaml_loader()) or {}
+    except (IOError, OSError, yaml.YAMLError):
+        return {}
+
+
+def get_named(kubeconfig, section, name):
+    for entry in kubeconfig.get(section) or []:
+        if entry.get('name') == name:
+            return entry.get(section[:-1]) or {}
+    return None
+
+
+def matches_context(name, project, cluster):
+    """
+    Checks a context name against the names gcloud writes, which are of the
+    form `gke_{project}_{location}_{cluster}`.
+    """
+    prefix = 'gke_{project}_'.format(project=project)
+    return name.startswith(prefix) and name.endswith('_{cluster}'.format(cluster=cluster))
+
+
+def has_valid_context(kubeconfig, project, cluster, now=None):
+    """
+    Checks whether the current context of the kubeconfig points to the
+    cluster and its access token (if gcloud cached one) doesn't expire soon.
+    Tokens of exec plugins like `gke-gcloud-auth-plugin` are refreshed by
+    the plugin itself.
+    """
+    context_name = kubeconfig.get('current-context')
+    if not context_name or not matches_context(context_name, project, cluster):
+        return False
+
+    context = get_named(kubeconfig, 'contexts', context_name)
+    if context is None or get_named(kubeconfig, 'clusters', context.get('cluster')) is None:
+        return False
+
+    user = get_named(kubeconfig, 'users', context.get('user')) or {}
+    provider_config = (user.get('auth-provider') or {}).get('config') or {}
+    expiry = provider_config.get('expiry')
+    if expiry and provider_config.get('access-token'):
+        now = now or time.time()
+        return utils.parse_timestamp(expiry) - EXPIRY_MARGIN > now
+    return True
+
+
+class CredentialCache(object):
+    """
+    Remembers when credentials were last fetched per project and cluster.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(utils.get_cache_dir(), CACHE_FILE_NAME)
+
+    def _read(self):
+        data = utils.read_json_file(self.path, default={})
+        return data if isinstance(data, dict) else {}
+
+    def get_key(self, project, cluster):
+        return '{project}/{cluster}'.format(project=project, cluster=cluster)
+
+    def is_fresh(self, project, cluster, ttl=DEFAULT_TTL, kubeconfig=None):
+        fetched = self._read().get(self.get_key(project, cluster))
+        if not fetched or time.time() - fetched > ttl:
+            return False
+        if kubeconfig is None:
+            kubeconfig = load_kubeconfig()
+        return has_valid_context(kubeconfig, project=project, cluster=cluster)
+
+    def mark_fetched(self, project, cluster):
+        data = self._read()
+        data[self.get_key(project, cluster)] = time.time()
+        # Best effort, without it credentials are just fetched again
+        utils.write_json_file(self.path, data)
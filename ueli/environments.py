@@ -0,0 +1,173 @@
+import re
+import time
+
+from ueli import utils
+
+
+# Namespaces created (or applied to) by ueli carry this label, so they can be
+# listed with a server side label selector
+MANAGED_LABEL = 'app.kubernetes.io/managed-by'
+MANAGED_VALUE = 'ueli'
+MANAGED_SELECTOR = '{}={}'.format(MANAGED_LABEL, MANAGED_VALUE)
+
+# Annotations set on the namespace by `ueli deploy`
+DEPLOYED_AT_ANNOTATION = 'ueli/deployed-at'
+TAG_ANNOTATION_PREFIX = 'ueli/tag-'
+
+# Namespaces of kubernetes itself, never ueli environments
+SYSTEM_NAMESPACES = frozenset(['default', 'kube-system', 'kube-public', 'kube-node-lease'])
+
+# Environments only deployed to or configured if named, never through
+# patterns
+PROTECTED_ENVIRONMENTS = frozenset(['production'])
+
+DURATION_UNITS = {'s': 1, 'm': 60, 'h': 60 * 60, 'd': 24 * 60 * 60, 'w': 7 * 24 * 60 * 60}
+
+
+def get_tag_annotation(service):
+    return '{prefix}{service}'.format(prefix=TAG_ANNOTATION_PREFIX, service=service)
+
+
+def escape_jsonpath(key):
+    # Dots in annotation keys would be taken as path separators
+    return key.replace('.', '\\.')
+
+
+class Environment(object):
+    """
+    One row of `ueli list_environments`. `created` and `deployed` are
+    seconds since the epoch, `deployed` and `tag` are None if ueli never
+    deployed the service there.
+    """
+
+    def __init__(self, name, created=None, deployed=None, tag=None):
+        self.name = name
+        self.created = created
+        self.deployed = deployed
+        self.tag = tag
+
+    @property
+    def last_active(self):
+        return self.deployed or self.created
+
+    def age(self, now=None):
+        if self.created is None:
+            return None
+        return (now or time.time()) - self.created
+
+
+def get_list_cmd(service, chunk_size=500, selector=MANAGED_SELECTOR):
+    """
+    Returns the kubectl call listing environments with their creation time,
+    last deploy and the deployed tag of `service`. The API server returns
+    them in pages of `chunk_size`, printed as soon as they arrive.
+    """
+    columns = [
+        ('NAME', 'metadata.name'),
+        ('CREATED', 'metadata.creationTimestamp'),
+        ('DEPLOYED', 'metadata.annotations.{}'.format(escape_jsonpath(DEPLOYED_AT_ANNOTATION))),
+        ('TAG', 'metadata.annotations.{}'.format(escape_jsonpath(get_tag_annotation(service)))),
+    ]
+    cmd = ['kubectl', 'get', 'namespaces', '--chunk-size={}'.format(chunk_size),
+           '--no-headers', '-o',
+           'custom-columns=' + ','.join('{}:.{}'.format(name, path) for name, path in columns)]
+    if selector:
+        cmd.append('--selector={}'.format(selector))
+    return cmd
+
+
+def parse_row(line):
+    """
+    Returns the `Environment` of a line printed by `get_list_cmd` or None
+    for system namespaces and empty lines.
+    """
+    parts = line.split()
+    if len(parts) != 4 or parts[0] in SYSTEM_NAMESPACES:
+        return None
+    name, created, deployed, tag = [None if part == '<none>' else part for part in parts]
+    return Environment(
+        name=name,
+        created=utils.parse_timestamp(created) if created else None,
+        deployed=utils.parse_timestamp(deployed) if deployed else None,
+        tag=tag)
+
+
+def get_label_cmd(namespace):
+    return ['kubectl', 'label', 'namespace', namespace, MANAGED_SELECTOR, '--overwrite']
+
+
+def get_label_patch():
+    return {'metadata': {'labels': {MANAGED_LABEL: MANAGED_VALUE}}}
+
+
+def get_namespace_manifest(namespace):
+    return {'apiVersion': 'v1', 'kind': 'Namespace',
+            'metadata': {'name': namespace, 'labels': {MANAGED_LABEL: MANAGED_VALUE}}}
+
+
+def is_managed(namespace):
+    """
+    Checks if a namespace object (as returned by kubectl) has the label of
+    ueli environments.
+    """
+    if not isinstance(namespace, dict):
+        return False
+    labels = namespace.get('metadata', {}).get('labels') or {}
+    return labels.get(MANAGED_LABEL) == MANAGED_VALUE
+
+
+def get_annotations(service, tag, now=None):
+    deployed_at = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(now or time.time()))
+    return {DEPLOYED_AT_ANNOTATION: deployed_at, get_tag_annotation(service): tag}
+
+
+def get_annotate_cmd(namespace, service, tag, now=None):
+    annotations = get_annotations(service, tag, now=now)
+    return ['kubectl', 'annotate', 'namespace', namespace, '--overwrite'] + \
+        ['{}={}'.format(key, value) for key, value in sorted(annotations.items())]
+
+
+def get_annotate_patch(service, tag, now=None):
+    return {'metadata': {'annotations': get_annotations(service, tag, now=now)}}
+
+
+def from_namespace(namespace, service):
+    """
+    Returns the `Environment` of a namespace object (as returned by the
+    API) or None for system namespaces.
+    """
+    metadata = namespace.get('metadata') or {}
+    if metadata.get('name') in SYSTEM_NAMESPACES:
+        return None
+    annotations = metadata.get('annotations') or {}
+    created = metadata.get('creationTimestamp')
+    deployed = annotations.get(DEPLOYED_AT_ANNOTATION)
+    return Environment(
+        name=metadata['name'],
+        created=utils.parse_timestamp(created) if created else None,
+        deployed=utils.parse_timestamp(deployed) if deployed else None,
+        tag=annotations.get(get_tag_annotation(service)))
+
+
+def parse_duration(value):
+    """
+    Parses durations like `90m`, `12h`, `7d` or `2w` and returns seconds.
+    """
+    match = re.match(r'^\s*(\d+)\s*([smhdw])\s*$', value or '')
+    if not match:
+        raise ValueError("Invalid duration '{}', use e.g. 30m, 12h or 7d".format(value))
+    return int(match.group(1)) * DURATION_UNITS[match.group(2)]
+
+
+def format_age(seconds):
+    """
+    Formats seconds like kubectl does, e.g. `45s`, `3h` or `12d`.
+    """
+    if seconds is None:
+        return '-'
+    seconds = max(int(seconds), 0)
+    for unit, size in (('d', DURATION_UNITS['d']), ('h', DURATION_UNITS['h']),
+                       ('m', DURATION_UNITS['m'])):
+        if seconds >= size:
+            return '{}{}'.format(seconds // size, unit)
+    return '{}s'.format(seconds)
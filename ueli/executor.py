@@ -0,0 +1,204 @@
+import asyncio
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+
+
+# Upper limit of external processes running at the same time, no matter how
+# many threads or steps start them
+DEFAULT_MAX_PROCESSES = 16
+
+# How often running commands check for cancellation and timeouts
+POLL_INTERVAL = 0.05
+
+# Grace period between terminating and killing a command
+KILL_TIMEOUT = 5
+
+# Lines longer than this (e.g. minified JSON) are read in several chunks
+LINE_LIMIT = 1024 * 1024
+
+
+class Executor(object):
+    """
+    Runs external commands with `asyncio.create_subprocess_exec` on an event
+    loop in a background thread. Callers on any other thread block until
+    their command finished (see `run`), so commands started by concurrent
+    threads or steps overlap, at most `max_processes` of them at a time.
+    """
+
+    def __init__(self, max_processes=DEFAULT_MAX_PROCESSES):
+        self.max_processes = max_processes
+        self._loop = None
+        self._semaphore = None
+        self._lock = threading.Lock()
+
+    @property
+    def loop(self):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                thread = threading.Thread(target=self._loop.run_forever, name='ueli-executor')
+                thread.daemon = True
+                thread.start()
+        return self._loop
+
+    def run(self, argv, stream=False, quiet=False, timeout=None, cancel=None, stdin=None,
+            on_line=None):
+        """
+        Runs `argv` and returns (returncode, stdout, stderr, output, stopped).
+        `stopped` is `timeout` or `cancelled` if the command was stopped
+        because it ran longer than `timeout` seconds or the `cancel` event
+        was set, None otherwise. `on_line` is called on the loop thread with
+        every line of stdout. See `runner.run` for the other arguments.
+        """
+        done = threading.Event()
+        future = asyncio.run_coroutine_threadsafe(
+            self._run(argv, stream=stream, quiet=quiet, timeout=timeout, cancel=cancel,
+                      stdin=stdin, on_line=on_line, done=done),
+            self.loop)
+        try:
+            return future.result()
+        except KeyboardInterrupt:
+            # Stop the command before giving up
+            future.cancel()
+            done.wait(KILL_TIMEOUT + 1)
+            raise
+
+    async def _run(self, argv, stream, quiet, timeout, cancel, stdin, on_line, done):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_processes)
+        try:
+            async with self._semaphore:
+                return await self._run_process(argv, stream=stream, quiet=quiet,
+                                               timeout=timeout, cancel=cancel, stdin=stdin,
+                                               on_line=on_line)
+        finally:
+            done.set()
+
+    async def _run_process(self, argv, stream, quiet, timeout, cancel, stdin, on_line):
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *argv, stdin=asyncio.subprocess.PIPE if stdin is not None else None,
+                stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+                limit=LINE_LIMIT)
+        except OSError as e:
+            # Report a missing executable like a shell would
+            message = '{}: {}\n'.format(argv[0], e.strerror)
+            if not quiet:
+                sys.stderr.write(message)
+            return 127, '', message, message, None
+
+        stdout, stderr, output = [], [], []
+        # stderr is passed through like a shell would do it, unless quiet
+        work = asyncio.ensure_future(asyncio.gather(
+            _read_lines(process.stdout, stdout, output, sys.stdout if stream else None, on_line),
+            _read_lines(process.stderr, stderr, output, None if quiet else sys.stderr),
+            _write_input(process, stdin),
+            process.wait()))
+
+        stopped = None
+        start = self.loop.time()
+        try:
+            while not work.done():
+                await asyncio.wait([work], timeout=POLL_INTERVAL)
+                if work.done():
+                    break
+                if cancel is not None and cancel.is_set():
+                    stopped = 'cancelled'
+                elif timeout is not None and self.loop.time() - start > timeout:
+                    stopped = 'timeout'
+                if stopped:
+                    await _stop(process)
+                    break
+        except asyncio.CancelledError:
+            await _stop(process)
+            raise
+        finally:
+            if not work.done():
+                work.cancel()
+
+        if not stopped:
+            # Raises exceptions of the readers
+            work.result()
+        return process.returncode, ''.join(stdout), ''.join(stderr), ''.join(output), stopped
+
+
+async def _read_lines(pipe, lines, output, echo, on_line=None):
+    while True:
+        line = await pipe.readline()
+        if not line:
+            break
+        line = line.decode('utf-8', 'replace').replace('\r\n', '\n')
+        lines.append(line)
+        output.append(line)
+        if echo:
+            echo.write(line)
+            echo.flush()
+        if on_line:
+            on_line(line)
+
+
+async def _write_input(process, stdin):
+    if stdin is None:
+        return
+    try:
+        process.stdin.write(stdin.encode('utf-8'))
+        await process.stdin.drain()
+    except (BrokenPipeError, ConnectionResetError):
+        # The command doesn't read its input, its exit code will tell
+        pass
+    process.stdin.close()
+
+
+async def _stop(process):
+    if process.returncode is not None:
+        return
+    try:
+        process.terminate()
+        await asyncio.wait_for(process.wait(), KILL_TIMEOUT)
+    except ProcessLookupError:
+        pass
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """
+    Returns the executor shared by all commands of this process.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = Executor()
+    return _executor
+
+
+def concurrently(*calls, jobs=None):
+    """
+    Runs independent steps, given as callables without arguments, at the
+    same time and returns their results in order. Steps run on threads and
+    their commands on the shared executor, so a group of steps takes about
+    as long as the slowest one. The first exception raised by a step (e.g.
+    `ctx.abort()`) is raised once all steps are done. With `jobs` at most
+    that many steps run at a time.
+
+    Steps can use the current click context, but must not prompt.
+    """
+    ctx = click.get_current_context(silent=True)
+
+    def call(step):
+        if ctx is None:
+            return step()
+        with ctx.scope(cleanup=False):
+            return step()
+
+    with ThreadPoolExecutor(max_workers=max(min(jobs or len(calls), len(calls)), 1)) as pool:
+        futures = [pool.submit(call, step) for step in calls]
+    return [future.result() for future in futures]
@@ -0,0 +1,225 @@
+import os
+import os.path
+import time
+
+from ueli import utils
+
+
+SHORT_COMMIT_LENGTH = 7
+
+REMOTE_REFS_FILE_NAME = 'remote_refs.json'
+# Heads of a remote repository are fetched at most this often, pushes are
+# picked up after that at the latest
+REMOTE_REFS_TTL = 30
+
+# Git info of the current process: branch and commit keyed by working dir,
+# dirtiness keyed by (working dir, dirty check). The repository doesn't
+# change while ueli runs, so commands invoking each other can share it.
+_head_cache = {}
+_clean_cache = {}
+
+
+def find_git_dirs(path='.'):
+    """
+    Returns the git dir and the common dir (they differ for worktrees) of
+    the repository containing `path` or (None, None).
+    """
+    path = os.path.abspath(path)
+    while True:
+        candidate = os.path.join(path, '.git')
+        if os.path.isdir(candidate):
+            return candidate, candidate
+        if os.path.isfile(candidate):
+            # Worktrees and submodules have a `.git` file pointing to the
+            # real git dir, which in turn may point to a common dir
+            with open(candidate) as f:
+                git_dir = f.read().strip()[len('gitdir:'):].strip()
+            git_dir = os.path.normpath(os.path.join(path, git_dir))
+            common_dir = git_dir
+            commondir_file = os.path.join(git_dir, 'commondir')
+            if os.path.isfile(commondir_file):
+                with open(commondir_file) as f:
+                    common_dir = os.path.normpath(os.path.join(git_dir, f.read().strip()))
+            return git_dir, common_dir
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None, None
+        path = parent
+
+
+def read_packed_refs(common_dir):
+    refs = {}
+    packed_refs = os.path.join(common_dir, 'packed-refs')
+    if not os.path.isfile(packed_refs):
+        return refs
+    with open(packed_refs) as f:
+        for line in f:
+            # Skip header and peeled tags (`^sha`)
+            if line.startswith(('#', '^')):
+                continue
+            parts = line.split()
+            if len(parts) == 2:
+                refs[parts[1]] = parts[0]
+    return refs
+
+
+def resolve_ref(git_dir, common_dir, ref, depth=0):
+    """
+    Resolves a (symbolic) ref like `HEAD` or `refs/heads/master` to a commit
+    hash by reading loose refs and `packed-refs`. Returns None if the ref
+    doesn't exist (e.g. no commit yet).
+    """
+    if depth > 5:
+        return None
+    for base in (git_dir, common_dir):
+        ref_file = os.path.join(base, ref)
+        if os.path.isfile(ref_file):
+            with open(ref_file) as f:
+                content = f.read().strip()
+            if content.startswith('ref:'):
+                return resolve_ref(git_dir, common_dir, content[len('ref:'):].strip(),
+                                   depth=depth + 1)
+            return content or None
+    return read_packed_refs(common_dir).get(ref)
+
+
+def read_head(git_dir, common_dir):
+    """
+    Returns branch name and full commit hash of HEAD. The branch is `HEAD`
+    for a detached head, like `git rev-parse --abbrev-ref HEAD` prints it.
+    """
+    with open(os.path.join(git_dir, 'HEAD')) as f:
+        head = f.read().strip()
+    if head.startswith('ref:'):
+        ref = head[len('ref:'):].strip()
+        branch = ref[len('refs/heads/'):] if ref.startswith('refs/heads/') else ref
+        return branch, resolve_ref(git_dir, common_dir, ref)
+    return 'HEAD', head
+
+
+def is_clean(dirty_check='status'):
+    """
+    Checks the working tree for uncommitted changes of tracked files.
+    Untracked files are ignored, so git doesn't need to walk the whole tree.
+
+    `status` counts the changes reported by `git status --porcelain=v2`,
+    `diff-index` only looks at the exit code of `git diff-index --quiet`. It's
+    faster but reports files which were only touched as changed.
+    """
+    if dirty_check == 'diff-index':
+        returncode, output = utils.run_captured(['git', 'diff-index', '--quiet', 'HEAD', '--'])
+        return returncode == 0
+
+    output = utils.run_local(['git', 'status', '--porcelain=v2', '--branch', '--untracked-files=no'])
+    changes = [line for line in output.split('\n') if line and not line.startswith('#')]
+    return len(changes) < 1
+
+
+def get_head():
+    """
+    Returns the current git branch and short commit hash, read from `.git`
+    directly. Results are memoized per process.
+    """
+    key = os.path.abspath('.')
+    if key not in _head_cache:
+        branch, commit = None, None
+        git_dir, common_dir = find_git_dirs()
+        if git_dir:
+            branch, commit = read_head(git_dir, common_dir)
+
+        # Fall back to git for anything we can't read, e.g. other ref storages
+        if not branch or not commit:
+            branch = utils.run_local(['git', 'rev-parse', '--abbrev-ref', 'HEAD'])
+            commit = utils.run_local(['git', 'rev-parse', '--verify', branch])
+
+        _head_cache[key] = branch, commit[:SHORT_COMMIT_LENGTH]
+    return _head_cache[key]
+
+
+def get_git_info(dirty_check='status'):
+    """
+    Returns the current git branch, short commit hash and whether the
+    working tree is clean. Only the dirty check spawns git. Results are
+    memoized per process.
+    """
+    branch, commit = get_head()
+    key = (os.path.abspath('.'), dirty_check)
+    if key not in _clean_cache:
+        _clean_cache[key] = is_clean(dirty_check)
+    return branch, commit, _clean_cache[key]
+
+
+def parse_heads(output):
+    """
+    Returns branch -> commit of `git ls-remote --heads` output. Only
+    `refs/heads/*` are taken, so `feature` never matches `feature-xy` or
+    `refs/heads/user/feature`.
+    """
+    heads = {}
+    for line in output.split('\n'):
+        parts = line.split()
+        if len(parts) == 2 and parts[1].startswith('refs/heads/'):
+            heads[parts[1][len('refs/heads/'):]] = parts[0]
+    return heads
+
+
+class RemoteRefCache(object):
+    """
+    Caches the heads of remote repositories for a short time, so listing
+    them for `ueli latest` and every deploy costs one `git ls-remote` per
+    `ttl` seconds.
+    """
+
+    def __init__(self, path=None, ttl=REMOTE_REFS_TTL):
+        self.path = path or os.path.join(utils.get_cache_dir(), REMOTE_REFS_FILE_NAME)
+        self.ttl = ttl
+
+    def _read(self):
+        data = utils.read_json_file(self.path, default={})
+        return data if isinstance(data, dict) else {}
+
+    def _write(self, data):
+        utils.write_json_file(self.path, data)
+
+    def get(self, repository):
+        """
+        Returns branch -> commit of `repository` if they were fetched within
+        the TTL, otherwise None.
+        """
+        entry = self._read().get(repository)
+        if not entry or time.time() - entry['fetched'] > self.ttl:
+            return None
+        return entry['heads']
+
+    def fetch(self, repository, verbose=False):
+        """
+        Lists all heads of `repository` with a single `git ls-remote` and
+        stores them.
+        """
+        output = utils.run_local(['git', 'ls-remote', '--heads', repository], verbose=verbose)
+        heads = parse_heads(output)
+        data = self._read()
+        # Drop expired entries of other repositories while at it
+        now = time.time()
+        data = dict((repo, entry) for repo, entry in data.items()
+                    if now - entry['fetched'] <= self.ttl)
+        data[repository] = {'fetched': now, 'heads': heads}
+        self._write(data)
+        return heads
+
+    def get_heads(self, repository, refresh=False, verbose=False):
+        heads = None if refresh else self.get(repository)
+        if heads is None:
+            heads = self.fetch(repository, verbose=verbose)
+        return heads
+
+    def resolve(self, repository, branch, refresh=False, verbose=False):
+        """
+        Returns the full commit hash `branch` points to on `repository` or
+        None. A branch missing from cached heads is looked up again, it may
+        have been pushed just now.
+        """
+        heads = None if refresh else self.get(repository)
+        if heads is None or branch not in heads:
+            heads = self.fetch(repository, verbose=verbose)
+        return heads.get(branch)
@@ -0,0 +1,572 @@
+import hashlib
+import json
+import os
+import os.path
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from ueli import runner, utils
+
+
+# Branch whose images serve as layer cache if the current branch has none
+CACHE_FALLBACK_BRANCH = 'master'
+
+# Label recording the digest of the build context an image was built from
+CONTEXT_DIGEST_LABEL = 'ueli.context-digest'
+
+# Local images are removed with one `docker rmi` per this many tags
+RMI_BATCH_SIZE = 100
+
+# Docker prints sizes in decimal units
+SIZE_UNITS = {'B': 1, 'KB': 1000, 'MB': 1000 ** 2, 'GB': 1000 ** 3, 'TB': 1000 ** 4}
+
+
+def read_dockerignore(context):
+    """
+    Returns the patterns of `.dockerignore` in the build context as
+    (regex, exclude) tuples, an `!` prefix re-includes files.
+    """
+    patterns = []
+    path = os.path.join(context, '.dockerignore')
+    if not os.path.isfile(path):
+        return patterns
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            exclude = not line.startswith('!')
+            pattern = os.path.normpath(line.lstrip('!').strip()).lstrip('/')
+            patterns.append((compile_pattern(pattern), exclude))
+    return patterns
+
+
+def compile_pattern(pattern):
+    """
+    Translates a `.dockerignore` pattern into a regex. Like docker, `**`
+    matches any number of directories and a pattern matching a directory
+    matches everything in it.
+    """
+    regex = ''
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if pattern[i:i + 3] == '**/':
+            regex += '(.*/)?'
+            i += 3
+            continue
+        if pattern[i:i + 2] == '**':
+            regex += '.*'
+            i += 2
+            continue
+        if c == '*':
+            regex += '[^/]*'
+        elif c == '?':
+            regex += '[^/]'
+        else:
+            regex += re.escape(c)
+        i += 1
+    return re.compile('^{}(/.*)?$'.format(regex))
+
+
+def is_ignored(path, patterns):
+    # The last matching pattern wins
+    ignored = False
+    for regex, exclude in patterns:
+        if regex.match(path):
+            ignored = exclude
+    return ignored
+
+
+def get_context_digest(context):
+    """
+    Returns a sha256 digest over names, executable bits and contents of all
+    files docker would send as build context, respecting `.dockerignore`.
+    """
+    patterns = read_dockerignore(context)
+    # Without re-includes ignored directories can be skipped completely
+    can_prune = all(exclude for regex, exclude in patterns)
+
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(context):
+        rel_root = os.path.relpath(root, context)
+        rel_root = '' if rel_root == '.' else rel_root + '/'
+        dirs.sort()
+        if can_prune:
+            dirs[:] = [d for d in dirs if not is_ignored(rel_root + d, patterns)]
+
+        for name in sorted(files):
+            rel_path = rel_root + name
+            if is_ignored(rel_path, patterns):
+                continue
+            path = os.path.join(root, name)
+            if os.path.islink(path):
+                content_digest = hashlib.sha256(os.readlink(path).encode('utf-8')).hexdigest()
+                mode = 'l'
+            else:
+                content_digest = hash_file(path)
+                mode = 'x' if os.access(path, os.X_OK) else 'f'
+            digest.update('{} {} {}\n'.format(rel_path, mode, content_digest).encode('utf-8'))
+    return 'sha256:{}'.format(digest.hexdigest())
+
+
+def get_build_digest(context_digest, dependencies=None):
+    """
+    Returns the digest recorded on an image: the one of its context and,
+    for images built on other images, the build digests of these by build
+    arg name. An image is only reused if the images it's built on are
+    unchanged, too.
+    """
+    if not dependencies:
+        return context_digest
+    digest = hashlib.sha256(context_digest.encode('utf-8'))
+    for name, value in sorted(dependencies.items()):
+        digest.update('\n{}={}'.format(name, value).encode('utf-8'))
+    return 'sha256:{}'.format(digest.hexdigest())
+
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_context_label(image):
+    """
+    Returns the context digest label of a local image, an empty string if
+    the image has no such label and None if the image doesn't exist.
+    """
+    label_format = '{{{{index .Config.Labels "{label}"}}}}'.format(label=CONTEXT_DIGEST_LABEL)
+    result = runner.run(['docker', 'image', 'inspect', '--format', label_format, image],
+                        quiet=True, check=False)
+    if not result.ok:
+        return None
+    label = result.stdout.strip()
+    return '' if label == '<no value>' else label
+
+
+def remote_image_exists(remote_tag):
+    """
+    Checks whether the registry has a manifest for `remote_tag`, without
+    pulling it.
+    """
+    returncode, output = utils.run_captured(['docker', 'manifest', 'inspect', remote_tag])
+    return returncode == 0
+
+
+def find_image_by_digest(context_digest):
+    """
+    Returns a local image tag built from the same build context or None.
+    """
+    cmd = ['docker', 'images',
+           '--filter', 'label={label}={digest}'.format(label=CONTEXT_DIGEST_LABEL,
+                                                       digest=context_digest),
+           '--format', '{{.Repository}}:{{.Tag}}']
+    for image in utils.run_local(cmd).split('\n'):
+        if image and '<none>' not in image:
+            return image
+    return None
+
+
+def find_reusable_image(build_tag, context_digest, remote_tag, clean):
+    """
+    Checks whether building `build_tag` can be skipped and returns
+    (action, image, reason). Action is `exists` if the image is already
+    there, `tag` if `image` was built from an identical context and just
+    needs a tag, `pull` if the registry has it and None if it has to be
+    built.
+    """
+    # Images built from a dirty repository with `--force` can have the same
+    # tag but different content, so unlabeled images only count for clean
+    # builds
+    existing_digest = get_context_label(build_tag)
+    if existing_digest == context_digest or (existing_digest == '' and clean):
+        return 'exists', build_tag, "Image '{}' already exists".format(build_tag)
+
+    existing = find_image_by_digest(context_digest)
+    if existing:
+        return 'tag', existing, "Image '{}' was built from identical source".format(existing)
+
+    if clean and existing_digest is None and remote_image_exists(remote_tag):
+        return 'pull', remote_tag, "Image '{}' already exists in registry".format(remote_tag)
+
+    return None, None, None
+
+
+def reuse_image_cmd(action, image, build_tag):
+    """
+    Returns the commands to run one after the other to make a reusable
+    image (see `find_reusable_image`) available as `build_tag`.
+    """
+    if action == 'tag':
+        return [['docker', 'tag', image, build_tag]]
+    if action == 'pull':
+        return [['docker', 'pull', image], ['docker', 'tag', image, build_tag]]
+    return []
+
+
+def get_build_cmd(build_tag, context, context_digest, cache_image=None, build_args=None,
+                  quiet=True):
+    """
+    Returns the `docker build` command. BuildKit needs inline cache metadata
+    in the image to use it as cache for later builds.
+    """
+    cmd = ['docker', 'build', '--tag', build_tag,
+           '--label', '{label}={digest}'.format(label=CONTEXT_DIGEST_LABEL, digest=context_digest),
+           '--build-arg', 'BUILDKIT_INLINE_CACHE=1']
+    for name, value in sorted((build_args or {}).items()):
+        cmd += ['--build-arg', '{name}={value}'.format(name=name, value=value)]
+    if cache_image:
+        cmd += ['--cache-from', cache_image]
+    cmd.append(context)
+    if quiet:
+        cmd.append('--quiet=true')
+    return cmd
+
+
+def get_repository(config, service=None):
+    """
+    Returns the registry repository of the service (or another image), e.g.
+
+        eu.gcr.io/flatfox-project/flatfox-crawler_webapp
+
+    """
+    return '{remote}/{service}'.format(remote=utils.get_remote(config),
+                                      service=service or config.service)
+
+
+def find_cache_image(repository, branches):
+    """
+    Returns the most recently pushed image of the first branch in
+    `branches` which has one, or None.
+    """
+    cmd = ['gcloud', 'container', 'images', 'list-tags', repository, '--sort-by=~timestamp',
+           '--limit=100', '--format=json']
+    returncode, output = utils.run_captured(cmd)
+    try:
+        tags = json.loads(output) if returncode == 0 and output else []
+    except ValueError:
+        return None
+
+    for branch in branches:
+        prefix = utils.get_tag_name(branch=branch, commit='')
+        for image in tags:
+            for tag in image.get('tags') or []:
+                if tag.startswith(prefix):
+                    return '{repository}:{tag}'.format(repository=repository, tag=tag)
+    return None
+
+
+class CacheImagePull(object):
+    """
+    Looks up and pulls the image to use as `--cache-from` in a background
+    thread, so it runs while the build context is prepared. Call `wait` to
+    get the pulled image (None if there is none) or `cancel` if the build
+    isn't needed anymore.
+    """
+
+    def __init__(self, repository, branch):
+        self.repository = repository
+        self.branches = [branch] if branch == CACHE_FALLBACK_BRANCH else [branch, CACHE_FALLBACK_BRANCH]
+        self.image = None
+        self._cancelled = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        image = find_cache_image(self.repository, self.branches)
+        if not image or self._cancelled.is_set():
+            return
+        try:
+            result = runner.run(['docker', 'pull', image], quiet=True, check=False,
+                                cancel=self._cancelled)
+        except runner.CommandCancelled:
+            return
+        if result.ok:
+            self.image = image
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def wait(self):
+        self._thread.join()
+        return self.image
+
+
+def get_layers(image):
+    returncode, output = utils.run_captured(
+        ['docker', 'image', 'inspect', '--format', '{{json .RootFS.Layers}}', image])
+    try:
+        return json.loads(output) if returncode == 0 else []
+    except ValueError:
+        return []
+
+
+def get_cache_hits(image, cache_image):
+    """
+    Returns how many layers of `image` were reused from `cache_image` and
+    the total number of layers. Layers are reused up to the first changed
+    one, so that's the common prefix of both layer lists.
+    """
+    layers = get_layers(image)
+    cache_layers = get_layers(cache_image)
+    hits = 0
+    for layer, cache_layer in zip(layers, cache_layers):
+        if layer != cache_layer:
+            break
+        hits += 1
+    return hits, len(layers)
+
+
+def get_image_id(image):
+    """
+    Returns the id of a local image or None if it doesn't exist.
+    """
+    returncode, output = utils.run_captured(
+        ['docker', 'image', 'inspect', '--format', '{{.Id}}', image])
+    return output if returncode == 0 else None
+
+
+def get_remote_image_id(remote_tag):
+    """
+    Returns the image id (digest of the image config) the registry has for
+    `remote_tag` or None. It's the same as the local image id for images
+    pushed from there. Multi-platform manifest lists have no single image
+    id and return None, too.
+    """
+    returncode, output = utils.run_captured(['docker', 'manifest', 'inspect', remote_tag])
+    if returncode != 0:
+        return None
+    try:
+        return (json.loads(output).get('config') or {}).get('digest')
+    except ValueError:
+        return None
+
+
+class PushResult(object):
+
+    def __init__(self, remote_tag):
+        self.remote_tag = remote_tag
+        self.skipped = False
+        self.returncode = 0
+        self.output = ''
+        self.seconds = 0
+
+    @property
+    def ok(self):
+        return self.returncode == 0
+
+
+def push_image(image, image_id, remote_tag):
+    """
+    Tags `image` as `remote_tag` and pushes it, unless the registry already
+    has the same image under that tag.
+    """
+    result = PushResult(remote_tag)
+    start = time.time()
+    if get_remote_image_id(remote_tag) == image_id:
+        result.skipped = True
+    else:
+        result.returncode, result.output = utils.run_captured(['docker', 'tag', image, remote_tag])
+        if result.ok:
+            result.returncode, result.output = utils.run_captured(
+                ['gcloud', 'docker', '--', 'push', remote_tag])
+    result.seconds = time.time() - start
+    return result
+
+
+def push_images(image, image_id, remote_tags, jobs=4, echo=None):
+    """
+    Pushes `image` under all `remote_tags` on up to `jobs` threads and
+    returns a list of `PushResult`. `echo` is called with each result once
+    it's done.
+    """
+    results = []
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        futures = [executor.submit(push_image, image, image_id, remote_tag)
+                   for remote_tag in remote_tags]
+        for future in futures:
+            result = future.result()
+            if echo:
+                echo(result)
+            results.append(result)
+    return results
+
+
+class LocalImage(object):
+    """
+    One tag of a local image as listed by `list_local_images`. `created`
+    is seconds since the epoch, `size` bytes.
+    """
+
+    def __init__(self, repository, tag, image_id, created, size):
+        self.repository = repository
+        self.tag = tag
+        self.image_id = image_id
+        self.created = created
+        self.size = size
+
+    @property
+    def ref(self):
+        return '{repository}:{tag}'.format(repository=self.repository, tag=self.tag)
+
+
+def parse_size(value):
+    """
+    Parses sizes as printed by docker, e.g. `512B`, `12.5kB` or `1.2GB`,
+    and returns bytes. Docker uses decimal units.
+    """
+    match = re.match(r'^\s*([\d.]+)\s*([kKMGT]?B)\s*$', value or '')
+    if not match:
+        return 0
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2).upper()])
+
+
+def format_size(size):
+    for unit in ('TB', 'GB', 'MB', 'KB'):
+        if size >= SIZE_UNITS[unit]:
+            return '{:.1f}{}'.format(size / float(SIZE_UNITS[unit]), unit.replace('K', 'k'))
+    return '{}B'.format(size)
+
+
+def parse_created(value):
+    """
+    Parses creation times as printed by `docker images`, e.g.
+    `2026-10-01 12:00:00 +0200 CEST`, and returns seconds since the epoch.
+    """
+    parts = (value or '').split()
+    if len(parts) < 3:
+        return 0
+    try:
+        return utils.parse_timestamp('{}T{}{}'.format(parts[0], parts[1], parts[2]))
+    except ValueError:
+        return 0
+
+
+def list_local_images():
+    """
+    Lists all tagged local images with a single `docker images` call.
+    """
+    output = utils.run_local(['docker', 'images', '--no-trunc', '--format', '{{json .}}'])
+    result = []
+    for line in output.splitlines():
+        try:
+            data = json.loads(line)
+        except ValueError:
+            continue
+        if data.get('Tag', '<none>') == '<none>':
+            continue
+        result.append(LocalImage(repository=data['Repository'], tag=data['Tag'],
+                                 image_id=data.get('ID'),
+                                 created=parse_created(data.get('CreatedAt')),
+                                 size=parse_size(data.get('Size'))))
+    return result
+
+
+def parse_tag_name(tag):
+    """
+    Returns (branch, commit) of a tag built by ueli (`{branch}.{commit}`, see
+    `utils.get_tag_name`) or None for other tags.
+    """
+    match = re.match(r'^(.+)\.([0-9a-f]{7,40})$', tag)
+    return (match.group(1), match.group(2)) if match else None
+
+
+class PrunePlan(object):
+    """
+    Local images of `services` to delete, keeping the `keep` most recent
+    builds of every service and branch. Tags of other images are left
+    alone.
+
+    A build can have several tags, the local build tag and the remote tag
+    (see `utils.get_remote_tag`), they're kept or deleted together. The
+    most recent build with a remote tag of every branch is always kept,
+    it's the image `--cache-from` pulls for the branch (see
+    `find_cache_image`) and, for `CACHE_FALLBACK_BRANCH`, for branches
+    without one.
+    """
+
+    def __init__(self, local_images, services, keep):
+        self.keep = keep
+        self.to_delete = []
+        self.kept = []
+        # (service, branch, kept tags, deleted tags), newest tags first
+        self.groups = []
+        # (service, branch) -> tag name -> images
+        self.builds = {}
+        for image in local_images:
+            service = image.repository.rsplit('/', 1)[-1]
+            parsed = parse_tag_name(image.tag)
+            if service not in services or not parsed:
+                continue
+            branch, commit = parsed
+            self.builds.setdefault((service, branch), {}).setdefault(image.tag, []).append(image)
+
+        for (service, branch), builds in sorted(self.builds.items()):
+            tags = sorted(builds, key=lambda tag: max(i.created for i in builds[tag]),
+                          reverse=True)
+            keep_tags = set(tags[:max(keep, 0)])
+            # The cache image of the branch is the newest one with a remote tag
+            for tag in tags:
+                if any('/' in image.repository for image in builds[tag]):
+                    keep_tags.add(tag)
+                    break
+            for tag in tags:
+                (self.kept if tag in keep_tags else self.to_delete).extend(builds[tag])
+            self.groups.append((service, branch, [tag for tag in tags if tag in keep_tags],
+                                [tag for tag in tags if tag not in keep_tags]))
+
+    def get_reclaimable(self):
+        """
+        Returns the bytes of the images to delete which aren't also tagged
+        with a kept tag. Layers shared with other images are counted, too.
+        """
+        kept_ids = set(image.image_id for image in self.kept)
+        sizes = dict((image.image_id, image.size) for image in self.to_delete
+                     if image.image_id not in kept_ids)
+        return sum(sizes.values())
+
+
+def remove_images(refs, batch_size=RMI_BATCH_SIZE, echo=None):
+    """
+    Removes local images with one `docker rmi` call per `batch_size`
+    refs. Images still used by containers are left alone. Returns the
+    refs which couldn't be removed, `echo` is called with every batch's
+    command, exit code and output.
+    """
+    failed = []
+    for i in range(0, len(refs), batch_size):
+        batch = refs[i:i + batch_size]
+        cmd = ['docker', 'rmi'] + batch
+        returncode, output = utils.run_captured(cmd)
+        if echo:
+            echo(cmd, returncode, output)
+        if returncode != 0:
+            # Successfully removed ones are reported as `Untagged: REF`
+            untagged = set(line.split(':', 1)[1].strip() for line in output.splitlines()
+                           if line.startswith('Untagged:'))
+            failed.extend(ref for ref in batch if ref not in untagged)
+    return failed
+
+
+def get_images_disk_usage():
+    """
+    Returns the bytes used by local images according to `docker system
+    df`, or None if it can't be told.
+    """
+    returncode, output = utils.run_captured(['docker', 'system', 'df', '--format', '{{json .}}'])
+    if returncode != 0:
+        return None
+    for line in output.splitlines():
+        try:
+            data = json.loads(line)
+        except ValueError:
+            continue
+        if data.get('Type') == 'Images':
+            return parse_size(data.get('Size'))
+    return None
@@ -0,0 +1,392 @@
+import base64
+import http.client
+import json
+import os
+import ssl
+import tempfile
+import threading
+import time
+from urllib.parse import quote, urlencode, urlsplit
+
+from ueli import credentials, runner, timings, utils
+
+
+DEFAULT_TIMEOUT = 60
+# Idle keep-alive connections kept per client, more are opened while
+# requests run concurrently
+MAX_IDLE_CONNECTIONS = 8
+# Tokens of exec plugins are fetched again a minute before they expire
+EXPIRY_MARGIN = 60
+
+# Kinds the client can handle: kind -> (API path, resource, namespaced).
+# Everything else needs kubectl, which discovers resources of the cluster.
+RESOURCES = {
+    'namespace': ('/api/v1', 'namespaces', False),
+    'configmap': ('/api/v1', 'configmaps', True),
+    'secret': ('/api/v1', 'secrets', True),
+    'service': ('/api/v1', 'services', True),
+    'serviceaccount': ('/api/v1', 'serviceaccounts', True),
+    'persistentvolumeclaim': ('/api/v1', 'persistentvolumeclaims', True),
+    'deployment': ('/apis/apps/v1', 'deployments', True),
+    'statefulset': ('/apis/apps/v1', 'statefulsets', True),
+    'daemonset': ('/apis/apps/v1', 'daemonsets', True),
+    'job': ('/apis/batch/v1', 'jobs', True),
+    'cronjob': ('/apis/batch/v1', 'cronjobs', True),
+    'ingress': ('/apis/networking.k8s.io/v1', 'ingresses', True),
+}
+
+
+class ApiError(Exception):
+    """
+    Failed API request. `status` is the HTTP status, 0 if the server
+    couldn't be reached.
+    """
+
+    def __init__(self, status, reason, message=None):
+        super(ApiError, self).__init__('{status} {reason}{message}'.format(
+            status=status, reason=reason, message=': {}'.format(message) if message else ''))
+        self.status = status
+        self.reason = reason
+        self.message = message
+
+
+class UnsupportedConfig(Exception):
+    """
+    Raised for kubeconfigs the client can't handle, e.g. proxies or exec
+    plugins needing environment variables. kubectl is used instead.
+    """
+
+
+class ExecCredentials(object):
+    """
+    Bearer token of an exec credential plugin like `gke-gcloud-auth-plugin`.
+    The plugin is run once and again shortly before the token expires.
+    """
+
+    def __init__(self, config):
+        if config.get('env'):
+            raise UnsupportedConfig('exec plugins with environment variables')
+        self.cmd = [config['command']] + list(config.get('args') or [])
+        self.token = None
+        self.expires = None
+        self._lock = threading.Lock()
+
+    def get_token(self):
+        with self._lock:
+            if self.token is None or \
+                    (self.expires and self.expires - EXPIRY_MARGIN < time.time()):
+                self._fetch()
+            return self.token
+
+    def _fetch(self):
+        output = utils.run_local(self.cmd)
+        status = json.loads(output).get('status') or {}
+        if not status.get('token'):
+            raise UnsupportedConfig('exec plugins without token')
+        self.token = status['token']
+        expiry = status.get('expirationTimestamp')
+        self.expires = utils.parse_timestamp(expiry) if expiry else None
+
+
+class StaticCredentials(object):
+
+    def __init__(self, token):
+        self.token = token
+
+    def get_token(self):
+        return self.token
+
+
+def get_ssl_context(cluster, user):
+    """
+    Returns the SSL context verifying the server like kubectl does, with
+    the client certificate of `user` if it has one.
+    """
+    context = ssl.create_default_context()
+    if cluster.get('insecure-skip-tls-verify'):
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    elif cluster.get('certificate-authority-data'):
+        context.load_verify_locations(
+            cadata=base64.b64decode(cluster['certificate-authority-data']).decode('ascii'))
+    elif cluster.get('certificate-authority'):
+        context.load_verify_locations(cafile=cluster['certificate-authority'])
+
+    if user.get('client-certificate-data') and user.get('client-key-data'):
+        # The ssl module only loads certificates from files
+        directory = tempfile.mkdtemp()
+        try:
+            paths = []
+            for key in ('client-certificate-data', 'client-key-data'):
+                path = os.path.join(directory, key)
+                with open(path, 'wb') as f:
+                    f.write(base64.b64decode(user[key]))
+                paths.append(path)
+            context.load_cert_chain(*paths)
+        finally:
+            for name in os.listdir(directory):
+                os.remove(os.path.join(directory, name))
+            os.rmdir(directory)
+    elif user.get('client-certificate') and user.get('client-key'):
+        context.load_cert_chain(user['client-certificate'], user['client-key'])
+    return context
+
+
+def get_credentials(user):
+    if user.get('token'):
+        return StaticCredentials(user['token'])
+    if user.get('tokenFile'):
+        with open(user['tokenFile']) as f:
+            return StaticCredentials(f.read().strip())
+    if user.get('exec'):
+        return ExecCredentials(user['exec'])
+    provider_config = (user.get('auth-provider') or {}).get('config') or {}
+    if provider_config.get('access-token'):
+        # Refreshed by `ueli set_credentials` before it expires
+        return StaticCredentials(provider_config['access-token'])
+    if user.get('username') or user.get('auth-provider'):
+        raise UnsupportedConfig('this kind of user authentication')
+    return None
+
+
+class ConnectionPool(object):
+    """
+    Keep-alive HTTP(S) connections to one server, shared by all threads.
+    Connections are taken for one request and put back afterwards, so the
+    TLS handshake is done once per connection instead of once per call.
+    """
+
+    def __init__(self, scheme, host, port, ssl_context=None, timeout=DEFAULT_TIMEOUT,
+                 max_idle=MAX_IDLE_CONNECTIONS):
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.ssl_context = ssl_context
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.connections = 0
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        self.connections += 1
+        if self.scheme == 'https':
+            return http.client.HTTPSConnection(self.host, self.port, timeout=self.timeout,
+                                               context=self.ssl_context)
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def _acquire(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop(), True
+        return self._connect(), False
+
+    def _release(self, connection):
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(connection)
+                return
+        connection.close()
+
+    def request(self, method, path, body=None, headers=None):
+        """
+        Sends a request and returns (status, reason, body). A request on an
+        idle connection the server closed in the meantime is sent again on
+        a new one.
+        """
+        while True:
+            connection, reused = self._acquire()
+            try:
+                connection.request(method, path, body=body, headers=headers or {})
+                response = connection.getresponse()
+                data = response.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                connection.close()
+                if reused:
+                    continue
+                raise
+            except Exception:
+                connection.close()
+                raise
+            if response.will_close:
+                connection.close()
+            else:
+                self._release(connection)
+            return response.status, response.reason, data
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
+
+
+class ApiClient(object):
+    """
+    Minimal Kubernetes API client for the calls ueli makes: get, list,
+    create, merge patch and server side apply of the kinds in `RESOURCES`.
+    """
+
+    def __init__(self, server, ssl_context=None, credentials=None, timeout=DEFAULT_TIMEOUT):
+        parts = urlsplit(server)
+        if parts.scheme not in ('http', 'https'):
+            raise UnsupportedConfig("server '{}'".format(server))
+        self.server = server
+        self.base_path = parts.path.rstrip('/')
+        self.credentials = credentials
+        self.pool = ConnectionPool(
+            scheme=parts.scheme, host=parts.hostname,
+            port=parts.port or (443 if parts.scheme == 'https' else 80),
+            ssl_context=ssl_context, timeout=timeout)
+
+    @staticmethod
+    def supports(kind):
+        return kind.lower() in RESOURCES
+
+    def get_path(self, kind, name=None, namespace=None):
+        try:
+            prefix, resource, namespaced = RESOURCES[kind.lower()]
+        except KeyError:
+            raise ValueError("Unsupported kind '{}'".format(kind))
+        path = prefix
+        if namespaced and namespace:
+            path += '/namespaces/{}'.format(quote(namespace, safe=''))
+        path += '/' + resource
+        if name:
+            path += '/{}'.format(quote(name, safe=''))
+        return path
+
+    def request(self, method, path, body=None, content_type='application/json', query=None):
+        """
+        Sends a request and returns the decoded JSON response. Raises
+        `ApiError` for error responses and unreachable servers.
+        """
+        url = self.base_path + path
+        if query:
+            url += '?' + urlencode(query)
+        headers = {'Accept': 'application/json', 'User-Agent': 'ueli'}
+        token = self.credentials.get_token() if self.credentials else None
+        if token:
+            headers['Authorization'] = 'Bearer {}'.format(token)
+        if body is not None:
+            body = json.dumps(body).encode('utf-8')
+            headers['Content-Type'] = content_type
+
+        with timings.span('{} {}'.format(method, path), category='api') as span:
+            try:
+                status, reason, data = self.pool.request(method, url, body=body,
+                                                         headers=headers)
+            except (OSError, http.client.HTTPException) as e:
+                raise ApiError(0, 'Connection failed', str(e))
+            span.set(status=status, response_bytes=len(data))
+
+        if status >= 400:
+            message = None
+            try:
+                message = json.loads(data).get('message')
+            except ValueError:
+                pass
+            raise ApiError(status, reason, message)
+        return json.loads(data) if data else None
+
+    def get(self, kind, name, namespace=None):
+        """
+        Returns the object or None if it doesn't exist.
+        """
+        try:
+            return self.request('GET', self.get_path(kind, name=name, namespace=namespace))
+        except ApiError as e:
+            if e.status == 404:
+                return None
+            raise
+
+    def list(self, kind, namespace=None, label_selector=None, limit=None):
+        """
+        Yields all objects of `kind`, in all namespaces unless `namespace`
+        is given. With `limit` they're fetched in pages of that size.
+        """
+        query = {}
+        if label_selector:
+            query['labelSelector'] = label_selector
+        if limit:
+            query['limit'] = limit
+        path = self.get_path(kind, namespace=namespace)
+        while True:
+            data = self.request('GET', path, query=query)
+            # Items of lists come without kind
+            item_kind = data.get('kind', '')[:-len('List')]
+            for item in data.get('items') or []:
+                item.setdefault('kind', item_kind)
+                item.setdefault('apiVersion', data.get('apiVersion'))
+                yield item
+            query['continue'] = (data.get('metadata') or {}).get('continue')
+            if not query['continue']:
+                return
+
+    def create(self, obj):
+        metadata = obj['metadata']
+        return self.request('POST', self.get_path(obj['kind'], namespace=metadata.get('namespace')),
+                            body=obj)
+
+    def replace(self, obj):
+        """
+        Replaces `obj` as a whole, like `kubectl replace`. Fails with a
+        conflict if it carries a `resourceVersion` which is no longer the
+        current one.
+        """
+        metadata = obj['metadata']
+        return self.request('PUT', self.get_path(obj['kind'], name=metadata['name'],
+                                                 namespace=metadata.get('namespace')),
+                            body=obj)
+
+    def merge_patch(self, kind, name, patch, namespace=None):
+        return self.request('PATCH', self.get_path(kind, name=name, namespace=namespace),
+                            body=patch, content_type='application/merge-patch+json')
+
+    def apply(self, obj, field_manager, force=False):
+        """
+        Server side apply of `obj`, like `kubectl apply --server-side`.
+        """
+        metadata = obj['metadata']
+        query = {'fieldManager': field_manager}
+        if force:
+            query['force'] = 'true'
+        # JSON is valid YAML
+        return self.request('PATCH', self.get_path(obj['kind'], name=metadata['name'],
+                                                   namespace=metadata.get('namespace')),
+                            body=obj, content_type='application/apply-patch+yaml', query=query)
+
+    def close(self):
+        self.pool.close()
+
+
+def get_client(kubeconfig=None, timeout=DEFAULT_TIMEOUT):
+    """
+    Returns a client for the current context of the kubeconfig kubectl
+    uses. Raises `UnsupportedConfig` if it can't be handled.
+    """
+    if kubeconfig is None:
+        kubeconfig = credentials.load_kubeconfig()
+    context = credentials.get_named(kubeconfig, 'contexts', kubeconfig.get('current-context'))
+    if not context:
+        raise UnsupportedConfig('no current context')
+    cluster = credentials.get_named(kubeconfig, 'clusters', context.get('cluster')) or {}
+    user = credentials.get_named(kubeconfig, 'users', context.get('user')) or {}
+    if not cluster.get('server'):
+        raise UnsupportedConfig('no cluster server')
+    if cluster.get('proxy-url'):
+        raise UnsupportedConfig('proxies')
+
+    ssl_context = None
+    if cluster['server'].startswith('https:'):
+        ssl_context = get_ssl_context(cluster, user)
+    client = ApiClient(cluster['server'], ssl_context=ssl_context,
+                       credentials=get_credentials(user), timeout=timeout)
+    # Exec plugins run now, so a plugin which doesn't work falls back to
+    # kubectl before anything was sent
+    if client.credentials:
+        try:
+            client.credentials.get_token()
+        except (runner.CommandError, ValueError) as e:
+            raise UnsupportedConfig('credential plugin failed: {}'.format(e))
+    return client
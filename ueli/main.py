@@ -1,18 +1,49 @@
 import click
-import json
+import sys
+import time
 from ueli import utils
 
+# Everything but click is loaded on first use, so `--help` and shell
+# completion answer quickly
+fnmatch = utils.lazy_import('fnmatch')
+json = utils.lazy_import('json')
+cluster = utils.lazy_import('ueli.cluster')
+configmaps = utils.lazy_import('ueli.configmaps')
+configuration = utils.lazy_import('ueli.configuration')
+credentials = utils.lazy_import('ueli.credentials')
+environments = utils.lazy_import('ueli.environments')
+executor = utils.lazy_import('ueli.executor')
+git = utils.lazy_import('ueli.git')
+images = utils.lazy_import('ueli.images')
+kubeapi = utils.lazy_import('ueli.kubeapi')
+manifests = utils.lazy_import('ueli.manifests')
+pipeline = utils.lazy_import('ueli.pipeline')
+rollout = utils.lazy_import('ueli.rollout')
+runner = utils.lazy_import('ueli.runner')
+timings = utils.lazy_import('ueli.timings')
+usage = utils.lazy_import('ueli.usage')
+
 
 VERSION = '0.0.1'
 CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
 CONFIG_FILE_NAME = 'ueli.yaml'
 
+# Commands which need git info, it's read while the config is loaded
+GIT_INFO_COMMANDS = ('status', 'build', 'push')
+
 
 @click.group(context_settings=CONTEXT_SETTINGS)
 @click.version_option(version=VERSION)
 @click.option('-v', '--verbose', is_flag=True, help='Enables verbose mode')
+@click.option('--refresh-credentials', is_flag=True,
+              help='Always fetch cluster credentials from gcloud')
+@click.option('--timings', 'show_timings', is_flag=True,
+              help='Print where the time went, by external command and phase')
+@click.option('--trace', type=click.Path(dir_okay=False, writable=True), default=None,
+              help='Write a Chrome trace (e.g. for Perfetto) of all external commands and '
+                   'phases to this file')
 @click.pass_context
-def ueli(ctx, verbose):
+def ueli(ctx, verbose, refresh_credentials, show_timings, trace):
     """
     Ueli the servant helps to build and deploy at flatfox.
 
@@ -35,12 +66,84 @@ def ueli(ctx, verbose):
     """
     # Main entry point. We use the context object to store our configuration
     # so they are available to all other commands through context
-    config = utils.load_yaml_file(path=CONFIG_FILE_NAME)
+    ctx.obj['verbose'] = verbose
+    ctx.obj['refresh_credentials'] = refresh_credentials
+
+    # Help of subcommands and completion don't need any config
+    if ctx.resilient_parsing or ctx.obj.get('help_requested'):
+        return
+
+    if show_timings or trace:
+        recorder = timings.enable()
+        ctx.call_on_close(lambda: report_timings(recorder, summary=show_timings, trace=trace))
+
+    # Branch and commit don't depend on the config, they're read from `.git`
+    # while the config is parsed. The dirty check waits for the config's
+    # `git.dirty_check`.
+    steps = [lambda: configuration.load(CONFIG_FILE_NAME)]
+    if ctx.invoked_subcommand in GIT_INFO_COMMANDS:
+        steps.append(prefetch_git_info)
+    try:
+        with timings.span('load config', category='config'):
+            config = executor.concurrently(*steps)[0]
+    except configuration.ConfigError as e:
+        click.secho("Invalid config file '{}':".format(CONFIG_FILE_NAME), fg='red')
+        for error in e.errors:
+            click.secho('  {}'.format(error), fg='red')
+        ctx.abort()
     if not config:
         click.secho("No config file '{}' found".format(CONFIG_FILE_NAME), fg='red')
         ctx.abort()
+    # On stderr, output of commands like `ueli latest` is used by scripts
+    for warning in config.warnings:
+        click.secho("{file}: {warning}, ignored".format(file=CONFIG_FILE_NAME, warning=warning),
+                    fg='yellow', err=True)
     ctx.obj['config'] = config
-    ctx.obj['verbose'] = verbose
+
+
+def require_config(*paths):
+    """
+    Aborts the current command if any of the config keys `paths` (e.g.
+    `gcloud.project`) isn't set. Only `service` is required by all
+    commands, the others are checked by the commands using them.
+    """
+    ctx = click.get_current_context()
+    missing = ctx.obj['config'].get_missing(paths)
+    if missing:
+        click.secho("Invalid config file '{file}', `ueli {command}` needs:".format(
+            file=CONFIG_FILE_NAME, command=ctx.info_name), fg='red')
+        for path in missing:
+            click.secho('  {}: is required'.format(path), fg='red')
+        ctx.abort()
+
+
+def report_timings(recorder, summary, trace):
+    """
+    Prints time spent per category of external commands and phases to
+    stderr and/or writes a Chrome trace file.
+    """
+    if summary:
+        total = time.time() - recorder.start
+        rows = [('CATEGORY', 'COUNT', 'TOTAL', 'MAX')]
+        for category, count, seconds, longest in recorder.summary():
+            rows.append((category, str(count), '{:.3f}s'.format(seconds),
+                         '{:.3f}s'.format(longest)))
+        click.echo(err=True)
+        for line in format_table(rows):
+            click.secho(line, fg='cyan', err=True)
+        click.secho('Wall time: {:.3f}s (categories overlap when run '
+                    'concurrently)'.format(total), fg='cyan', err=True)
+    if trace:
+        recorder.write_trace(trace)
+        click.secho("Trace written to '{}'".format(trace), fg='cyan', err=True)
+
+
+def prefetch_git_info():
+    # Failures are reported by the command actually using git info
+    try:
+        git.get_head()
+    except (runner.CommandError, IOError, OSError):
+        pass
 
 
 @ueli.command()
@@ -54,12 +157,12 @@ def status(ctx, details):
     """
     config = ctx.obj['config']
     click.secho("Service", fg='cyan')
-    click.secho(config['service'], fg='green')
+    click.secho(config.service, fg='green')
 
     click.secho("Gcloud", fg='cyan')
-    click.secho("Project: {}".format(config['gcloud']['project']), fg='green')
-    click.secho("Registry: {}".format(config['gcloud']['registry']), fg='green')
-    click.secho("Cluster: {}".format(config['gcloud']['cluster']), fg='green')
+    click.secho("Project: {}".format(config.gcloud.project), fg='green')
+    click.secho("Registry: {}".format(config.gcloud.registry), fg='green')
+    click.secho("Cluster: {}".format(config.gcloud.cluster), fg='green')
 
     click.secho("Repository Status", fg='cyan')
     branch, commit, clean = utils.get_git_info()
@@ -69,7 +172,7 @@ def status(ctx, details):
 
     if details:
         click.secho("Config File", fg='cyan')
-        click.echo(json.dumps(config, indent=4))
+        click.echo(json.dumps(config.to_dict(), indent=4))
 
 
 @ueli.command()
@@ -80,14 +183,15 @@ def init(ctx):
 
     TODO (silvan): how to handle service account for e.g. CI?
     """
+    require_config('gcloud.project')
     config = ctx.obj['config']
-    gcloud_project = config['gcloud']['project']
+    gcloud_project = config.gcloud.project
 
     if click.confirm('Do you want to (re)login to gcloud too? (will open browser)'):
-        utils.run_local('gcloud auth login')
-        utils.run_local('gcloud auth application-default login')
+        utils.run_local(['gcloud', 'auth', 'login'], output=False)
+        utils.run_local(['gcloud', 'auth', 'application-default', 'login'], output=False)
 
-    utils.run_local('gcloud config set project {}'.format(gcloud_project))
+    utils.run_local(['gcloud', 'config', 'set', 'project', gcloud_project])
 
     click.echo('Done!')
 
@@ -95,14 +199,33 @@ def init(ctx):
 @ueli.command()
 @click.option('--force', is_flag=True, help='Froce build, ignore dirty git.')
 @click.option('--tag', is_flag=False, help='Override tag', default=None)
+@click.option('--rebuild', is_flag=True,
+              help='Build even if an image of the same source exists.')
+@click.option('--no-cache-from', is_flag=True,
+              help="Don't use the branch's last pushed image as layer cache.")
+@click.option('--all', 'all_images', is_flag=True,
+              help='Build all images declared in `images` of the config.')
+@click.option('-j', '--jobs', default=4, show_default=True,
+              help='Number of images built concurrently with `--all`')
 @click.pass_context
-def build(ctx, force, tag):
+def build(ctx, force, tag, rebuild, no_cache_from, all_images, jobs):
     """
     Build image from current branch.
+
+    The build is skipped if the image already exists locally or in the
+    registry or if a local image was built from an identical `source`
+    directory (respecting `.dockerignore`). Such images are just tagged.
+
+    Otherwise the last pushed image of the branch (or master) is pulled
+    while the build context is prepared and used as layer cache.
+
+    With `--all` all images of the config are built, each one as soon as
+    the images it depends on are built.
     """
+    require_config('gcloud.project', 'gcloud.registry')
     config = ctx.obj['config']
     verbose = ctx.obj['verbose']
-    service = config['service']
+    service = config.service
 
     branch, commit, clean = utils.get_git_info()
     build_tag = utils.get_build_tag(service=service, branch=branch, commit=commit, tag=tag)
@@ -114,58 +237,253 @@ def build(ctx, force, tag):
                     "if you know what you're doing.", fg='yellow')
         ctx.abort()
 
+    if all_images:
+        run_pipeline(ctx, push=False, jobs=jobs, rebuild=rebuild,
+                     cache_from=not no_cache_from)
+        return
+
+    cache_pull = None
+    if not no_cache_from:
+        cache_pull = images.CacheImagePull(repository=images.get_repository(config),
+                                           branch=branch)
+
+    # Images are labeled with a digest of their build context, so an image
+    # with identical content can be reused instead of built again
+    context_digest = images.get_context_digest('source')
+    if not rebuild:
+        remote_tag = utils.get_remote_tag(config=config, build_tag=build_tag)
+        action, image, reason = images.find_reusable_image(
+            build_tag=build_tag, context_digest=context_digest, remote_tag=remote_tag,
+            clean=clean)
+        if action:
+            if cache_pull:
+                cache_pull.cancel()
+            click.secho("{reason}, skipping build.".format(reason=reason), fg='green')
+            for cmd in images.reuse_image_cmd(action, image=image, build_tag=build_tag):
+                utils.run_local(cmd, verbose=True)
+            return
+
     click.secho("Building image '{build_tag}'".format(build_tag=build_tag), fg='cyan')
     click.confirm('Do you want to continue?', abort=True)
 
+    cache_image = cache_pull.wait() if cache_pull else None
+    if cache_image:
+        click.secho("Using '{}' as layer cache".format(cache_image), fg='cyan')
+    elif cache_pull:
+        click.secho("No previous image found to use as layer cache", fg='yellow')
+
     # Build and tag local image
-    cmd = "docker build --tag {build_tag} source {quiet}".format(
-        build_tag=build_tag, quiet='--quiet=true' if not verbose else '')
-    utils.run_local(cmd, verbose=True)
+    cmd = images.get_build_cmd(build_tag=build_tag, context='source',
+                               context_digest=context_digest, cache_image=cache_image,
+                               quiet=not verbose)
+    utils.run_local(cmd, verbose=True, stream=True)
+
+    if cache_image:
+        hits, total = images.get_cache_hits(build_tag, cache_image)
+        click.secho("Layer cache: {hits}/{total} layers reused ({ratio:.0%})".format(
+            hits=hits, total=total, ratio=float(hits) / total if total else 0), fg='cyan')
 
     click.echo('Done!')
 
 
 @ueli.command()
 @click.option('--tag', is_flag=False, help='Override tag', default=None)
+@click.option('--also-tag', multiple=True,
+              help='Additional remote tag, e.g. `master-latest` or `1.2.0`. '
+                   'Can be used multiple times.')
+@click.option('-j', '--jobs', default=4, show_default=True,
+              help='Number of tags (or images with `--all`) pushed concurrently')
+@click.option('--all', 'all_images', is_flag=True,
+              help='Build and push all images declared in `images` of the config.')
 @click.pass_context
-def push(ctx, tag):
+def push(ctx, tag, also_tag, jobs, all_images):
     """
     Push image to remote registry.
+
+    Tags which already point to the same image in the registry are
+    skipped.
+
+    With `--all` all images of the config are built like `ueli build --all`
+    does and each one is pushed as soon as its build finished.
     """
+    require_config('gcloud.project', 'gcloud.registry')
     config = ctx.obj['config']
-    service = config['service']
+    service = config.service
 
     branch, commit, clean = utils.get_git_info()
+    if all_images:
+        if not clean:
+            click.secho("Repository is not clean. Clean up or use `ueli build "
+                        "--all --force` first.", fg='yellow')
+            ctx.abort()
+        run_pipeline(ctx, push=True, jobs=jobs)
+        return
 
     build_tag = utils.get_build_tag(service=service, branch=branch, commit=commit, tag=tag)
+    remote_tags = [utils.get_remote_tag(config=config, build_tag=build_tag)]
+    for extra_tag in also_tag:
+        remote_tags.append(utils.get_remote_tag(
+            config=config, build_tag=utils.get_build_tag(service=service, branch=branch,
+                                                         commit=commit, tag=extra_tag)))
 
-    remote = '{gcloud_registry}/{gcloud_project}'.format(
-        gcloud_registry=config['gcloud']['registry'],
-        gcloud_project=config['gcloud']['project'])
+    remote = utils.get_remote(config)
 
-    click.secho("Pushing '{build_tag}' to '{remote}'".format(
-        build_tag=build_tag, remote=remote), fg='cyan')
+    click.secho("Pushing '{build_tag}' to '{remote}' as {tags}".format(
+        build_tag=build_tag, remote=remote,
+        tags=', '.join("'{}'".format(t.split(':')[-1]) for t in remote_tags)), fg='cyan')
     click.confirm('Do you want to continue?', abort=True)
 
-    # Add remote tag to local image
-    remote_tag = '{remote}/{build_tag}'.format(remote=remote, build_tag=build_tag)
-    cmd = 'docker tag {build_tag} {remote_tag}'.format(build_tag=build_tag, remote_tag=remote_tag)
-    utils.run_local(cmd, verbose=True)
+    image_id = images.get_image_id(build_tag)
+    if not image_id:
+        click.secho("Image '{build_tag}' doesn't exist, run `ueli build` first.".format(
+            build_tag=build_tag), fg='yellow')
+        ctx.abort()
+
+    def echo(result):
+        if not result.ok:
+            click.secho(result.output, fg='red')
+        status = 'unchanged, skipped' if result.skipped else ('pushed' if result.ok else 'failed')
+        click.secho("{remote_tag}: {status} ({seconds:.1f}s)".format(
+            remote_tag=result.remote_tag, status=status, seconds=result.seconds),
+            fg='green' if result.ok else 'red')
 
-    # Push image to remote server
-    cmd = 'gcloud docker -- push {remote_tag}'.format(remote_tag=remote_tag)
-    utils.run_local(cmd, verbose=True)
+    results = images.push_images(build_tag, image_id, remote_tags, jobs=jobs, echo=echo)
+    if any(not result.ok for result in results):
+        ctx.exit(1)
 
     click.echo('Done!')
 
 
+def run_pipeline(ctx, push, jobs, rebuild=False, cache_from=True):
+    """
+    Builds (and pushes) all images of `images` in the config and prints a
+    summary with the critical path.
+    """
+    config = ctx.obj['config']
+    if not config.images:
+        click.secho("No `images` declared in the config file.", fg='yellow')
+        ctx.abort()
+
+    branch, commit, clean = utils.get_git_info()
+    try:
+        tasks = pipeline.plan(config, branch=branch, commit=commit)
+    except ValueError as e:
+        click.secho(str(e), fg='red')
+        ctx.abort()
+
+    click.secho("{action} images: \n\n{tags}\n".format(
+        action='Building and pushing' if push else 'Building',
+        tags='\n'.join(task.build_tag for task in tasks)), fg='cyan')
+    click.confirm('Do you want to continue?', abort=True)
+
+    def echo(task, step):
+        if task.failed and task.output:
+            click.secho(task.output, fg='red')
+        if step == 'push':
+            seconds = ' ({:.1f}s)'.format(task.push_end - task.push_start)
+        elif task.build_end:
+            seconds = ' ({:.1f}s)'.format(task.build_end - task.build_start)
+        else:
+            seconds = ''
+        click.secho("{name}: {step} {status}{reason}{seconds}".format(
+            name=task.name, step=step, status=task.status, seconds=seconds,
+            reason=' - {}'.format(task.reason) if task.reason else ''),
+            fg='red' if task.failed else 'green')
+
+    started = time.time()
+    pipeline.run(tasks, branch=branch, clean=clean, jobs=jobs, push=push, rebuild=rebuild,
+                 cache_from=cache_from, echo=echo)
+    total = time.time() - started
+
+    critical_path = pipeline.get_critical_path(tasks)
+    click.secho("Critical path ({total:.1f}s total):".format(total=total), fg='cyan')
+    for task in critical_path:
+        click.secho("  {name}: build {build:.1f}s{push}".format(
+            name=task.name, build=task.build_end - task.build_start,
+            push=', push {:.1f}s'.format(task.push_end - task.push_start) if task.push_end else ''))
+
+    if any(task.failed for task in tasks):
+        ctx.exit(1)
+    click.echo('Done!')
+
+
 @ueli.command()
-@click.confirmation_option(prompt='Are you sure you want to delete all docker images?')
-def delete_images():
+@click.option('--keep', default=3, show_default=True,
+              help='Number of most recent builds kept per service and branch')
+@click.option('--all', 'all_images', is_flag=True,
+              help='Delete all local docker images, not only old builds of the config')
+@click.option('--yes', is_flag=True, help="Don't ask before deleting all images with `--all`")
+@click.option('--dry-run', is_flag=True, help='Show what would be deleted')
+@click.pass_context
+def delete_images(ctx, keep, all_images, yes, dry_run):
     """
-    Delete all local docker images.
+    Delete old local images of the config.
+
+    Local builds (`{service}:{branch}.{commit}` and their remote tags) of
+    the images in the config are grouped by service and branch. The
+    `--keep` most recent ones of each branch are kept, as is the latest
+    pushed one, which `ueli build` uses as layer cache. Everything else is
+    deleted with batched `docker rmi` calls. Other images (e.g. base
+    images) are left alone.
     """
-    utils.run_local('docker rmi -f $(docker images -q)', verbose=True)
+    if all_images:
+        if not (yes or dry_run):
+            click.confirm('Are you sure you want to delete all docker images?', abort=True)
+        image_ids = utils.run_local(['docker', 'images', '-q'], verbose=True).split()
+        if not image_ids:
+            click.echo('No images to delete')
+            return
+        utils.run_local(['docker', 'rmi', '-f'] + sorted(set(image_ids)), verbose=True,
+                        execute=not dry_run)
+        return
+
+    config = ctx.obj['config']
+    services = set([config.service] + [image.name for image in config.images])
+
+    # Disk usage before is only needed to tell what was reclaimed
+    local_images, usage_before = executor.concurrently(
+        images.list_local_images,
+        lambda: None if dry_run else images.get_images_disk_usage())
+    plan = images.PrunePlan(local_images, services=services, keep=keep)
+
+    for service, branch, kept, deleted in plan.groups:
+        click.secho('{service} {branch}: {kept} kept, {deleted} to delete'.format(
+            service=service, branch=branch, kept=len(kept), deleted=len(deleted)), fg='cyan')
+        if ctx.obj['verbose'] or dry_run:
+            for tag in kept:
+                click.secho('  = {tag}'.format(tag=tag), fg='green')
+            for tag in deleted:
+                click.secho('  - {tag}'.format(tag=tag), fg='yellow')
+
+    if not plan.to_delete:
+        click.echo('No images to delete')
+        return
+    if dry_run:
+        click.echo('Would reclaim up to {size}'.format(
+            size=images.format_size(plan.get_reclaimable())))
+        return
+
+    def echo(cmd, returncode, output):
+        click.secho(u'$ docker rmi ({count} images)'.format(count=len(cmd) - 2), fg='magenta')
+        errors = [line for line in output.splitlines()
+                  if not line.startswith(('Untagged:', 'Deleted:'))]
+        if returncode != 0 and errors:
+            click.secho('\n'.join(errors), fg='yellow')
+
+    refs = [image.ref for image in plan.to_delete]
+    failed = images.remove_images(refs, echo=echo)
+    usage_after = images.get_images_disk_usage() if usage_before is not None else None
+    if usage_after is not None:
+        reclaimed = max(usage_before - usage_after, 0)
+    else:
+        # Without `docker system df` it's an estimate
+        reclaimed = plan.get_reclaimable()
+    click.secho('Deleted {count} image tags, reclaimed {size}'.format(
+        count=len(refs) - len(failed), size=images.format_size(reclaimed)), fg='green')
+    if failed:
+        click.secho('Not deleted, still in use by containers?\n\n{refs}\n'.format(
+            refs='\n'.join(failed)), fg='yellow')
+        ctx.exit(1)
 
 
 @ueli.command()
@@ -173,116 +491,537 @@ def delete_images():
 def set_credentials(ctx):
     """
     Setting the right gcloud cluster credentials for kubectl.
+
+    Skipped if the current kubectl context already points to the cluster
+    with a valid token and credentials were fetched within
+    `gcloud.credentials_ttl` seconds (default 3600). Use
+    `ueli --refresh-credentials` to fetch them anyway.
     """
+    # Once per invocation is enough, several commands invoke this one
+    if ctx.obj.get('credentials_set'):
+        return
+
+    require_config('gcloud.project', 'gcloud.cluster')
     config = ctx.obj['config']
-    gcloud_project = config['gcloud']['project']
-    gcloud_cluster = config['gcloud']['cluster']
-    cmd = ('gcloud container clusters get-credentials {gcloud_cluster} '
-           '--project={gcloud_project}').format(gcloud_cluster=gcloud_cluster,
-                                                gcloud_project=gcloud_project)
-    utils.run_local(cmd)
+    gcloud_project = config.gcloud.project
+    gcloud_cluster = config.gcloud.cluster
+    ttl = config.gcloud.credentials_ttl or credentials.DEFAULT_TTL
+
+    cache = credentials.CredentialCache()
+    if ctx.obj.get('refresh_credentials') or not cache.is_fresh(
+            project=gcloud_project, cluster=gcloud_cluster, ttl=ttl):
+        utils.run_local(['gcloud', 'container', 'clusters', 'get-credentials', gcloud_cluster,
+                         '--project={}'.format(gcloud_project)])
+        cache.mark_fetched(project=gcloud_project, cluster=gcloud_cluster)
+    ctx.obj['credentials_set'] = True
 
 
-def list_type(type, namespace=None):
-    namespace_option = '--namespace={}'.format(namespace) if namespace else ''
-    cmd = 'kubectl get {type} -o name {namespace_option}'.format(
-        type=type, namespace_option=namespace_option)
-    return utils.run_local(cmd).split('\n')
+def get_inventory():
+    """
+    Returns the cluster inventory of the current invocation. It's shared by
+    all commands so kubectl is called once instead of once per check.
+    """
+    ctx = click.get_current_context()
+    if 'inventory' not in ctx.obj:
+        ctx.obj['inventory'] = cluster.Inventory(client=get_kube_client())
+    return ctx.obj['inventory']
+
+
+def get_kube_client():
+    """
+    Returns the Kubernetes API client of the current invocation if the
+    config sets `kubernetes.backend: api`, or None to use kubectl. Falls
+    back to kubectl for kubeconfigs the client can't handle, so it has to
+    be called after `set_credentials`.
+    """
+    ctx = click.get_current_context()
+    if 'kube_client' not in ctx.obj:
+        client = None
+        if ctx.obj['config'].kubernetes.backend == 'api':
+            try:
+                client = kubeapi.get_client()
+            except kubeapi.UnsupportedConfig as e:
+                click.secho("Using kubectl, the API backend doesn't support {}".format(e),
+                            fg='yellow')
+        ctx.obj['kube_client'] = client
+    return ctx.obj['kube_client']
+
+
+def run_kube(cmd, request, dry_run=False):
+    """
+    Runs `request` with the API client if there is one, otherwise the
+    equivalent kubectl `cmd`. Both are echoed as kubectl command.
+    """
+    client = get_kube_client()
+    if client is None:
+        return utils.run_local(cmd, verbose=True, execute=not dry_run)
+    click.secho(u'$ {} (api)'.format(runner.format_cmd(cmd)), fg='magenta')
+    if not dry_run:
+        return request(client)
+
+
+def get_manifest_cache():
+    """
+    Returns the manifest cache of the current invocation.
+    """
+    ctx = click.get_current_context()
+    if 'manifest_cache' not in ctx.obj:
+        ctx.obj['manifest_cache'] = manifests.ManifestCache()
+    return ctx.obj['manifest_cache']
 
 
 def type_exists(type, name, namespace=None):
-    names = list_type(type=type, namespace=namespace)
-    return '{type}/{name}'.format(type=type, name=name) in names
+    return get_inventory().exists(kind=type, name=name, namespace=namespace)
+
+
+def get_environments():
+    names = get_inventory().names(kind='namespace')
+    return [name for name in names if name not in environments.SYSTEM_NAMESPACES]
+
+
+def get_managed_environments():
+    """
+    Returns the environments created by `ueli apply`, the ones `ueli
+    list-environments` shows.
+    """
+    inventory = get_inventory()
+    return [name for name in get_environments()
+            if environments.is_managed(inventory.get('namespace', name=name))]
+
+
+def match_environments(pattern, existing, managed):
+    """
+    Returns the `managed` environments matching a glob `pattern`, except
+    protected ones like production, or the pattern itself if it has no
+    wildcards and exists.
+    """
+    if not any(c in pattern for c in '*?['):
+        return [pattern] if pattern in existing else []
+    matches = [env for env in managed if fnmatch.fnmatchcase(env, pattern)]
+    return [env for env in matches if env not in environments.PROTECTED_ENVIRONMENTS]
+
+
+def format_table(rows):
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    return ['  '.join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip()
+            for row in rows]
 
 
 @ueli.command()
+@click.option('--age', 'show_age', is_flag=True,
+              help='Show age of the environments and time since the last deploy')
+@click.option('--tag', 'show_tag', is_flag=True, help='Show the deployed tag of the service')
+@click.option('--older-than', metavar='DURATION',
+              help='Only environments not deployed to (or created, if never deployed) '
+                   'within DURATION, e.g. 12h or 7d')
+@click.option('--all', 'all_namespaces', is_flag=True,
+              help='Include namespaces not created by `ueli apply`')
+@click.option('--chunk-size', default=500, show_default=True,
+              help='Number of namespaces fetched per request')
 @click.pass_context
-def list_environments(ctx):
-    ctx.invoke(set_credentials)
+def list_environments(ctx, show_age, show_tag, older_than, all_namespaces, chunk_size):
+    """
+    List environments, i.e. namespaces created by `ueli apply`.
 
-    envs = list_type(type='namespace')
-    filters = ['namespace/default', 'namespace/kube-system']
-    filtered = [env.replace('namespace/', '') for env in envs if not any(f == env for f in filters)]
-    click.secho("{} available environments".format(len(filtered)), fg='cyan')
-    click.secho("\n".join(filtered), fg='green')
+    Namespaces are filtered by label on the server and printed page by
+    page while they arrive. Use `--older-than` to find stale environments.
+    If no namespace has the label yet, e.g. environments created by older
+    ueli versions, all namespaces are listed.
+    """
+    try:
+        max_age = environments.parse_duration(older_than) if older_than else None
+    except ValueError as e:
+        click.secho(str(e), fg='red')
+        ctx.abort()
+
+    ctx.invoke(set_credentials)
+    service = ctx.obj['config'].service
+    selector = None if all_namespaces else environments.MANAGED_SELECTOR
+    now = time.time()
+    count = [0]
+    listed = [0]
+
+    def echo(env):
+        if env is None:
+            return
+        listed[0] += 1
+        if max_age is not None:
+            if env.last_active is None or now - env.last_active < max_age:
+                return
+        count[0] += 1
+        # Pages are printed as they arrive, so columns have fixed widths
+        columns = [env.name.ljust(40)]
+        if show_age:
+            columns.append(environments.format_age(env.age(now)).ljust(8))
+            columns.append(environments.format_age(
+                now - env.deployed if env.deployed else None).ljust(8))
+        if show_tag:
+            columns.append(env.tag or '-')
+        click.secho('  '.join(columns).rstrip(), fg='green')
+
+    header = ['NAME'.ljust(40)]
+    if show_age:
+        header += ['AGE'.ljust(8), 'DEPLOYED'.ljust(8)]
+    if show_tag:
+        header.append('TAG')
+    if show_age or show_tag:
+        click.secho('  '.join(header).rstrip(), fg='cyan')
+
+    def list_namespaces(selector):
+        client = get_kube_client()
+        if client is not None:
+            for namespace in client.list('namespace', label_selector=selector,
+                                         limit=chunk_size):
+                echo(environments.from_namespace(namespace, service=service))
+        else:
+            cmd = environments.get_list_cmd(service=service, chunk_size=chunk_size,
+                                            selector=selector)
+            utils.run_local(cmd, on_line=lambda line: echo(environments.parse_row(line)))
+
+    list_namespaces(selector)
+    if selector and not listed[0]:
+        click.secho("No namespace is labeled as environment, listing all. `ueli apply "
+                    "ENVIRONMENT` labels them.", fg='yellow')
+        list_namespaces(None)
+    click.secho("{} available environments".format(count[0]), fg='cyan')
 
 
 @ueli.command()
 @click.argument('environment')
 @click.option('--dry-run', is_flag=True, help="Don't create anything")
+@click.option('-j', '--jobs', default=4, show_default=True,
+              help='Number of manifests applied concurrently')
+@click.option('--batch', is_flag=True,
+              help='Apply manifests of the same kind with one kubectl call')
+@click.option('--full', is_flag=True,
+              help='Apply all manifests, also the ones unchanged since the last apply')
 @click.pass_context
-def apply(ctx, environment, dry_run):
+def apply(ctx, environment, dry_run, jobs, batch, full):
     """
     Create a new environment.
+
+    Namespace and configmap are created first, manifests are then applied
+    by kind (configs and secrets, services, deployments and everything
+    else). Manifests of the same kind are applied concurrently.
+
+    Only manifests which changed since they were last applied to the
+    environment are applied again. Their content hashes are kept in the
+    configmap `SERVICE-ueli-state` of the environment.
     """
-    clean, config_keys, secret_keys = ctx.invoke(inspect_deployments)
-    if not clean:
+    analysis = ctx.invoke(inspect_deployments)
+    if not analysis.clean:
         ctx.abort()
 
     config = ctx.obj['config']
-    service = config['service']
+    service = config.service
     ctx.invoke(set_credentials)
 
+    # Hashes of the last apply are in a configmap, they come with the
+    # inventory. Namespaces and the environment's resources are fetched
+    # together.
+    inventory = get_inventory()
+    inventory.load(namespaces=[environment])
+    state_name = utils.get_state_name(service=service)
+    state = inventory.get('configmap', name=state_name, namespace=environment)
+
     # Create namespace if not exists
-    if not type_exists(type='namespace', name=environment):
-        utils.run_local('kubectl create namespace {}'.format(environment),
-                        verbose=True, execute=not dry_run)
+    namespace = inventory.get('namespace', name=environment)
+    if namespace is None:
+        # Through the API it's labeled right away, kubectl can't create
+        # labeled namespaces
+        namespace = run_kube(['kubectl', 'create', 'namespace', environment],
+                             lambda client: client.create(
+                                 environments.get_namespace_manifest(environment)),
+                             dry_run=dry_run)
+        if not dry_run:
+            # kubectl only tells what it created
+            if not isinstance(namespace, dict):
+                namespace = {'apiVersion': 'v1', 'kind': 'Namespace',
+                             'metadata': {'name': environment}}
+            inventory.add(namespace)
+
+    # Label it as environment for `ueli list_environments`, also namespaces
+    # created before ueli labeled them
+    if not environments.is_managed(namespace):
+        run_kube(environments.get_label_cmd(environment),
+                 lambda client: client.merge_patch('namespace', environment,
+                                                   environments.get_label_patch()),
+                 dry_run=dry_run)
 
     # Create configmap if not exists
     config_name = utils.get_config_name(service=service)
     if not type_exists(type='configmap', name=config_name, namespace=environment):
-        cmd = 'kubectl create configmap {name} --namespace={environment}'.format(
-            name=config_name, environment=environment)
-        utils.run_local(cmd, verbose=True, execute=not dry_run)
-
-    # Apply k8s files
-    deployments = config['deployments']
-    for deployment in deployments:
-        for to_apply in deployment['apply']:
-            cmd = 'kubectl apply -f {to_apply} --namespace={environment}'.format(
-                environment=environment, to_apply=to_apply)
-            utils.run_local(cmd, verbose=True, execute=not dry_run)
-
-    if len(config_keys) > 0:
+        config_map = {'apiVersion': 'v1', 'kind': 'ConfigMap',
+                      'metadata': {'name': config_name, 'namespace': environment}}
+        run_kube(['kubectl', 'create', 'configmap', config_name,
+                  '--namespace={}'.format(environment)],
+                 lambda client: client.create(config_map),
+                 dry_run=dry_run)
+        if not dry_run:
+            inventory.add(config_map)
+
+    plan = cluster.ApplyPlan(analysis.to_apply(), hashes=analysis.hashes(),
+                             applied=cluster.get_applied_hashes(state), full=full)
+    echo_plan(plan, verbose=ctx.obj['verbose'])
+
+    # Apply k8s files, ordered by kind so e.g. services exist before the
+    # deployments using them
+    def echo(result):
+        click.secho(u'$ {}'.format(result.format_cmd()), fg='magenta')
+        if result.output:
+            click.secho(result.output, fg='green' if result.ok else 'red')
+
+    results = cluster.apply_manifests(plan.to_apply, namespace=environment, jobs=jobs,
+                                      batch=batch, execute=not dry_run,
+                                      echo=None if dry_run else echo)
+    if dry_run:
+        for result in results:
+            click.secho(u'$ {}'.format(result.format_cmd()), fg='magenta')
+    elif results:
+        returncode, output = cluster.save_applied_hashes(
+            state_name, namespace=environment, hashes=plan.get_state(results),
+            client=get_kube_client())
+        if returncode != 0:
+            click.secho("Failed to save state, the next apply applies everything again: "
+                        "{}".format(output), fg='yellow')
+
+    failed = [f for result in results if not result.ok for f in result.files]
+    if failed:
+        skipped = [f for result in results if not result.executed for f in result.files]
+        click.secho("Failed to apply: \n\n{files}\n".format(files='\n'.join(failed)), fg='red')
+        if skipped:
+            click.secho("Skipped: \n\n{files}\n".format(files='\n'.join(skipped)), fg='yellow')
+        ctx.exit(1)
+
+    if len(analysis.config_keys) > 0:
         click.secho("Don't forget to update config with "
                     "`ueli config {environment}`: \n\n{keys}\n".format(
-                        environment=environment, keys='\n'.join(config_keys)),
+                        environment=environment, keys='\n'.join(analysis.config_keys)),
                     fg='cyan')
 
-    if len(secret_keys) > 0:
+    if len(analysis.secret_keys) > 0:
         click.secho("Don't forget to update secrets: \n\n{keys}\n".format(
-            keys='\n'.join(secret_keys)), fg='cyan')
+            keys='\n'.join(analysis.secret_keys)), fg='cyan')
 
     click.echo('Done!')
 
 
+def echo_plan(plan, verbose=False):
+    """
+    Prints which manifests are applied and why, unchanged ones only if
+    `verbose`.
+    """
+    click.secho("{count} manifests to apply, {unchanged} unchanged".format(
+        count=len(plan.to_apply), unchanged=len(plan.unchanged)), fg='cyan')
+    for path, kinds in plan.to_apply:
+        change = plan.changes.get(path, 'unchanged')
+        click.secho(u'  {sign} {path} ({change})'.format(
+            sign={'new': '+', 'changed': '~'}.get(change, '='), path=path, change=change),
+            fg='yellow' if change in plan.changes else 'green')
+    if verbose:
+        for path in plan.unchanged:
+            click.secho(u'  = {path} (unchanged, skipped)'.format(path=path), fg='green')
+
+
 @ueli.command()
-@click.argument('environment')
+@click.argument('environment', nargs=-1, required=True)
+@click.option('--set', 'assignments', multiple=True, metavar='KEY=VALUE',
+              help='Key to set, can be given several times')
+@click.option('--unset', multiple=True, metavar='KEY',
+              help='Key to remove, can be given several times')
+@click.option('--from-file', type=click.Path(exists=True, dir_okay=False), default=None,
+              help='Keys to set from an env file (KEY=VALUE lines) or a YAML mapping')
+@click.option('--check', is_flag=True,
+              help="Only report missing and unused keys, don't open the editor")
+@click.option('--dry-run', is_flag=True, help="Show the changes without writing them")
+@click.option('-j', '--jobs', default=4, show_default=True,
+              help='Number of environments written concurrently')
 @click.pass_context
-def config(ctx, environment):
+def config(ctx, environment, assignments, unset, from_file, check, dry_run, jobs):
     """
-    Opens config map edit from kubectl
+    Updates the config map of environments.
+
+    Without changes to make, opens the config map of a single ENVIRONMENT
+    in the kubectl editor. With `--set`, `--unset` or `--from-file` the
+    changes are written to all given environments, with one replace per
+    environment. ENVIRONMENT can be several environments and glob
+    patterns, e.g. `stage1 stage2` or `'stage*'`. Patterns only match
+    environments created by `ueli apply` and never production, which has
+    to be named.
+
+    Keys referenced by the manifests but missing in a config map are
+    reported, as are keys no manifest references.
     """
     config = ctx.obj['config']
-    service = config['service']
-    ctx.invoke(set_credentials)
-
+    service = config.service
+    patterns = [pattern.strip() for value in environment for pattern in value.split(',')
+                if pattern.strip()]
     config_name = utils.get_config_name(service=service)
-    cmd = 'kubectl edit configmap {name} --namespace={environment}'.format(
-        name=config_name, environment=environment)
-    utils.run_local(cmd, output=False, verbose=True)
+
+    values = {}
+    try:
+        if from_file:
+            values.update(configmaps.load_values(from_file))
+        values.update(configmaps.parse_assignment(value) for value in assignments)
+    except ValueError as e:
+        click.secho("Invalid config values{source}: {error}".format(
+            source=" in '{}'".format(from_file) if from_file else '', error=e), fg='red')
+        ctx.abort()
+    edit = not (from_file or assignments or unset or check)
+
+    if edit:
+        if len(patterns) != 1 or any(c in patterns[0] for c in '*?['):
+            click.secho("Only one environment can be edited at a time, use `--set`, `--unset` "
+                        "or `--from-file` to change several.", fg='yellow')
+            ctx.abort()
+        ctx.invoke(set_credentials)
+        cmd = ['kubectl', 'edit', 'configmap', config_name,
+               '--namespace={}'.format(patterns[0])]
+        utils.run_local(cmd, output=False, verbose=True)
+        return
+
+    def check_environments():
+        ctx.invoke(set_credentials)
+        return get_environments(), get_managed_environments()
+
+    # The manifests are parsed while the cluster is asked for environments,
+    # config maps of the targets are then fetched together
+    (existing, managed), analysis = executor.concurrently(
+        check_environments, lambda: manifests.analyze(config, cache=get_manifest_cache()))
+
+    targets = []
+    for pattern in patterns:
+        matches = match_environments(pattern, existing, managed)
+        if not matches:
+            click.secho("Environment '{environment}' doesn't exist. Use `ueli "
+                        "list_environments` to see which one exists or `ueli apply NAME` "
+                        "to create one.".format(environment=pattern), fg='yellow')
+            ctx.abort()
+        targets.extend(env for env in matches if env not in targets)
+
+    get_inventory().load(namespaces=targets)
+    changes = [configmaps.ConfigChange(config_name, namespace=env,
+                                       current=get_inventory().get('configmap', name=config_name,
+                                                                   namespace=env),
+                                       values=values, unset=unset)
+               for env in targets]
+    prefix = len(targets) > 1
+    for change in changes:
+        echo_config_change(change, analysis, prefix=prefix, check=check)
+    if analysis.config_used_whole:
+        click.secho("'{name}' is used as a whole (volume or envFrom), unused keys can't be "
+                    "told.".format(name=config_name), fg='yellow')
+
+    to_write = [change for change in changes if change.dirty and not check]
+    if to_write and not dry_run:
+        click.confirm('Write {count} config map(s)?'.format(count=len(to_write)), abort=True)
+
+    client = get_kube_client()
+
+    def write(change):
+        click.secho(u'$ {cmd}{api}'.format(cmd=runner.format_cmd(change.get_cmd()),
+                                           api=' (api)' if client else ''), fg='magenta')
+        if dry_run:
+            return change, None, ''
+        returncode, output = change.write(client=client)
+        if returncode != 0:
+            click.secho('{env}: {output}'.format(env=change.namespace, output=output.strip()),
+                        fg='red')
+        return change, returncode, output
+
+    results = executor.concurrently(
+        *[lambda change=change: write(change) for change in to_write], jobs=jobs)
+    returncodes = dict((change.namespace, returncode) for change, returncode, output in results)
+
+    rows = []
+    for change in changes:
+        if change.namespace not in returncodes:
+            status = 'unchanged'
+        elif returncodes[change.namespace] is None:
+            status = 'dry run'
+        elif returncodes[change.namespace] == 0:
+            status = 'updated'
+        else:
+            status = 'failed'
+        rows.append((change.namespace, status,
+                     str(len(change.added) + len(change.changed) + len(change.removed)),
+                     str(len(change.missing(analysis))), str(len(change.unused(analysis)))))
+
+    if prefix:
+        table = format_table([('ENVIRONMENT', 'STATUS', 'CHANGES', 'MISSING', 'UNUSED')] + rows)
+        click.echo()
+        click.secho(table[0], fg='cyan')
+        for line, row in zip(table[1:], rows):
+            click.secho(line, fg='red' if row[1] == 'failed' or row[3] != '0' else 'green')
+
+    if any(row[1] == 'failed' for row in rows) or (check and any(row[3] != '0' for row in rows)):
+        ctx.exit(1)
+
+    click.echo('Done!')
+
+
+def echo_config_change(change, analysis, prefix=False, check=False):
+    """
+    Prints the keys a config change adds, changes and removes, then the
+    keys missing and unused afterwards.
+    """
+    indent = '  ' if prefix else ''
+    if prefix:
+        click.secho('{env}:'.format(env=change.namespace), fg='cyan')
+    if change.current is None and not check:
+        click.secho(u'{indent}+ {name} (new config map)'.format(
+            indent=indent, name=change.name), fg='yellow')
+    for sign, keys in (('+', change.added), ('~', change.changed), ('-', change.removed)):
+        for key in keys:
+            click.secho(u'{indent}{sign} {key}'.format(indent=indent, sign=sign, key=key),
+                        fg='yellow')
+    for key in change.missing(analysis):
+        click.secho(u'{indent}! {key} (missing)'.format(indent=indent, key=key), fg='red')
+    for key in change.unused(analysis):
+        click.secho(u'{indent}? {key} (unused)'.format(indent=indent, key=key), fg='white')
+
+
+def get_remote_refs():
+    ctx = click.get_current_context()
+    ttl = ctx.obj['config'].git.remote_refs_ttl
+    return git.RemoteRefCache(ttl=git.REMOTE_REFS_TTL if ttl is None else ttl)
 
 
 @ueli.command()
-@click.argument('branch')
+@click.argument('branch', required=False)
+@click.option('--all', 'all_branches', is_flag=True,
+              help='List all branches and their latest commit')
+@click.option('--refresh', is_flag=True,
+              help='Always ask the remote repository, ignoring recently fetched branches')
 @click.pass_context
-def latest(ctx, branch):
+def latest(ctx, branch, all_branches, refresh):
+    """
+    Show the latest commit of BRANCH on the remote repository, which is
+    what `ueli deploy` deploys.
+
+    All branches are fetched with one `git ls-remote` and remembered for
+    a short time (`git.remote_refs_ttl` in the config, 30 seconds by
+    default), so scripted and repeated deploys don't ask the git server
+    every time.
+    """
+    require_config('repository')
     config = ctx.obj['config']
-    repo = config['repository']
-    cmd = 'git ls-remote {repo} {branch}'.format(repo=repo, branch=branch)
-    commit = utils.run_local(cmd, verbose=True)
+    refs = get_remote_refs()
+
+    if all_branches:
+        heads = refs.get_heads(config.repository, refresh=refresh, verbose=True)
+        rows = [(name, heads[name][:git.SHORT_COMMIT_LENGTH]) for name in sorted(heads)]
+        for line in format_table([('BRANCH', 'COMMIT')] + rows):
+            click.echo(line)
+        return None
+
+    if not branch:
+        click.secho('Missing argument BRANCH (or use --all)', fg='yellow')
+        ctx.abort()
+
+    commit = refs.resolve(config.repository, branch, refresh=refresh, verbose=True)
     if commit:
-        short = commit[:7]
+        short = commit[:git.SHORT_COMMIT_LENGTH]
         click.secho("Latest commit on '{branch}' available for deploy is '{commit}'".format(
             branch=branch, commit=short))
         return short
@@ -292,55 +1031,157 @@ def latest(ctx, branch):
 @ueli.command()
 @click.argument('environment')
 @click.argument('branch', default='master')
+@click.option('--timeout', default=300, show_default=True,
+              help='Seconds to wait for all deployments to become ready')
+@click.option('--no-rollback', is_flag=True,
+              help="Don't roll back deployments if a rollout fails or times out")
+@click.option('-j', '--jobs', default=4, show_default=True,
+              help='Number of environments deployed concurrently')
 @click.pass_context
-def deploy(ctx, environment, branch):
+def deploy(ctx, environment, branch, timeout, no_rollback, jobs):
     """
     Deploy specific image tag.
-    """
-    ctx.invoke(set_credentials)
 
-    if not type_exists(type='namespace', name=environment):
-        click.secho("Can not deploy to '{environment}', environment doesn't "
-                    "exist. Use `ueli list_environments` to see which one "
-                    "exists or `ueli apply NAME` to create "
-                    "one.".format(environment=environment), fg='yellow')
-        ctx.abort()
+    All containers of the configured deployments running an image of the
+    service are updated with one batched call, then the rollouts are
+    watched until they're ready. If any of them fails or doesn't finish
+    within `--timeout` seconds, all deployments are set back to their
+    previous images.
 
+    ENVIRONMENT can be a comma separated list of environments and glob
+    patterns, e.g. `stage1,stage2` or `'stage*'`, to deploy to several
+    environments at once. Patterns only match environments created by
+    `ueli apply` and never production, which has to be named.
+    """
+    require_config('repository', 'gcloud.project', 'gcloud.registry', 'gcloud.cluster')
     config = ctx.obj['config']
-    service = config['service']
+    service = config.service
+    patterns = [pattern.strip() for pattern in environment.split(',') if pattern.strip()]
+
+    def check_environments():
+        ctx.invoke(set_credentials)
+        return get_environments(), get_managed_environments()
+
+    # Listing environments needs cluster credentials, looking up the commit
+    # on the remote repository doesn't, so both run at the same time. Both
+    # are shared by all environments.
+    (existing, managed), commit = executor.concurrently(
+        check_environments, lambda: ctx.invoke(latest, branch=branch))
+
+    targets = []
+    for pattern in patterns:
+        matches = match_environments(pattern, existing, managed)
+        if not matches:
+            click.secho("Can not deploy to '{environment}', environment doesn't "
+                        "exist. Use `ueli list_environments` to see which one "
+                        "exists or `ueli apply NAME` to create "
+                        "one.".format(environment=pattern), fg='yellow')
+            ctx.abort()
+        targets.extend(env for env in matches if env not in targets)
 
     # Special handling for production
-    if environment == 'production' and branch != 'master':
+    if 'production' in targets and branch != 'master':
         click.secho("Only 'master' can be deployed to 'production'.", fg='yellow')
         ctx.abort()
 
-    commit = ctx.invoke(latest, branch=branch)
     if not commit:
         click.secho("No commit for '{branch}' found on remote repository. `git push`?".format(
             branch=branch), fg='yellow')
         ctx.abort()
 
+    tag_name = utils.get_tag_name(branch=branch, commit=commit)
     build_tag = utils.get_build_tag(service=service, branch=branch, commit=commit)
-    click.secho("Deploying '{build_tag}' to '{environment}'".format(
-        build_tag=build_tag, environment=environment), fg='cyan')
+    click.secho("Deploying '{build_tag}' to {environments}".format(
+        build_tag=build_tag, environments=', '.join("'{}'".format(env) for env in targets)),
+        fg='cyan')
     click.confirm('Do you want to continue?', abort=True)
 
-    # remote = '{registry}/{project}'.format(registry=config['gcloud']['registry'],
-    #                                        project=config['gcloud']['project'])
-
-    # remote_tag = '{remote}/{build_tag}'.format(remote=remote, build_tag=build_tag)
+    names = [deployment.name for deployment in config.deployments]
+    repository = images.get_repository(config)
+    remote_tag = utils.get_remote_tag(config=config, build_tag=build_tag)
+    prefix = len(targets) > 1
+    client = get_kube_client()
+
+    def deploy_environment(env):
+        def echo(result):
+            name = '{env}/{name}'.format(env=env, name=result.name) if prefix else result.name
+            if result.ok:
+                seconds = result.seconds
+                click.secho("{name}: ready{time}{message}".format(
+                    name=name,
+                    time=' after {:.1f}s'.format(seconds) if seconds else '',
+                    message=' ({})'.format(result.message) if result.message else ''),
+                    fg='green')
+            else:
+                click.secho("{name}: {status} ({message})".format(
+                    name=name, status=result.status, message=result.message), fg='red')
+
+        # Deployments of each environment are fetched by the inventory once,
+        # environments deployed concurrently fetch them concurrently
+        deployments = dict((name, get_inventory().get('deployment', name=name, namespace=env))
+                           for name in names)
+        start = time.time()
+        try:
+            rollouts = rollout.deploy(deployments, names=names, namespace=env,
+                                      repository=repository, image=remote_tag,
+                                      timeout=timeout, rollback=not no_rollback, echo=echo,
+                                      client=client)
+        except (runner.CommandError, kubeapi.ApiError) as e:
+            click.secho('{env}: {error}'.format(env=env, error=e), fg='red')
+            rollouts = None
+
+        # Remembered on the namespace for `ueli list_environments --tag`
+        if rollouts is not None and all(r.ok for r in rollouts):
+            if client is not None:
+                try:
+                    client.merge_patch('namespace', env, environments.get_annotate_patch(
+                        service=service, tag=tag_name))
+                    returncode, output = 0, ''
+                except kubeapi.ApiError as e:
+                    returncode, output = 1, str(e)
+            else:
+                cmd = environments.get_annotate_cmd(env, service=service, tag=tag_name)
+                returncode, output = utils.run_captured(cmd)
+            if returncode != 0:
+                click.secho('{env}: Failed to annotate namespace: {output}'.format(
+                    env=env, output=output), fg='yellow')
+        return env, rollouts, time.time() - start
+
+    results = executor.concurrently(
+        *[lambda env=env: deploy_environment(env) for env in targets], jobs=jobs)
+
+    failed = False
+    rows = []
+    for env, rollouts, seconds in results:
+        if rollouts is None:
+            status = 'error'
+        elif all(r.ok for r in rollouts):
+            status = 'deployed'
+        elif any(r.status == 'rolled back' for r in rollouts):
+            status = 'rolled back'
+        else:
+            status = 'failed'
+        failed = failed or status != 'deployed'
+        ready = sum(1 for r in rollouts or [] if r.ok)
+        rows.append((env, status, '{}/{}'.format(ready, len(names)),
+                     '{:.1f}s'.format(seconds)))
+
+        rolled_back = [r.name for r in rollouts or [] if r.status == 'rolled back']
+        if rolled_back and not prefix:
+            click.secho("Rolled back {names} to their previous images.".format(
+                names=', '.join(rolled_back)), fg='yellow')
+
+    if prefix:
+        table = format_table([('ENVIRONMENT', 'STATUS', 'READY', 'TIME')] + rows)
+        click.echo()
+        click.secho(table[0], fg='cyan')
+        for line, row in zip(table[1:], rows):
+            click.secho(line, fg='green' if row[1] == 'deployed' else 'red')
+
+    if failed:
+        ctx.exit(1)
 
-    # deployments = config['deployments']
-    # for deployment in deployments:
-    #     container_name = project
-    #     cmd = ('kubectl --namespace={namespace} set image deployment/{deployment} '
-    #            '{container_name}={remote_tag}'.format(
-    #                namespace=namespace,
-    #                deployment=deployment,
-    #                container_name=container_name,
-    #                remote_tag=remote_tag))
-    #     click.secho(cmd)
-    #     utils.run_local(cmd)
+    click.echo('Done!')
 
 
 # @click.group()
@@ -469,76 +1310,120 @@ def inspect_deployments(ctx):
     """
     Goes through all k8s files and checks for naming and collects config keys.
 
-    TODO (silvan): clean up this messy shitty code... you can better
+    Entries of `deployments[].apply` can be files, directories or globs and
+    files can contain several documents.
     """
     config = ctx.obj['config']
-    service = config['service']
-    deployments = config['deployments']
+    analysis = manifests.analyze(config, cache=get_manifest_cache())
 
-    warnings = set()
+    click.secho("{} wrong namings".format(len(analysis.warnings)), fg='cyan')
+    click.secho("{msg}".format(msg='\n'.join(analysis.warnings)), fg='yellow')
 
-    config_name = utils.get_config_name(service=service)
-    config_keys = set()
-
-    secret_name = utils.get_secret_name(service=service)
-    secret_keys = set()
-
-    for deployment in deployments:
-
-        if not deployment['name'].startswith(service):
-            warnings.add("Ueli config deployment name '{name}' doesn't start "
-                         "with {service}".format(name=deployment['name'],
-                                                 service=service))
-
-        for to_apply in deployment['apply']:
-            data = utils.load_yaml_file(path=to_apply)
-            if data:
-                names = []
-                names.append(data['metadata']['name'])
-                if 'template' in data['spec'].keys():
-                    names.append(data['spec']['template']['metadata']['labels']['name'])
-
-                    # get configs and secrets used as volumes
-                    if 'volumes' in data['spec']['template']['spec'].keys():
-                        for volume in data['spec']['template']['spec']['volumes']:
-                            if 'configMap' in volume.keys():
-                                config_keys.add(volume['configMap']['name'])
-                            if 'secret' in volume.keys():
-                                secret_keys.add(volume['secret']['secretName'])
-
-                    # get configs and secrets used in container ENVS
-                    if 'containers' in data['spec']['template']['spec'].keys():
-                        for container in data['spec']['template']['spec']['containers']:
-                            if 'env' in container.keys():
-                                for e in container['env']:
-                                    if 'valueFrom' in e.keys():
-                                        if 'configMapKeyRef' in e['valueFrom'].keys():
-                                            if e['valueFrom']['configMapKeyRef']['name'] == config_name:
-                                                config_keys.add(e['valueFrom']['configMapKeyRef']['key'])
-                                        if 'secretKeyRef' in e['valueFrom'].keys():
-                                            if e['valueFrom']['secretKeyRef']['name'] == secret_name:
-                                                secret_keys.add(e['valueFrom']['secretKeyRef']['key'])
-
-                # check correct name naming
-                for name in names:
-                    if not name.startswith(service):
-                        warnings.add("{to_apply}: Name '{name}' doesn't start "
-                                     "with {service}".format(to_apply=to_apply,
-                                                             name=name,
-                                                             service=service))
-
-    click.secho("{} wrong namings".format(len(warnings)), fg='cyan')
-    click.secho("{msg}".format(msg='\n'.join(warnings)), fg='yellow')
-
-    click.secho("{} config keys".format(len(config_keys)), fg='cyan')
-    click.secho("{keys}".format(keys='\n'.join(config_keys)), fg='green')
-
-    click.secho("{} secret keys".format(len(secret_keys)), fg='cyan')
-    click.secho("{keys}".format(keys='\n'.join(secret_keys)), fg='green')
-
-    clean = len(warnings) <= 0
-    return clean, config_keys, secret_keys
+    click.secho("{} config keys".format(len(analysis.config_keys)), fg='cyan')
+    click.secho("{keys}".format(keys='\n'.join(analysis.config_keys)), fg='green')
+
+    click.secho("{} secret keys".format(len(analysis.secret_keys)), fg='cyan')
+    click.secho("{keys}".format(keys='\n'.join(analysis.secret_keys)), fg='green')
+    return analysis
+
+
+def format_usage(item):
+    return (item.path, ','.join(item.deployments), item.container or '(volume)')
+
+
+@ueli.command()
+@click.argument('key')
+@click.pass_context
+def where_used(ctx, key):
+    """
+    Shows which manifests use a config or secret key.
+
+    Lists every manifest file, deployment and container referencing KEY of
+    a config map or secret, and the ones using the config map or secret of
+    the service as a whole (volumes, `envFrom`), which get KEY as well if
+    it's in there. Answered from the manifest cache, only files changed
+    since the last call are parsed again. Exits with 1 if KEY isn't used.
+    """
+    config = ctx.obj['config']
+    analysis = manifests.analyze(config, cache=get_manifest_cache())
+    index = usage.UsageIndex(analysis)
+
+    usages = index.where_used(key)
+    rows = [('{}/{}'.format(u.kind, u.name),) + format_usage(u) for u in usages]
+    for kind, name in (('configmap', analysis.config_name), ('secret', analysis.secret_name)):
+        rows.extend(('{}/{} (all keys)'.format(u.kind, u.name),) + format_usage(u)
+                    for u in index.where_used_whole(kind, name))
+
+    if not rows:
+        click.secho("No manifest uses '{key}'.".format(key=key), fg='yellow')
+        ctx.exit(1)
+
+    table = format_table([('SOURCE', 'FILE', 'DEPLOYMENT', 'CONTAINER')] + rows)
+    click.secho(table[0], fg='cyan')
+    for line, row in zip(table[1:], rows):
+        click.secho(line, fg='yellow' if row[0].endswith('(all keys)') else 'green')
+    if not usages:
+        ctx.exit(1)
+
+
+@ueli.command()
+@click.argument('environment')
+@click.pass_context
+def unused_keys(ctx, environment):
+    """
+    Lists keys of an environment's config map no manifest uses.
+
+    The keys of the live config map are checked against the keys the
+    manifests use (see `ueli where-used`). If the config map is used as
+    a whole (volumes, `envFrom`) its keys can't be told unused. Exits with
+    1 if there are unused keys.
+    """
+    config = ctx.obj['config']
+
+    def get_config_map():
+        ctx.invoke(set_credentials)
+        inventory = get_inventory()
+        inventory.load(namespaces=[environment])
+        if not inventory.exists('namespace', name=environment):
+            return None, False
+        return inventory.get('configmap', name=utils.get_config_name(service=config.service),
+                             namespace=environment), True
+
+    # The manifests are parsed while the cluster is asked for the config map
+    (config_map, exists), analysis = executor.concurrently(
+        get_config_map, lambda: manifests.analyze(config, cache=get_manifest_cache()))
+    if not exists:
+        click.secho("Environment '{environment}' doesn't exist. Use `ueli list_environments` "
+                    "to see which one exists.".format(environment=environment), fg='yellow')
+        ctx.abort()
+    if config_map is None:
+        click.secho("There is no config map '{name}' in '{environment}', `ueli apply "
+                    "{environment}` creates it.".format(name=analysis.config_name,
+                                                        environment=environment),
+                    fg='yellow')
+        ctx.abort()
+
+    index = usage.UsageIndex(analysis)
+    whole = index.where_used_whole('configmap', analysis.config_name)
+    if whole:
+        click.secho("'{name}' is used as a whole (volume or envFrom), unused keys can't be "
+                    "told:".format(name=analysis.config_name), fg='yellow')
+        for line in format_table([format_usage(u) for u in whole]):
+            click.secho('  ' + line, fg='yellow')
+        return
+
+    used = index.used_keys('configmap', analysis.config_name)
+    unused = sorted(set(config_map.get('data') or {}) - used)
+    click.secho("{count} unused keys in '{name}' of '{environment}'".format(
+        count=len(unused), name=analysis.config_name, environment=environment), fg='cyan')
+    if unused:
+        click.secho('\n'.join(unused), fg='yellow')
+        ctx.exit(1)
 
 
 def main():
-    ueli(obj={})
+    # The group callback runs before click parses the options of a
+    # subcommand, so `ueli status --help` has to be detected here
+    help_requested = any(arg in CONTEXT_SETTINGS['help_option_names']
+                         for arg in sys.argv[1:])
+    ueli(obj={'help_requested': help_requested})
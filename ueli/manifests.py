@@ -0,0 +1,385 @@
+import concurrent.futures
+import glob
+import hashlib
+import os
+import os.path
+import time
+import yaml
+
+from ueli import timings, utils
+
+
+CACHE_FILE_NAME = 'manifests.json'
+CACHE_VERSION = 2
+CACHE_MAX_ENTRIES = 4096
+# Seconds after which the last use of an unchanged entry is updated
+CACHE_TOUCH_INTERVAL = 24 * 60 * 60
+
+# File extensions `kubectl apply -f DIRECTORY` picks up
+MANIFEST_EXTENSIONS = ('.yaml', '.yml', '.json')
+
+# Below this number of files to parse, starting worker processes costs more
+# than it saves
+PARALLEL_THRESHOLD = 32
+
+
+def get_pod_spec(data):
+    """
+    Returns the pod template metadata and pod spec of pods, pod controllers
+    (deployments, jobs, ...) and cron jobs.
+    """
+    spec = data.get('spec') or {}
+    if data.get('kind') == 'Pod':
+        return data.get('metadata') or {}, spec
+    if 'jobTemplate' in spec:
+        spec = (spec['jobTemplate'] or {}).get('spec') or {}
+    template = spec.get('template')
+    if not template:
+        return None, None
+    return template.get('metadata') or {}, template.get('spec') or {}
+
+
+def extract_facts(data):
+    """
+    Extracts everything ueli needs to know about one parsed k8s document:
+    kind, names, label names and the configmaps and secrets it references.
+
+    `config_refs`/`secret_refs` are references to a whole configmap or secret
+    (volumes, projected volumes, `envFrom`) as [name, container] and
+    `config_key_refs`/`secret_key_refs` references to single keys in container
+    envs as [name, key, container]. Container is None for volumes. The result
+    only contains plain lists, so it can be cached as JSON.
+    """
+    if not isinstance(data, dict):
+        return None
+
+    facts = {
+        'kind': data.get('kind'),
+        'names': [],
+        'labels': [],
+        'config_refs': [],
+        'secret_refs': [],
+        'config_key_refs': [],
+        'secret_key_refs': [],
+    }
+
+    metadata = data.get('metadata') or {}
+    if 'name' in metadata:
+        facts['names'].append(metadata['name'])
+
+    pod_metadata, pod_spec = get_pod_spec(data)
+    if pod_spec is None:
+        return facts
+
+    labels = pod_metadata.get('labels') or {}
+    if 'name' in labels:
+        facts['labels'].append(labels['name'])
+
+    for volume in pod_spec.get('volumes') or []:
+        if 'configMap' in volume:
+            facts['config_refs'].append([volume['configMap']['name'], None])
+        if 'secret' in volume:
+            facts['secret_refs'].append([volume['secret']['secretName'], None])
+        for source in (volume.get('projected') or {}).get('sources') or []:
+            if 'configMap' in source:
+                facts['config_refs'].append([source['configMap']['name'], None])
+            if 'secret' in source:
+                facts['secret_refs'].append([source['secret']['name'], None])
+
+    containers = (pod_spec.get('initContainers') or []) + (pod_spec.get('containers') or [])
+    for container in containers:
+        container_name = container.get('name')
+        for env_from in container.get('envFrom') or []:
+            if 'configMapRef' in env_from:
+                facts['config_refs'].append([env_from['configMapRef']['name'], container_name])
+            if 'secretRef' in env_from:
+                facts['secret_refs'].append([env_from['secretRef']['name'], container_name])
+        for env in container.get('env') or []:
+            value_from = env.get('valueFrom') or {}
+            if 'configMapKeyRef' in value_from:
+                ref = value_from['configMapKeyRef']
+                facts['config_key_refs'].append([ref['name'], ref['key'], container_name])
+            if 'secretKeyRef' in value_from:
+                ref = value_from['secretKeyRef']
+                facts['secret_key_refs'].append([ref['name'], ref['key'], container_name])
+
+    return facts
+
+
+def parse_facts(content):
+    """
+    Parses all documents of a manifest file and returns their facts as
+    {'documents': [...], 'error': None}. Items of `kind: List` documents are
+    treated as documents. YAML errors are returned instead of raised, they
+    are cached like any other result.
+    """
+    documents = []
+    try:
+        for data in yaml.load_all(content, Loader=utils.get_yaml_loader()):
+            items = data.get('items') if isinstance(data, dict) and data.get('kind') == 'List' else [data]
+            for item in items or []:
+                facts = extract_facts(item)
+                if facts:
+                    documents.append(facts)
+    except yaml.YAMLError as e:
+        return {'documents': documents, 'error': str(e)}
+    return {'documents': documents, 'error': None}
+
+
+def expand_path(to_apply):
+    """
+    Expands an entry of `deployments[].apply` into manifest files. Entries
+    can be files, directories (not recursive, like `kubectl apply -f`) or
+    glob patterns. Files that don't exist are returned as they are, applying
+    them will tell.
+    """
+    if os.path.isdir(to_apply):
+        paths = [os.path.join(to_apply, name) for name in os.listdir(to_apply)
+                 if name.endswith(MANIFEST_EXTENSIONS)]
+        return sorted(path for path in paths if os.path.isfile(path))
+    if glob.has_magic(to_apply):
+        return sorted(path for path in glob.glob(to_apply, recursive=True)
+                      if os.path.isfile(path))
+    return [to_apply]
+
+
+class ManifestCache(object):
+    """
+    On-disk cache of parsed manifest facts (see `parse_facts`) keyed by path.
+
+    An entry is used as long as mtime and size of the file are unchanged. If
+    they changed, the content hash decides whether the file has to be parsed
+    again (e.g. a `git checkout` touches files without changing them). The
+    least recently used entries are evicted once there are more than
+    `max_entries`, but never the ones used since the cache was loaded, so
+    projects with more manifests get them all cached.
+    """
+
+    def __init__(self, path=None, max_entries=CACHE_MAX_ENTRIES):
+        self.path = path or os.path.join(utils.get_cache_dir(), CACHE_FILE_NAME)
+        self.max_entries = max_entries
+        self._entries = None
+        self._dirty = False
+        # Paths of the entries used since loaded
+        self._working = set()
+
+    @property
+    def entries(self):
+        if self._entries is None:
+            self._entries = self._read()
+        return self._entries
+
+    def _read(self):
+        data = utils.read_json_file(self.path, default={})
+        if not isinstance(data, dict) or data.get('version') != CACHE_VERSION:
+            return {}
+        return data.get('entries', {})
+
+    def get_facts(self, path):
+        """
+        Returns the parsed facts of the manifest at `path` or None if the
+        file doesn't exist.
+        """
+        return self.get_many([path])[path]
+
+    def get_many(self, paths, jobs=None):
+        """
+        Returns a dict of path to facts like `get_facts`. Files which have to
+        be parsed are parsed on up to `jobs` processes if there are many.
+        """
+        results = {}
+        misses = []
+        for path in paths:
+            abs_path = os.path.abspath(path)
+            try:
+                stat = os.stat(abs_path)
+            except OSError:
+                results[path] = None
+                continue
+
+            entry = self.entries.get(abs_path)
+            if entry and entry['mtime'] == stat.st_mtime and entry['size'] == stat.st_size:
+                results[path] = self._use(abs_path, entry)
+                continue
+
+            with open(abs_path, 'rb') as f:
+                content = f.read()
+            digest = hashlib.sha1(content).hexdigest()
+            if entry and entry['hash'] == digest:
+                entry.update(mtime=stat.st_mtime, size=stat.st_size)
+                self._dirty = True
+                results[path] = self._use(abs_path, entry)
+                continue
+            misses.append((path, abs_path, stat, digest, content))
+
+        contents = [miss[-1] for miss in misses]
+        if len(misses) >= PARALLEL_THRESHOLD and jobs != 1:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+                parsed = list(executor.map(parse_facts, contents, chunksize=8))
+        else:
+            parsed = [parse_facts(content) for content in contents]
+
+        for (path, abs_path, stat, digest, content), facts in zip(misses, parsed):
+            entry = {'hash': digest, 'facts': facts, 'mtime': stat.st_mtime,
+                     'size': stat.st_size, 'used': 0}
+            self.entries[abs_path] = entry
+            self._dirty = True
+            results[path] = self._use(abs_path, entry)
+        return results
+
+    def get_hash(self, path):
+        """
+        Returns the content hash of a file seen by `get_many` or None.
+        """
+        entry = self.entries.get(os.path.abspath(path))
+        return entry['hash'] if entry else None
+
+    def _use(self, abs_path, entry):
+        self._working.add(abs_path)
+        now = time.time()
+        # Last use only matters for eviction, it's not worth rewriting the
+        # cache on every run
+        if now - entry.get('used', 0) > CACHE_TOUCH_INTERVAL:
+            entry['used'] = now
+            self._dirty = True
+        return entry['facts']
+
+    def save(self):
+        if not self._dirty:
+            return
+        entries = self.entries
+        if len(entries) > self.max_entries:
+            others = sorted((p for p in entries if p not in self._working),
+                            key=lambda p: entries[p]['used'])
+            keep = list(self._working)
+            if len(keep) < self.max_entries:
+                keep += others[-(self.max_entries - len(keep)):]
+            entries = dict((p, entries[p]) for p in keep)
+
+        # Best effort, a cache which can't be written only costs speed
+        utils.write_json_file(self.path, {'version': CACHE_VERSION, 'entries': entries})
+        self._entries = entries
+        self._dirty = False
+
+
+class Manifest(object):
+    """
+    One manifest file of a deployment with the facts of all its documents.
+    """
+
+    def __init__(self, deployment, path, documents, error=None, hash=None):
+        self.deployment = deployment
+        self.path = path
+        self.documents = documents
+        self.error = error
+        self.hash = hash
+
+    @property
+    def kinds(self):
+        return [document['kind'] for document in self.documents]
+
+
+class Analysis(object):
+    """
+    Result of analyzing the manifests of all deployments in the config.
+    """
+
+    def __init__(self, service):
+        self.service = service
+        self.config_name = utils.get_config_name(service=service)
+        self.secret_name = utils.get_secret_name(service=service)
+        self.manifests = []
+        self.warnings = set()
+        self.config_keys = set()
+        self.secret_keys = set()
+        # Keys of the service configmap referenced one by one in container
+        # envs, and whether it's also used as a whole (volumes, `envFrom`),
+        # which makes every key of it used
+        self.required_config_keys = set()
+        self.config_used_whole = False
+
+    @property
+    def clean(self):
+        return len(self.warnings) <= 0
+
+    def add(self, manifest):
+        self.manifests.append(manifest)
+        if manifest.error:
+            self.warnings.add("{path}: Can't parse YAML: {error}".format(
+                path=manifest.path, error=manifest.error))
+
+        for facts in manifest.documents:
+            # get configs and secrets used as volumes or `envFrom`
+            self.config_keys.update(name for name, container in facts['config_refs'])
+            self.secret_keys.update(name for name, container in facts['secret_refs'])
+            if any(name == self.config_name for name, container in facts['config_refs']):
+                self.config_used_whole = True
+
+            # get configs and secrets used in container ENVS
+            for name, key, container in facts['config_key_refs']:
+                if name == self.config_name:
+                    self.config_keys.add(key)
+                    self.required_config_keys.add(key)
+            for name, key, container in facts['secret_key_refs']:
+                if name == self.secret_name:
+                    self.secret_keys.add(key)
+
+            # check correct name naming
+            for name in facts['names'] + facts['labels']:
+                if not name.startswith(self.service):
+                    self.warnings.add("{path}: Name '{name}' doesn't start "
+                                      "with {service}".format(path=manifest.path,
+                                                              name=name,
+                                                              service=self.service))
+
+    def to_apply(self):
+        """
+        Returns (path, kinds) of all manifest files in config order, every
+        file only once.
+        """
+        seen = set()
+        to_apply = []
+        for manifest in self.manifests:
+            if manifest.path not in seen:
+                seen.add(manifest.path)
+                to_apply.append((manifest.path, manifest.kinds))
+        return to_apply
+
+    def hashes(self):
+        """
+        Returns the content hash of every manifest file by path.
+        """
+        return dict((manifest.path, manifest.hash) for manifest in self.manifests
+                    if manifest.hash)
+
+
+def analyze(config, cache=None, jobs=None):
+    """
+    Analyzes all manifests of the deployments in `config` and returns an
+    `Analysis` with naming warnings and used config and secret keys.
+    """
+    service = config.service
+    analysis = Analysis(service=service)
+
+    paths = []
+    for deployment in config.deployments:
+        if not deployment.name.startswith(service):
+            analysis.warnings.add("Ueli config deployment name '{name}' doesn't start "
+                                  "with {service}".format(name=deployment.name,
+                                                          service=service))
+        for to_apply in deployment.apply:
+            for path in expand_path(to_apply):
+                paths.append((deployment.name, path))
+
+    cache = cache or ManifestCache()
+    with timings.span('parse manifests', category='yaml', files=len(paths)):
+        parsed = cache.get_many([path for name, path in paths], jobs=jobs)
+        # Saving may evict entries of huge projects, so hashes are taken first
+        hashes = dict((path, cache.get_hash(path)) for name, path in paths if parsed[path])
+        cache.save()
+
+    for name, path in paths:
+        facts = parsed[path] or {'documents': [], 'error': None}
+        analysis.add(Manifest(deployment=name, path=path, documents=facts['documents'],
+                              error=facts['error'], hash=hashes.get(path)))
+    return analysis
@@ -0,0 +1,214 @@
+import re
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from ueli import images, utils
+
+
+class ImageTask(object):
+    """
+    Build (and push) of one image declared in `images` of the config.
+    """
+
+    def __init__(self, name, source, depends_on, build_tag, remote_tag, repository):
+        self.name = name
+        self.source = source
+        self.depends_on = depends_on
+        self.build_tag = build_tag
+        self.remote_tag = remote_tag
+        self.repository = repository
+
+        self.status = 'pending'
+        self.reason = None
+        # Digest of the context and the images it's built on, see
+        # `images.get_build_digest`
+        self.digest = None
+        self.output = ''
+        self.build_start = None
+        self.build_end = None
+        self.push_start = None
+        self.push_end = None
+
+    @property
+    def end(self):
+        return self.push_end or self.build_end
+
+    @property
+    def failed(self):
+        return self.status in ('failed', 'push failed', 'blocked')
+
+
+def get_build_arg_name(image_name):
+    """
+    Dependencies are passed to builds as build args, e.g. the tag of image
+    `flatfox-base` as `FLATFOX_BASE_IMAGE`, to be used in a Dockerfile like
+
+        ARG FLATFOX_BASE_IMAGE
+        FROM ${FLATFOX_BASE_IMAGE}
+
+    """
+    return '{}_IMAGE'.format(re.sub(r'[^A-Z0-9]', '_', image_name.upper()))
+
+
+def plan(config, branch, commit):
+    """
+    Returns the tasks of all images in `config.images` in dependency
+    order. Raises ValueError for unknown dependencies or cycles.
+    """
+    declared = config.images
+    by_name = dict((image.name, image) for image in declared)
+    for image in declared:
+        for dependency in image.depends_on:
+            if dependency not in by_name:
+                raise ValueError("Image '{name}' depends on unknown image '{dependency}'".format(
+                    name=image.name, dependency=dependency))
+
+    ordered = []
+    visiting = set()
+
+    def visit(name, path):
+        if name in ordered:
+            return
+        if name in visiting:
+            raise ValueError('Cyclic image dependencies: {}'.format(' -> '.join(path + [name])))
+        visiting.add(name)
+        for dependency in by_name[name].depends_on:
+            visit(dependency, path + [name])
+        visiting.discard(name)
+        ordered.append(name)
+
+    for image in declared:
+        visit(image.name, [])
+
+    tasks = []
+    for name in ordered:
+        image = by_name[name]
+        build_tag = utils.get_build_tag(service=name, branch=branch, commit=commit)
+        tasks.append(ImageTask(
+            name=name, source=image.source,
+            depends_on=list(image.depends_on), build_tag=build_tag,
+            remote_tag=utils.get_remote_tag(config=config, build_tag=build_tag),
+            repository=images.get_repository(config, service=name)))
+    return tasks
+
+
+def build_task(task, tasks_by_name, branch, clean, rebuild=False, cache_from=True):
+    """
+    Builds the image of a task without printing anything, output is
+    collected on the task.
+    """
+    task.build_start = time.time()
+    cache_pull = None
+    if cache_from:
+        cache_pull = images.CacheImagePull(repository=task.repository, branch=branch)
+    # Tags of dependencies change with every commit, their digests only if
+    # the images do
+    task.digest = images.get_build_digest(
+        images.get_context_digest(task.source),
+        dict((get_build_arg_name(name), tasks_by_name[name].digest) for name in task.depends_on))
+
+    action = None
+    if not rebuild:
+        action, image, reason = images.find_reusable_image(
+            build_tag=task.build_tag, context_digest=task.digest,
+            remote_tag=task.remote_tag, clean=clean)
+    if action:
+        if cache_pull:
+            cache_pull.cancel()
+        task.reason = reason
+        returncode = 0
+        for cmd in images.reuse_image_cmd(action, image=image, build_tag=task.build_tag):
+            returncode, task.output = utils.run_captured(cmd)
+            if returncode != 0:
+                break
+        task.status = 'reused' if returncode == 0 else 'failed'
+    else:
+        cache_image = cache_pull.wait() if cache_pull else None
+        build_args = dict((get_build_arg_name(name), tasks_by_name[name].build_tag)
+                          for name in task.depends_on)
+        cmd = images.get_build_cmd(build_tag=task.build_tag, context=task.source,
+                                   context_digest=task.digest, cache_image=cache_image,
+                                   build_args=build_args)
+        returncode, task.output = utils.run_captured(cmd)
+        task.status = 'built' if returncode == 0 else 'failed'
+    task.build_end = time.time()
+    return task
+
+
+def push_task(task):
+    task.push_start = time.time()
+    image_id = images.get_image_id(task.build_tag)
+    result = images.push_image(task.build_tag, image_id, task.remote_tag)
+    if not result.ok:
+        task.status = 'push failed'
+        task.output = result.output
+    elif result.skipped:
+        task.reason = task.reason or 'Unchanged in registry'
+    else:
+        task.status = 'pushed'
+    task.push_end = time.time()
+    return task
+
+
+def run(tasks, branch, clean, jobs=4, push=False, rebuild=False, cache_from=True, echo=None):
+    """
+    Runs builds of all tasks on up to `jobs` threads as soon as the images
+    they depend on are built. With `push`, each image is pushed as soon as
+    its build finished. Tasks depending on a failed build are blocked.
+    `echo` is called with a task and the finished step (`build` or `push`).
+    """
+    tasks_by_name = dict((task.name, task) for task in tasks)
+    built = set()
+    pending = list(tasks)
+    running = {}
+
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        while pending or running:
+            for task in list(pending):
+                dependencies = [tasks_by_name[name] for name in task.depends_on]
+                if any(dependency.status in ('failed', 'blocked') for dependency in dependencies):
+                    task.status = 'blocked'
+                    task.reason = 'A dependency failed'
+                    pending.remove(task)
+                    if echo:
+                        echo(task, 'build')
+                elif all(dependency.name in built for dependency in dependencies):
+                    pending.remove(task)
+                    future = executor.submit(build_task, task, tasks_by_name, branch=branch,
+                                             clean=clean, rebuild=rebuild, cache_from=cache_from)
+                    running[future] = 'build'
+
+            if not running:
+                continue
+
+            done, _ = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+            for future in done:
+                step = running.pop(future)
+                task = future.result()
+                if echo:
+                    echo(task, step)
+                if step == 'build' and not task.failed:
+                    built.add(task.name)
+                    if push:
+                        running[executor.submit(push_task, task)] = 'push'
+    return tasks
+
+
+def get_critical_path(tasks):
+    """
+    Returns the chain of tasks which determined the total run time: the
+    task finishing last, the dependency of it which was built last and so on.
+    """
+    tasks_by_name = dict((task.name, task) for task in tasks)
+    finished = [task for task in tasks if task.end]
+    if not finished:
+        return []
+
+    path = [max(finished, key=lambda task: task.end)]
+    while path[-1].depends_on:
+        dependencies = [tasks_by_name[name] for name in path[-1].depends_on
+                        if tasks_by_name[name].build_end]
+        if not dependencies:
+            break
+        path.append(max(dependencies, key=lambda task: task.build_end))
+    return list(reversed(path))
@@ -0,0 +1,302 @@
+import json
+import threading
+import time
+
+from ueli import runner
+
+
+# Seconds to wait for all rollouts before rolling back
+DEFAULT_TIMEOUT = 300
+
+# Seconds to wait before watching again after the API server closed a
+# watch, doubled up to the maximum for every watch without events
+WATCH_BACKOFF = 0.5
+WATCH_MAX_BACKOFF = 8
+
+# Field manager of the image fields set by deploys, see `set_images`
+FIELD_MANAGER = 'ueli-deploy'
+
+
+class Rollout(object):
+    """
+    Image update of one deployment and its progress.
+
+    `images` and `previous_images` map container names to images. Status is
+    one of `pending`, `ready`, `failed`, `timeout`, `rolled back` or
+    `missing` if there is no such deployment.
+    """
+
+    def __init__(self, name, images=None, previous_images=None):
+        self.name = name
+        self.images = images or {}
+        self.previous_images = previous_images or {}
+        self.generation = None
+        self.status = 'pending'
+        self.message = ''
+        self.start = None
+        self.ready = None
+
+    @property
+    def seconds(self):
+        if self.start is None or self.ready is None:
+            return None
+        return self.ready - self.start
+
+    @property
+    def ok(self):
+        return self.status == 'ready'
+
+    @property
+    def done(self):
+        return self.status != 'pending'
+
+
+def get_repository_name(image):
+    """
+    Returns the image name without tag or digest, e.g. `eu.gcr.io/p/web` for
+    `eu.gcr.io/p/web:master.abcdef1`.
+    """
+    name = image.split('@')[0]
+    if ':' in name.rsplit('/', 1)[-1]:
+        name = name.rsplit(':', 1)[0]
+    return name
+
+
+def plan(deployments, names, repository, image):
+    """
+    Returns a `Rollout` for every name in `names`. `deployments` maps names
+    to deployment objects, as returned by kubectl. All containers running an
+    image of `repository` are updated to `image`.
+    """
+    rollouts = []
+    for name in names:
+        deployment = deployments.get(name)
+        if deployment is None:
+            rollout = Rollout(name)
+            rollout.status = 'missing'
+            rollout.message = "Deployment doesn't exist"
+            rollouts.append(rollout)
+            continue
+
+        pod_spec = deployment['spec']['template']['spec']
+        previous = dict((c['name'], c.get('image', ''))
+                        for c in pod_spec.get('containers') or []
+                        if get_repository_name(c.get('image', '')) == repository)
+        rollout = Rollout(name, images=dict((c, image) for c in previous),
+                          previous_images=previous)
+        if not previous:
+            rollout.status = 'failed'
+            rollout.message = "No container runs an image of '{}'".format(repository)
+        rollouts.append(rollout)
+    return rollouts
+
+
+def get_image_manifest(rollouts, namespace, previous=False):
+    """
+    Returns a list manifest only containing the container images of the
+    rollouts, to be applied server side.
+    """
+    items = []
+    for rollout in rollouts:
+        images = rollout.previous_images if previous else rollout.images
+        items.append({
+            'apiVersion': 'apps/v1',
+            'kind': 'Deployment',
+            'metadata': {'name': rollout.name, 'namespace': namespace},
+            'spec': {'template': {'spec': {'containers': [
+                {'name': container, 'image': image}
+                for container, image in sorted(images.items())]}}},
+        })
+    return {'apiVersion': 'v1', 'kind': 'List', 'items': items}
+
+
+def set_images(rollouts, namespace, previous=False, client=None):
+    """
+    Updates the images of all rollouts with one server side apply. Only the
+    image fields are sent, so everything else stays as `ueli apply` left
+    it. Returns the new generations by deployment name.
+
+    With an API `client` every deployment is applied on its own, the API
+    has no batch calls, but they share the client's connections.
+    """
+    manifest = get_image_manifest(rollouts, namespace=namespace, previous=previous)
+    if client is not None:
+        items = [client.apply(item, field_manager=FIELD_MANAGER, force=True)
+                 for item in manifest['items']]
+        return dict((item['metadata']['name'], item['metadata'].get('generation'))
+                    for item in items)
+    cmd = ['kubectl', 'apply', '--server-side', '--force-conflicts',
+           '--field-manager={}'.format(FIELD_MANAGER), '--namespace={}'.format(namespace),
+           '-o', 'json', '-f', '-']
+    output = runner.run(cmd, stdin=json.dumps(manifest), quiet=True).stdout
+    data = json.loads(output)
+    items = data.get('items', [data]) if data.get('kind') == 'List' else [data]
+    return dict((item['metadata']['name'], item['metadata'].get('generation'))
+                for item in items)
+
+
+def get_rollout_state(deployment, generation=None):
+    """
+    Returns `ready`, `failed` or `pending` for a deployment object, checked
+    like `kubectl rollout status` does. Before the controller observed
+    `generation` the rollout is pending.
+    """
+    metadata = deployment.get('metadata') or {}
+    spec = deployment.get('spec') or {}
+    status = deployment.get('status') or {}
+
+    observed = status.get('observedGeneration') or 0
+    if observed < (generation or metadata.get('generation') or 0):
+        return 'pending', 'Waiting for the controller'
+
+    for condition in status.get('conditions') or []:
+        if condition.get('type') == 'Progressing' and \
+                condition.get('reason') == 'ProgressDeadlineExceeded':
+            return 'failed', condition.get('message') or 'Progress deadline exceeded'
+
+    replicas = spec.get('replicas', 1)
+    updated = status.get('updatedReplicas') or 0
+    if updated < replicas:
+        return 'pending', '{} of {} updated replicas'.format(updated, replicas)
+    if (status.get('replicas') or 0) > updated:
+        return 'pending', '{} old replicas pending termination'.format(
+            status['replicas'] - updated)
+    if (status.get('availableReplicas') or 0) < updated:
+        return 'pending', '{} of {} updated replicas available'.format(
+            status.get('availableReplicas') or 0, updated)
+    return 'ready', ''
+
+
+class RolloutWatch(object):
+    """
+    Consumes the output of `kubectl get deployments --watch -o json`, which
+    is a stream of pretty printed JSON objects, and updates the rollouts.
+    `finished` is set once no rollout is pending anymore.
+    """
+
+    def __init__(self, rollouts, echo=None):
+        self.rollouts = dict((rollout.name, rollout) for rollout in rollouts)
+        self.echo = echo
+        self.finished = threading.Event()
+        self._buffer = ''
+        self._decoder = json.JSONDecoder()
+        self._check_finished()
+
+    def feed(self, line):
+        # Objects start with an unindented opening brace, anything before is
+        # left over from an interrupted watch
+        if line.startswith('{'):
+            self._buffer = ''
+        self._buffer += line
+        # Objects end with an unindented closing brace
+        if not line.startswith('}'):
+            return
+        try:
+            deployment, _ = self._decoder.raw_decode(self._buffer.strip())
+        except ValueError:
+            return
+        self._buffer = ''
+        self.update(deployment)
+
+    def update(self, deployment):
+        rollout = self.rollouts.get(deployment.get('metadata', {}).get('name'))
+        if rollout is None or rollout.done:
+            return
+        state, message = get_rollout_state(deployment, generation=rollout.generation)
+        rollout.message = message
+        if state != 'pending':
+            rollout.status = state
+            rollout.ready = time.time()
+            if self.echo:
+                self.echo(rollout)
+        self._check_finished()
+
+    def _check_finished(self):
+        if all(rollout.done for rollout in self.rollouts.values()):
+            self.finished.set()
+
+
+def watch(rollouts, namespace, timeout=DEFAULT_TIMEOUT, echo=None):
+    """
+    Watches all pending rollouts with one kubectl watch stream until they're
+    ready or failed. Rollouts still pending after `timeout` seconds get the
+    status `timeout`. Raises `CommandError` if kubectl fails without
+    watching anything, e.g. for missing permissions.
+    """
+    rollout_watch = RolloutWatch([r for r in rollouts if not r.done], echo=echo)
+    cmd = ['kubectl', 'get', 'deployments', '--namespace={}'.format(namespace),
+           '--watch', '-o', 'json']
+    deadline = time.time() + timeout
+    delay = WATCH_BACKOFF
+    # The API server closes watches now and then, they're just started again
+    while not rollout_watch.finished.is_set() and time.time() < deadline:
+        try:
+            result = runner.run(cmd, on_line=rollout_watch.feed, cancel=rollout_watch.finished,
+                                timeout=deadline - time.time(), quiet=True, check=False)
+        except runner.CommandCancelled:
+            break
+        except runner.CommandTimeout:
+            break
+        if not result.stdout:
+            if not result.ok:
+                raise runner.CommandError(result.returncode, cmd, output=result.stdout,
+                                          stderr=result.stderr)
+        else:
+            delay = WATCH_BACKOFF
+        if rollout_watch.finished.wait(min(delay, max(deadline - time.time(), 0))):
+            break
+        delay = min(delay * 2, WATCH_MAX_BACKOFF)
+
+    for rollout in rollouts:
+        if not rollout.done:
+            rollout.status = 'timeout'
+            rollout.message = 'Timed out: {}'.format(rollout.message)
+            if echo:
+                echo(rollout)
+    return rollouts
+
+
+def deploy(deployments, names, namespace, repository, image, timeout=DEFAULT_TIMEOUT,
+           rollback=True, echo=None, client=None):
+    """
+    Updates all containers running an image of `repository` in the
+    deployments `names` to `image` with one batched call and watches the
+    rollouts. If any rollout times out or fails, or a deployment is
+    missing, all updated deployments are set back to their previous images
+    with `rollback`, also if watching fails. `echo` is called with every
+    rollout once it's done. Images are set with the API `client` if given.
+    Returns the rollouts.
+    """
+    rollouts = plan(deployments, names=names, repository=repository, image=image)
+    changed = [r for r in rollouts if not r.done and r.images != r.previous_images]
+    for rollout in rollouts:
+        if rollout in changed:
+            continue
+        if not rollout.done:
+            rollout.status = 'ready'
+            rollout.message = 'Already running this image'
+            rollout.start = rollout.ready = time.time()
+        if echo:
+            echo(rollout)
+    if not changed:
+        return rollouts
+
+    start = time.time()
+    generations = set_images(changed, namespace=namespace, client=client)
+    for rollout in changed:
+        rollout.start = start
+        rollout.generation = generations.get(rollout.name)
+    try:
+        watch(changed, namespace=namespace, timeout=timeout, echo=echo)
+    except runner.CommandError:
+        if rollback:
+            set_images(changed, namespace=namespace, previous=True, client=client)
+        raise
+
+    if rollback and any(not rollout.ok for rollout in rollouts):
+        set_images(changed, namespace=namespace, previous=True, client=client)
+        for rollout in changed:
+            if rollout.status == 'ready':
+                rollout.message = 'Rolled back because other deployments failed'
+            rollout.status = 'rolled back'
+    return rollouts
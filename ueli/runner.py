@@ -0,0 +1,250 @@
+import os.path
+import re
+import shlex
+import subprocess
+import sys
+import time
+
+from ueli import executor, timings
+
+
+# Default timeouts in seconds per executable. Docker builds and pushes can
+# legitimately take very long, so they don't have one, also not when run
+# through gcloud.
+DEFAULT_TIMEOUTS = {
+    'git': 120,
+    'gcloud': 600,
+    'kubectl': 300,
+}
+UNLIMITED_COMMANDS = (
+    ('gcloud', 'docker'),
+)
+
+# Commands failing with output like this are retried. Errors of the first
+# list happen before the server got the request, the ones of the second
+# may happen after it was executed.
+REJECTED_ERRORS = [
+    r'connection refused',
+    r'TLS handshake timeout',
+    r'Could not resolve host',
+    r'no such host',
+    r'Too Many Requests',
+    r'\b(?:HTTP status|status code|status):? 429\b',
+]
+UNCERTAIN_ERRORS = [
+    r'connection reset by peer',
+    r'i/o timeout',
+    r'net/http: request canceled',
+    r'unexpected EOF',
+    r'Service Unavailable',
+    r'the server is currently unable to handle the request',
+    r'\b(?:HTTP status|status code|status):? (?:502|503|504)\b',
+]
+TRANSIENT_ERRORS = re.compile('|'.join(REJECTED_ERRORS + UNCERTAIN_ERRORS), re.IGNORECASE)
+UNCERTAIN_ERROR = re.compile('|'.join(UNCERTAIN_ERRORS), re.IGNORECASE)
+
+# Output of builds comes from the commands of the Dockerfile, network
+# errors in there aren't retried
+NO_RETRY_COMMANDS = (
+    ('docker', 'build'),
+)
+
+# A create retried after an uncertain error may find what the earlier
+# attempt created before its connection broke
+ALREADY_EXISTS = re.compile(r'\(AlreadyExists\)')
+
+DEFAULT_RETRIES = 2
+DEFAULT_BACKOFF = 1.0
+
+
+class CommandError(subprocess.CalledProcessError):
+    """
+    Raised if a command fails. `output` has stdout, `stderr` stderr.
+    """
+
+    def __str__(self):
+        message = "Command '{}' failed with exit code {}".format(
+            format_cmd(self.cmd), self.returncode)
+        if self.stderr and self.stderr.strip():
+            message += ': {}'.format(self.stderr.strip().split('\n')[-1])
+        return message
+
+
+class CommandTimeout(CommandError):
+
+    def __init__(self, cmd, timeout, output=None, stderr=None):
+        super(CommandTimeout, self).__init__(-1, cmd, output=output, stderr=stderr)
+        self.timeout = timeout
+
+    def __str__(self):
+        return "Command '{}' timed out after {}s".format(format_cmd(self.cmd), self.timeout)
+
+
+class CommandCancelled(CommandError):
+
+    def __init__(self, cmd, output=None, stderr=None):
+        super(CommandCancelled, self).__init__(-1, cmd, output=output, stderr=stderr)
+
+    def __str__(self):
+        return "Command '{}' was cancelled".format(format_cmd(self.cmd))
+
+
+class Result(object):
+    """
+    Outcome of a command: exit code, captured stdout and stderr and output,
+    which is both interleaved like on a terminal.
+    """
+
+    def __init__(self, argv, returncode, stdout, stderr, output, seconds, attempts):
+        self.argv = argv
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.output = output
+        self.seconds = seconds
+        self.attempts = attempts
+
+    @property
+    def ok(self):
+        return self.returncode == 0
+
+
+def format_cmd(argv):
+    if isinstance(argv, str):
+        return argv
+    return ' '.join(shlex.quote(arg) for arg in argv)
+
+
+def get_command(argv, depth=2):
+    """
+    Returns executable and subcommands of `argv`, e.g. ('kubectl', 'create')
+    for `kubectl --namespace=x create namespace x`.
+    """
+    args = [arg for arg in argv[1:] if not arg.startswith('-')]
+    return tuple([os.path.basename(argv[0])] + args[:depth - 1])
+
+
+def get_default_timeout(argv):
+    if get_command(argv) in UNLIMITED_COMMANDS:
+        return None
+    return DEFAULT_TIMEOUTS.get(os.path.basename(argv[0]))
+
+
+def is_create(argv):
+    """
+    Checks if `argv` is a `kubectl create`, which fails if what it creates
+    exists already.
+    """
+    return get_command(argv) == ('kubectl', 'create')
+
+
+def _run_once(argv, capture, stream, quiet, timeout, cancel, stdin, on_line):
+    if capture:
+        returncode, stdout, stderr, output, stopped = executor.get_executor().run(
+            argv, stream=stream, quiet=quiet, timeout=timeout, cancel=cancel, stdin=stdin,
+            on_line=on_line)
+        if stopped == 'cancelled':
+            raise CommandCancelled(argv, output=stdout, stderr=stderr)
+        if stopped == 'timeout':
+            raise CommandTimeout(argv, timeout, output=stdout, stderr=stderr)
+        return returncode, stdout, stderr, output
+
+    # Interactive commands (editors, logins) get the terminal
+    try:
+        process = subprocess.Popen(argv)
+    except OSError as e:
+        message = '{}: {}\n'.format(argv[0], e.strerror)
+        sys.stderr.write(message)
+        return 127, '', message, message
+
+    start = time.time()
+    try:
+        while True:
+            try:
+                process.wait(timeout=executor.POLL_INTERVAL)
+                break
+            except subprocess.TimeoutExpired:
+                pass
+            if cancel is not None and cancel.is_set():
+                _stop(process)
+                raise CommandCancelled(argv)
+            if timeout is not None and time.time() - start > timeout:
+                _stop(process)
+                raise CommandTimeout(argv, timeout)
+    except KeyboardInterrupt:
+        _stop(process)
+        raise
+    return process.returncode, '', '', ''
+
+
+def _stop(process):
+    if process.poll() is not None:
+        return
+    process.terminate()
+    try:
+        process.wait(timeout=executor.KILL_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def run(argv, capture=True, stream=False, quiet=False, timeout='default',
+        retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF, check=True, cancel=None, stdin=None,
+        on_line=None):
+    """
+    Runs the command `argv` (a list, no shell involved) and returns a
+    `Result`. Captured commands run on the shared asyncio executor (see
+    `ueli.executor`), which limits how many processes run at once.
+
+    With `capture` stdout and stderr are collected, otherwise the command
+    gets the terminal. `stream` writes stdout line by line while the command
+    runs, stderr is passed through unless `quiet`. `stdin` is sent as input.
+    `on_line` is called with every line of stdout as soon as it's read.
+    Commands running longer than `timeout` seconds (defaults per executable,
+    see `DEFAULT_TIMEOUTS`) are terminated. Failures with output looking
+    like a transient network or API error are retried up to `retries` times
+    with exponential backoff, unless lines were streamed or passed to
+    `on_line` already, they'd be repeated otherwise. A retried `kubectl
+    create` failing because it exists succeeded on an earlier attempt, if
+    that one failed with an error telling nothing about whether it was
+    executed. Setting the `cancel` event stops the command.
+
+    Raises `CommandError` (a `CalledProcessError`) for failures if `check`.
+    """
+    if timeout == 'default':
+        timeout = get_default_timeout(argv) if capture else None
+
+    if get_command(argv) in NO_RETRY_COMMANDS:
+        retries = 0
+
+    start = time.time()
+    attempt = 0
+    uncertain = False
+    while True:
+        attempt += 1
+        with timings.span(format_cmd(argv), category=os.path.basename(argv[0]),
+                          attempt=attempt) as span:
+            returncode, stdout, stderr, output = _run_once(
+                argv, capture=capture, stream=stream, quiet=quiet, timeout=timeout,
+                cancel=cancel, stdin=stdin, on_line=on_line)
+            span.set(returncode=returncode, output_bytes=len(stdout) + len(stderr))
+        transient = returncode != 0 and TRANSIENT_ERRORS.search(output)
+        # Lines of stdout streamed or passed on would be repeated
+        emitted = (stream or on_line) and stdout
+        if not transient or attempt > retries or emitted:
+            break
+        uncertain = uncertain or bool(UNCERTAIN_ERROR.search(output))
+        delay = backoff * 2 ** (attempt - 1)
+        if cancel is not None:
+            if cancel.wait(delay):
+                raise CommandCancelled(argv, output=stdout, stderr=stderr)
+        else:
+            time.sleep(delay)
+
+    if returncode != 0 and uncertain and is_create(argv) and ALREADY_EXISTS.search(output):
+        returncode = 0
+
+    if check and returncode != 0:
+        raise CommandError(returncode, argv, output=stdout, stderr=stderr)
+    return Result(argv=argv, returncode=returncode, stdout=stdout, stderr=stderr,
+                  output=output, seconds=time.time() - start, attempts=attempt)
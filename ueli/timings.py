@@ -0,0 +1,133 @@
+import json
+import os
+import threading
+import time
+
+
+class Span(object):
+    """
+    One recorded phase or external command. `args` are shown in the trace,
+    use `set` to add to them while the span is open.
+    """
+
+    def __init__(self, recorder, name, category, args):
+        self.recorder = recorder
+        self.name = name
+        self.category = category
+        self.args = args
+        self.thread = threading.current_thread()
+        self.start = None
+        self.duration = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def set(self, **args):
+        self.args.update(args)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.duration = time.time() - self.start
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        self.recorder.add(self)
+        return False
+
+
+class NullSpan(object):
+    """
+    Stands in for `Span` while nothing is recorded.
+    """
+
+    def __enter__(self):
+        return self
+
+    def set(self, **args):
+        pass
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class Recorder(object):
+    """
+    Collects spans of all threads of one invocation.
+    """
+
+    def __init__(self):
+        self.start = time.time()
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+    def summary(self):
+        """
+        Returns (category, count, total seconds, max seconds) per category,
+        the slowest category first.
+        """
+        categories = {}
+        for span in self.spans:
+            count, total, longest = categories.get(span.category, (0, 0.0, 0.0))
+            categories[span.category] = (count + 1, total + span.duration,
+                                         max(longest, span.duration))
+        return sorted(((category,) + values for category, values in categories.items()),
+                      key=lambda row: -row[2])
+
+    def to_trace(self):
+        """
+        Returns the spans as Chrome trace events, which can be opened in
+        Perfetto or `chrome://tracing`.
+        """
+        pid = os.getpid()
+        events = []
+        threads = {}
+        for span in sorted(self.spans, key=lambda span: span.start):
+            if span.thread.ident not in threads:
+                threads[span.thread.ident] = len(threads) + 1
+                events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid,
+                               'tid': threads[span.thread.ident],
+                               'args': {'name': span.thread.name}})
+            tid = threads[span.thread.ident]
+            events.append({
+                'name': span.name,
+                'cat': span.category,
+                'ph': 'X',
+                'ts': int((span.start - self.start) * 1e6),
+                'dur': int(span.duration * 1e6),
+                'pid': pid,
+                'tid': tid,
+                'args': span.args,
+            })
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def write_trace(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_trace(), f)
+
+
+# Recorder of this process, None while timings aren't enabled
+recorder = None
+
+
+def enable():
+    global recorder
+    if recorder is None:
+        recorder = Recorder()
+    return recorder
+
+
+def span(name, category, **args):
+    """
+    Returns a context manager recording the time spent in it as `name` of
+    `category` (e.g. `kubectl` or `yaml`). Doesn't record anything unless
+    timings are enabled.
+    """
+    if recorder is None:
+        return NULL_SPAN
+    return Span(recorder, name=name, category=category, args=args)
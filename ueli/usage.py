@@ -0,0 +1,85 @@
+import os
+
+
+class Usage(object):
+    """
+    One reference of a manifest to a configmap or secret: a single `key`
+    in a container env or, with `key` None, the whole of it (volume,
+    `envFrom`). `container` is None for volumes.
+    """
+
+    def __init__(self, kind, name, key, path, container, deployments=()):
+        self.kind = kind
+        self.name = name
+        self.key = key
+        self.path = path
+        self.container = container
+        self.deployments = list(deployments)
+
+
+def get_refs(documents):
+    """
+    Returns the references of a manifest's documents (see
+    `manifests.extract_facts`) as [kind, name, key, container] lists.
+    """
+    refs = []
+    for facts in documents:
+        refs.extend(['configmap', name, None, container]
+                    for name, container in facts['config_refs'])
+        refs.extend(['secret', name, None, container]
+                    for name, container in facts['secret_refs'])
+        refs.extend(['configmap', name, key, container]
+                    for name, key, container in facts['config_key_refs'])
+        refs.extend(['secret', name, key, container]
+                    for name, key, container in facts['secret_key_refs'])
+    return refs
+
+
+class UsageIndex(object):
+    """
+    Reverse index of config and secret keys to the manifest files of an
+    analysis (see `manifests.analyze`) referencing them.
+
+    It's built from the facts the manifest cache keeps of every file, so
+    it's as current as the analysis without parsing anything or storing a
+    copy of the facts. Besides key -> usages it has configmap or secret
+    name -> usages for whole references, queries don't look at other
+    files.
+    """
+
+    def __init__(self, analysis):
+        self.keys = {}
+        self.whole = {}
+        deployments = {}
+        documents = {}
+        for manifest in analysis.manifests:
+            abs_path = os.path.abspath(manifest.path)
+            deployments.setdefault(abs_path, set()).add(manifest.deployment)
+            documents.setdefault(abs_path, (manifest.path, manifest.documents))
+
+        for abs_path in sorted(documents):
+            path, docs = documents[abs_path]
+            for kind, name, key, container in get_refs(docs):
+                postings = self.whole if key is None else self.keys
+                postings.setdefault(name if key is None else key, []).append(
+                    Usage(kind, name, key, os.path.relpath(path), container,
+                          deployments=sorted(deployments[abs_path])))
+
+    def where_used(self, key):
+        """
+        Returns the `Usage`s of `key` of any configmap or secret.
+        """
+        return list(self.keys.get(key, []))
+
+    def where_used_whole(self, kind, name):
+        """
+        Returns the `Usage`s of the whole configmap or secret `name`.
+        """
+        return [u for u in self.whole.get(name, []) if u.kind == kind]
+
+    def used_keys(self, kind, name):
+        """
+        Returns the keys of configmap or secret `name` referenced anywhere.
+        """
+        return set(key for key, usages in self.keys.items()
+                   if any(u.kind == kind and u.name == name for u in usages))
@@ -1,29 +1,134 @@
+import importlib
+import os
 import os.path
-import yaml
-import subprocess
+import re
+import shlex
+import sys
 import click
 
 
-def load_yaml_file(path):
-    working_dir = os.path.abspath('.')
-    yaml_file = os.path.join(working_dir, path)
-    exists = os.path.exists(yaml_file)
+class LazyModule(object):
+    """
+    Stands in for a module until an attribute is accessed. The import goes
+    through `importlib`, whose per-module locks make threads accessing it
+    concurrently wait for the module to be fully executed.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+    def __repr__(self):
+        return '<lazy module {!r}>'.format(self._name)
+
+
+def lazy_import(name):
+    """
+    Returns the module `name`, which is only loaded on first attribute
+    access. Keeps startup fast for e.g. `--help` and shell completion, which
+    never need yaml and co.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    return LazyModule(name)
+
+
+calendar = lazy_import('calendar')
+datetime = lazy_import('datetime')
+yaml = lazy_import('yaml')
+
 
-    if exists:
-        with open(yaml_file, 'r') as f:
-            return yaml.load(f)
+def get_yaml_loader():
+    # Use the libyaml based loader if pyyaml was built with it, it's a lot faster
+    return getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
 
-    return None
+
+def get_cache_dir():
+    """
+    Returns the directory for ueli's caches, `$UELI_CACHE_DIR` or
+    `$XDG_CACHE_HOME/ueli` (defaults to `~/.cache/ueli`).
+    """
+    if os.environ.get('UELI_CACHE_DIR'):
+        return os.environ['UELI_CACHE_DIR']
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(cache_home, 'ueli')
+
+
+def read_json_file(path, default=None):
+    """
+    Returns the content of the JSON file at `path`, or `default` if it
+    doesn't exist or can't be read or parsed.
+    """
+    import json
+
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return default
+
+
+def write_json_file(path, data):
+    """
+    Writes `data` as JSON to `path` for ueli's caches. The file is written
+    to a temporary file next to it first and then renamed, so parallel runs
+    never read a half written file. Best effort, a cache which can't be
+    written only costs speed: returns False instead of raising.
+    """
+    import json
+    import tempfile
+
+    directory = os.path.dirname(path)
+    tmp_path = None
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, separators=(',', ':'))
+        os.rename(tmp_path, path)
+    except (IOError, OSError):
+        if tmp_path is not None:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+        return False
+    return True
 
 
 def get_git_info():
     """
-    Returns the current git branch and short commit hash
+    Returns the current git branch, short commit hash and if the working
+    tree is clean. How dirtiness is checked can be configured with
+    `git.dirty_check` (`status` or `diff-index`) in the config file.
     """
-    branch = run_local('git rev-parse --abbrev-ref HEAD')
-    commit = run_local('git rev-parse --short --verify {}'.format(branch))
-    clean = int(run_local('git status --porcelain | wc -l')) < 1
-    return branch, commit, clean
+    from ueli import git
+
+    ctx = click.get_current_context()
+    return git.get_git_info(dirty_check=ctx.obj['config'].git.dirty_check)
+
+
+def parse_timestamp(value):
+    """
+    Parses RFC 3339 timestamps as written by kubernetes and gcloud, e.g.
+    `2017-01-31T08:05:49Z`, and returns seconds since the epoch.
+    """
+    match = re.match(r'(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(\.\d+)?(Z|([+-])(\d\d):?(\d\d))?$',
+                     value.strip())
+    if not match:
+        raise ValueError("Invalid timestamp '{}'".format(value))
+    dt = datetime.datetime.strptime(match.group(1), '%Y-%m-%dT%H:%M:%S')
+    seconds = calendar.timegm(dt.timetuple())
+    if match.group(4):
+        offset = int(match.group(5)) * 3600 + int(match.group(6)) * 60
+        seconds -= offset if match.group(4) == '+' else -offset
+    return seconds
 
 
 def get_build_tag(service, branch, commit, tag=None):
@@ -38,6 +143,22 @@ def get_build_tag(service, branch, commit, tag=None):
     return '{service}:{tag_name}'.format(service=service, tag_name=tag_name)
 
 
+def get_remote(config):
+    return '{gcloud_registry}/{gcloud_project}'.format(
+        gcloud_registry=config.gcloud.registry,
+        gcloud_project=config.gcloud.project)
+
+
+def get_remote_tag(config, build_tag):
+    """
+    Returns the tag of a build tag in the remote registry, e.g.
+
+        eu.gcr.io/flatfox-project/flatfox-crawler_webapp:feature-xy.982405a
+
+    """
+    return '{remote}/{build_tag}'.format(remote=get_remote(config), build_tag=build_tag)
+
+
 def get_tag_name(branch, commit):
     return '{branch}.{commit}'.format(branch=branch, commit=commit)
 
@@ -50,17 +171,49 @@ def get_secret_name(service):
     return '{service}-secret'.format(service=service)
 
 
-def run_local(cmd, output=True, verbose=False, execute=True):
+def get_state_name(service):
+    return '{service}-ueli-state'.format(service=service)
+
+
+def run_local(cmd, output=True, verbose=False, execute=True, stream=False, **kwargs):
     """
-    TODO: handle output option like fabric
-    https://github.com/fabric/fabric/blob/master/fabric/operations.py#L1152
+    Runs a command given as argv list (strings are split like a shell would,
+    but no shell is involved) and returns its stripped stdout if `output`.
+    Without `output` the command gets the terminal, e.g. for editors, and
+    failures are ignored. `stream` prints stdout while the command runs.
+    Nothing is executed without `execute`, which is used for dry runs.
+    Other arguments like `timeout` and `retries` are passed to `runner.run`.
     """
-    ctx = click.get_current_context()
+    from ueli import runner
+
+    if isinstance(cmd, str):
+        cmd = shlex.split(cmd)
 
-    if verbose or ctx.obj['verbose']:
-        click.secho(u'$ {}'.format(cmd), fg='magenta')
+    # There's no click context in worker threads
+    ctx = click.get_current_context(silent=True)
+
+    if verbose or (ctx is not None and ctx.obj.get('verbose')):
+        click.secho(u'$ {}'.format(runner.format_cmd(cmd)), fg='magenta')
 
     if execute:
+        result = runner.run(cmd, capture=output, stream=stream, check=output, **kwargs)
         if output:
-            return subprocess.check_output(cmd, shell=True).strip()
-        subprocess.call(cmd, shell=True)
+            return result.stdout.strip()
+
+
+def run_captured(cmd, **kwargs):
+    """
+    Runs `cmd` and returns its exit code and output (stdout and stderr
+    combined) instead of raising or printing. Safe to call from worker
+    threads.
+    """
+    from ueli import runner
+
+    if isinstance(cmd, str):
+        cmd = shlex.split(cmd)
+    try:
+        result = runner.run(cmd, quiet=True, check=False, **kwargs)
+    except runner.CommandError as e:
+        # Timed out or cancelled
+        return e.returncode, str(e)
+    return result.returncode, result.output.strip()